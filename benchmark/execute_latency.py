@@ -0,0 +1,84 @@
+#
+#
+# Copyright 2019 XEBIALABS
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+#
+# THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND, EITHER EXPRESSED OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS
+# FOR A PARTICULAR PURPOSE. THIS CODE AND INFORMATION ARE NOT SUPPORTED BY XEBIALABS.
+#
+
+"""
+    Measures the per-command overhead of OverthereHostSession.execute using the local connection.
+
+    Run from the project directory, Gradle fetches Jython and Overthere:
+
+        ./gradlew benchmarkExecuteLatency -Piterations=20
+
+    or with Jython and the Overthere jar (and its dependencies) on the classpath:
+
+        jython -J-cp "overthere.jar:lib/*" benchmark/execute_latency.py [iterations]
+
+    The "sleep-drain" scenario reproduces the previous behaviour (conn.execute followed by a 1 second sleep),
+    the "eof-drain" scenario uses the current execute, which returns once stdout and stderr reach EOF.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "main", "resources"))
+
+from java.lang import Class
+from com.xebialabs.overthere import CmdLine, OperatingSystemFamily
+from com.xebialabs.overthere.util import CapturingOverthereExecutionOutputHandler
+from fastlane.overthere import LocalConnectionOptions, OverthereHost, OverthereHostSession
+
+COMMAND = ["echo", "fastlane"]
+
+
+def sleep_drain(session):
+    cmdline = CmdLine()
+    for s in COMMAND:
+        cmdline.addRaw(s)
+    so_handler = CapturingOverthereExecutionOutputHandler.capturingHandler()
+    se_handler = CapturingOverthereExecutionOutputHandler.capturingHandler()
+    session.get_conn().execute(so_handler, se_handler, cmdline)
+    time.sleep(1)
+
+
+def eof_drain(session):
+    session.execute(COMMAND)
+
+
+def measure(name, fn, session, iterations):
+    fn(session)
+    timings = []
+    for i in range(iterations):
+        start = time.time()
+        fn(session)
+        timings.append((time.time() - start) * 1000)
+    timings.sort()
+    print "| %s | %d | %.1f | %.1f | %.1f |" % (name, iterations, sum(timings) / len(timings),
+                                               timings[len(timings) / 2], timings[-1])
+
+
+def main(iterations):
+    host = OverthereHost(LocalConnectionOptions(os=OperatingSystemFamily.UNIX))
+    overthere = Class.forName("com.xebialabs.overthere.Overthere").getPackage().getImplementationVersion()
+    print "Jython %s, Overthere %s, local connection" % (sys.version.split()[0], overthere or "unknown")
+    with OverthereHostSession(host, enable_logging=False) as session:
+        print "| scenario | iterations | mean ms | median ms | max ms |"
+        print "| ------ | ------ | ------ | ------ | ------ |"
+        measure("sleep-drain", sleep_drain, session, iterations)
+        measure("eof-drain", eof_drain, session, iterations)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
@@ -0,0 +1,228 @@
+#
+#
+# Copyright 2019 XEBIALABS
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+#
+# THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND, EITHER EXPRESSED OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS
+# FOR A PARTICULAR PURPOSE. THIS CODE AND INFORMATION ARE NOT SUPPORTED BY XEBIALABS.
+#
+
+"""
+    Runs the Lane Task and the Matrix Lane Task end to end on the local host against the stub git and fastlane in benchmark/stubs,
+    so no network, repository or Xcode is needed.  The stubs read their delays and output volumes from
+    $XLR_FASTLANE_BENCH_DIR/stub.conf, which each scenario writes before it runs.
+
+    Run from the project directory, Gradle fetches Jython and Overthere and puts the stubs first on PATH:
+
+        ./gradlew benchmarkLaneTask -Pruns=3 -Pconcurrency=4
+
+    or with Jython and the Overthere jar (and its dependencies) on the classpath, with the stubs first on PATH:
+
+        PATH="$PWD/benchmark/stubs:$PATH" jython -J-cp "overthere.jar:lib/*" benchmark/lane_task.py [runs] [concurrency]
+
+    For each scenario the table shows the wall time of all runs, the mean task duration, the number of remote
+    commands with their mean latency, and the peak JVM heap.  The task's own log is discarded.
+    Scenarios check the outputs of their tasks, so the benchmark fails when the single round trip job script,
+    the result cache, the workspace budget or the matrix cells stop working.
+"""
+import os
+import shutil
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "main", "resources"))
+
+from java.lang import System
+from java.lang.management import ManagementFactory, MemoryType
+
+from fastlane import laneTask, matrixLaneTask
+from fastlane.markdown_logger import MarkdownLogger as mdl
+from fastlane.phase_timer import COMMAND_PHASE, PhaseTimer
+
+STUBS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stubs")
+BENCH_DIR = os.environ.get("XLR_FASTLANE_BENCH_DIR", "/tmp/xlr-fastlane-bench")
+
+
+class NullLogWriter(object):
+    """Discards the task log"""
+
+    def write(self, text):
+        pass
+
+    def flush(self):
+        pass
+
+
+def task_vars(base_dir, **overrides):
+    """
+    :return: lane task inputs with the defaults of synthetic.xml
+    """
+    params = {"clientHost": None, "clientHosts": [], "maxLanesPerHost": 2, "minFreeDiskMb": 0,
+              "xcodeVersion": None, "hostProbeTtlSecs": 600,
+              "gitCloneUrl": "file:///bench/app.git", "gitBranch": "", "gitRepoBaseDir": base_dir,
+              "gitMirrorDir": None, "gitFetchDepth": 0, "gitPartialClone": False, "gitWorktreeMode": "shared",
+              "gitWorkspaceBudgetMb": 0, "gitWorkspaceMinFreeMb": 0,
+              "dependencyCacheDir": None, "dependencyCacheMaxMb": 20480, "warmFastlane": False,
+              "resultCacheDir": None, "resultCacheEnv": [], "resultCacheTools": [], "resultArtifacts": [],
+              "forceRebuild": False, "lane": "bench", "options": {}, "laneTimeoutMins": 0, "singleRoundTrip": False,
+              "actionHistoryRuns": 20, "slowActionPercent": 150, "collectArtifacts": [], "artifactsDir": None,
+              "artifactStreams": 1, "artifactStoreDir": None, "artifactStoreKeepRuns": 50}
+    params.update(overrides)
+    return params
+
+
+def matrix_vars(base_dir, cells):
+    """
+    :return: matrix lane task inputs with the defaults of synthetic.xml
+    """
+    return {"clientHosts": [], "cells": cells, "maxParallel": 4, "maxPerHost": 2,
+            "gitRepoBaseDir": base_dir, "gitMirrorDir": None, "gitFetchDepth": 0, "gitPartialClone": False,
+            "gitWorktreeMode": "per-task"}
+
+
+def write_stub_conf(**settings):
+    if not os.path.isdir(BENCH_DIR):
+        os.makedirs(BENCH_DIR)
+    with open(os.path.join(BENCH_DIR, "stub.conf"), "w") as f:
+        for name in sorted(settings.keys()):
+            f.write("%s=%s\n" % (name, settings[name]))
+
+
+def reset_peak_heap():
+    System.gc()
+    for pool in ManagementFactory.getMemoryPoolMXBeans():
+        if pool.getType() == MemoryType.HEAP:
+            pool.resetPeakUsage()
+
+
+def peak_heap_mb():
+    used = 0
+    for pool in ManagementFactory.getMemoryPoolMXBeans():
+        if pool.getType() == MemoryType.HEAP:
+            used += pool.getPeakUsage().getUsed()
+    return used / (1024.0 * 1024.0)
+
+
+class ScenarioResult(object):
+
+    def __init__(self):
+        self.task_ms = []
+        self.commands = 0
+        self.command_ms = 0
+        self._lock = threading.Lock()
+
+    def add(self, timer):
+        with self._lock:
+            self.task_ms.append(timer.total_ms())
+            self.commands += timer.calls(COMMAND_PHASE)
+            self.command_ms += timer.duration_ms(COMMAND_PHASE)
+
+
+def run_task(task, params, result, check, run):
+    timer = PhaseTimer.start()
+    try:
+        task.process(params)
+    finally:
+        PhaseTimer.stop()
+    result.add(timer)
+    if check is not None and not check(run, params):
+        raise Exception("Unexpected task outputs in run %d: %s" % (run + 1, params))
+
+
+def run_scenario(name, runs, prepare, make_params, concurrency=1, task=laneTask, check=None):
+    """
+    :param prepare: called before each run
+    :param make_params: called with the task number, returns the task inputs
+    :param concurrency: tasks started together in each run
+    :param task: task script module whose process function is run
+    :param check: called with the run number and the task inputs and outputs after each task.  False fails the benchmark
+    """
+    result = ScenarioResult()
+    reset_peak_heap()
+    start = time.time()
+    for i in range(runs):
+        prepare()
+        if concurrency == 1:
+            run_task(task, make_params(0), result, check, i)
+            continue
+        errors = []
+
+        def worker(n, run=i):
+            try:
+                run_task(task, make_params(n), result, check, run)
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+    wall = time.time() - start
+    mean_task = sum(result.task_ms) / float(len(result.task_ms))
+    latency = result.command_ms / float(result.commands) if result.commands else 0
+    print "| %s | %d | %.2f | %.0f | %d | %.1f | %.0f |" % (name, len(result.task_ms), wall, mean_task,
+                                                            result.commands, latency, peak_heap_mb())
+
+
+def main(runs, concurrency):
+    if not os.environ.get("PATH", "").startswith(STUBS_DIR):
+        print "Put the stubs first on PATH: PATH=\"%s:$PATH\"" % STUBS_DIR
+        sys.exit(1)
+    repos = os.path.join(BENCH_DIR, "repos")
+
+    def clean():
+        shutil.rmtree(repos, ignore_errors=True)
+        os.makedirs(repos)
+
+    def keep():
+        pass
+
+    mdl.set_writer(NullLogWriter())
+    print "| scenario | tasks | wall s | mean task ms | commands | mean command ms | peak heap MB |"
+    print "| ------ | ------ | ------ | ------ | ------ | ------ | ------ |"
+
+    write_stub_conf(GIT_CLONE_SECS=0.5, GIT_CLONE_LINES=2000, FASTLANE_LINES=1000)
+    run_scenario("cold clone", runs, clean, lambda n: task_vars(repos))
+
+    write_stub_conf(GIT_PULL_SECS=0.1, GIT_PULL_LINES=100, FASTLANE_LINES=1000)
+    run_scenario("warm pull", runs, keep, lambda n: task_vars(repos))
+
+    write_stub_conf(FASTLANE_LINES=1000000, FASTLANE_STEPS=20)
+    run_scenario("1M-line lane output", runs, keep, lambda n: task_vars(repos))
+
+    write_stub_conf(GIT_FETCH_SECS=0.2, FASTLANE_LINES=10000, FASTLANE_SECS=1)
+    run_scenario("%d concurrent tasks" % concurrency, runs, keep,
+                 lambda n: task_vars(repos, gitBranch="release-%d" % n, gitWorktreeMode="per-task"),
+                 concurrency=concurrency)
+
+    write_stub_conf(FASTLANE_LINES=1000)
+    results = os.path.join(BENCH_DIR, "results")
+    shutil.rmtree(results, ignore_errors=True)
+    run_scenario("single round trip, cached result", runs, keep,
+                 lambda n: task_vars(repos, singleRoundTrip=True, resultCacheDir=results),
+                 check=lambda run, params: bool(params.get("resultCacheKey")) and (run == 0) != bool(params.get("resultCached")))
+
+    write_stub_conf(GIT_FETCH_SECS=0.1, FASTLANE_LINES=1000)
+    run_scenario("per-task worktrees, 1 MB budget", runs, keep,
+                 lambda n: task_vars(repos, gitBranch="feature-%d" % n, gitWorktreeMode="per-task", gitWorkspaceBudgetMb=1),
+                 concurrency=concurrency, check=lambda run, params: params.get("gitCommitSha"))
+
+    write_stub_conf(GIT_FETCH_SECS=0.1, FASTLANE_LINES=1000)
+    cells = ["file:///bench/app.git|release-%d|bench|flavor=f%d, configuration = Release" % (n, n) for n in range(concurrency)]
+    run_scenario("matrix of %d cells" % concurrency, runs, keep, lambda n: matrix_vars(repos, cells), task=matrixLaneTask)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 3, int(sys.argv[2]) if len(sys.argv) > 2 else 4)
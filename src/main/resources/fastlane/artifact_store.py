@@ -0,0 +1,284 @@
+#
+#
+# Copyright 2019 XEBIALABS
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+#
+# THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND, EITHER EXPRESSED OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS
+# FOR A PARTICULAR PURPOSE. THIS CODE AND INFORMATION ARE NOT SUPPORTED BY XEBIALABS.
+#
+
+"""
+    Content addressed store of collected artifacts on the XL Release server.  Files are hashed on the
+    fastlane host and only the contents missing from the store are transferred.  Each run keeps a
+    manifest of its files pointing at the shared blobs, and blobs no kept manifest points at are evicted.
+
+    <store>/blobs/<first 2 hex digits>/<sha-256>    file contents, read-only
+    <store>/runs/<run id>.manifest                 one '<sha-256> <bytes> <path>' line per file
+"""
+import hashlib
+import os
+import pipes
+import shutil
+import time
+import uuid
+
+from fastlane.artifacts import ArtifactCollector, ArtifactTransfer
+from fastlane.overthere import OverthereHostSession
+from fastlane.markdown_logger import MarkdownLogger as mdl
+
+HASH_SCRIPT = """cd %(base_dir)s || exit 1
+if command -v shasum >/dev/null 2>&1; then sha="shasum -a 256"; else sha=sha256sum; fi
+files=$(mktemp) || exit 1
+for p in %(patterns)s; do
+  [ -e "$p" ] && find "$p" -type f
+done | sort -u > "$files"
+if [ -s "$files" ]; then
+  tr '\\n' '\\0' < "$files" | xargs -0 $sha | sed 's/^/sha /'
+  tr '\\n' '\\0' < "$files" | xargs -0 du -k | sed 's/^/size /'
+fi
+rm -f "$files"
+exit 0
+"""
+READ_CHUNK = 1024 * 1024
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        chunk = f.read(READ_CHUNK)
+        while chunk:
+            digest.update(chunk)
+            chunk = f.read(READ_CHUNK)
+    return digest.hexdigest()
+
+
+class StoredFile(object):
+    """A file of a run"""
+
+    def __init__(self, path, sha, size):
+        """
+        :param path: path relative to the working copy
+        :param sha: sha-256 of the contents
+        :param size: bytes on the server, or KB on the host before the transfer
+        """
+        self.path = path
+        self.sha = sha
+        self.size = size
+
+
+class StoredRun(object):
+    """Outcome of storing the artifacts of a run"""
+
+    def __init__(self, run_id, manifest, files, transfer):
+        """
+        :param manifest: path of the run manifest, None when nothing matched
+        :param files: list of StoredFile
+        :param transfer: ArtifactTransfer of the missing blobs only
+        """
+        self.run_id = run_id
+        self.manifest = manifest
+        self.files = files
+        self.transfer = transfer
+
+
+class ArtifactStore(object):
+    """Deduplicating store of artifacts in a directory of the XL Release server"""
+
+    def __init__(self, store_dir, keep_runs=50, grace_secs=3600):
+        """
+        :param store_dir: directory on the XL Release server
+        :param keep_runs: manifests kept by gc(), newest first
+        :param grace_secs: gc() leaves blobs and staging dirs younger than this, so runs still storing
+                           their files are not affected
+        """
+        self.store_dir = store_dir
+        self.keep_runs = keep_runs
+        self.grace_secs = grace_secs
+        self.blobs_dir = os.path.join(store_dir, "blobs")
+        self.runs_dir = os.path.join(store_dir, "runs")
+        self.tmp_dir = os.path.join(store_dir, "tmp")
+
+    @staticmethod
+    def new_run_id():
+        return "%s-%s" % (time.strftime("%Y%m%d-%H%M%S"), uuid.uuid4().hex[:8])
+
+    def blob_path(self, sha):
+        return os.path.join(self.blobs_dir, sha[:2], sha)
+
+    def manifest_path(self, run_id):
+        return os.path.join(self.runs_dir, "%s.manifest" % run_id)
+
+    @staticmethod
+    def hash_files(collector, patterns):
+        """
+        Hashes the files matching the patterns on the host in one command.  Matching directories are walked.
+        :return: list of StoredFile, with sizes in KB
+        """
+        session = OverthereHostSession(collector.host, enable_logging=False, capture_max_lines=None)
+        with session:
+            response = session.execute_script(HASH_SCRIPT % {"base_dir": pipes.quote(collector.base_dir),
+                                                             "patterns": " ".join(patterns)},
+                                              "hash_artifacts.sh", show_script=False)
+        shas = {}
+        sizes = {}
+        for line in response.stdout:
+            if line.startswith("sha ") and len(line) > 70:
+                # '<sha-256>  <path>', or '<sha-256> *<path>' in binary mode
+                shas[line[70:]] = line[4:68]
+            elif line.startswith("size "):
+                parts = line[5:].split("\t", 1)
+                if len(parts) == 2 and parts[0].isdigit():
+                    sizes[parts[1]] = int(parts[0])
+        return [StoredFile(path, shas[path], sizes.get(path, 0)) for path in sorted(shas.keys())]
+
+    def collect(self, collector, patterns, run_id=None):
+        """
+        Stores the files matching the patterns and writes the manifest of the run.
+        :param collector: ArtifactCollector of the working copy on the host
+        :return: StoredRun
+        """
+        run_id = run_id or ArtifactStore.new_run_id()
+        files = ArtifactStore.hash_files(collector, patterns)
+        if not files:
+            mdl.println("No artifacts match %s in '%s'" % (", ".join(patterns), collector.base_dir))
+            return StoredRun(run_id, None, [], ArtifactTransfer([], 0, 0, 0, 0))
+
+        missing = {}
+        for f in files:
+            if not os.path.exists(self.blob_path(f.sha)) and f.sha not in missing:
+                missing[f.sha] = f
+        transfer = ArtifactTransfer([], 0, 0, 0, 0)
+        if missing:
+            transfer = self._fetch(collector, missing.values(), run_id)
+
+        stored = []
+        for f in files:
+            blob = self.blob_path(f.sha)
+            # a fresh mtime keeps gc() from evicting a blob this run points at
+            os.utime(blob, None)
+            stored.append(StoredFile(f.path, f.sha, os.path.getsize(blob)))
+        manifest = self._write_manifest(run_id, stored)
+
+        rows = [[f.path, "%d KB" % (f.size / 1024), f.sha[:12], "stored" if f.sha in missing else "deduplicated"]
+                for f in stored]
+        mdl.print_table(["Artifact", "Size", "SHA-256", "Blob"], rows)
+        mdl.println("%d artifact file(s) with %d new content(s) to store" % (len(files), len(missing)))
+        if missing:
+            ArtifactCollector.print_transfer(transfer)
+        return StoredRun(run_id, manifest, stored, transfer)
+
+    def _fetch(self, collector, missing, run_id):
+        """
+        Transfers one file per missing blob into a staging dir and moves them into the store.
+        :return: ArtifactTransfer
+        """
+        staging = os.path.join(self.tmp_dir, run_id)
+        try:
+            received, secs, streams = collector.download([(f.path, f.size) for f in missing], staging)
+            for f in missing:
+                staged = os.path.join(staging, f.path)
+                sha = sha256_file(staged)
+                if sha != f.sha:
+                    raise Exception("Artifact '%s' changed while it was copied, expected sha-256 %s but got %s"
+                                    % (f.path, f.sha, sha))
+                blob = self.blob_path(f.sha)
+                if not os.path.isdir(os.path.dirname(blob)):
+                    os.makedirs(os.path.dirname(blob))
+                os.chmod(staged, 0444)
+                try:
+                    os.rename(staged, blob)
+                except OSError:
+                    # another run stored the same contents meanwhile
+                    if not os.path.exists(blob):
+                        raise
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+        return ArtifactTransfer([f.path for f in missing], sum(f.size for f in missing), received, secs, streams)
+
+    def _write_manifest(self, run_id, files):
+        if not os.path.isdir(self.runs_dir):
+            os.makedirs(self.runs_dir)
+        manifest = self.manifest_path(run_id)
+        with open(manifest + ".tmp", "w") as out:
+            for f in files:
+                out.write("%s %d %s\n" % (f.sha, f.size, f.path))
+        os.rename(manifest + ".tmp", manifest)
+        return manifest
+
+    @staticmethod
+    def read_manifest(manifest):
+        """
+        :return: list of StoredFile
+        """
+        files = []
+        with open(manifest) as f:
+            for line in f:
+                parts = line.rstrip("\n").split(" ", 2)
+                if len(parts) == 3:
+                    files.append(StoredFile(parts[2], parts[0], int(parts[1])))
+        return files
+
+    def checkout(self, manifest, target_dir):
+        """
+        Places the files of a run in target_dir, hard linked to the blobs when possible and copied otherwise.
+        Hard linked files are read-only, as they share their contents with other runs.
+        :return: list of paths in target_dir
+        """
+        paths = []
+        for f in ArtifactStore.read_manifest(manifest):
+            target = os.path.join(target_dir, f.path)
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            if os.path.lexists(target):
+                os.remove(target)
+            try:
+                os.link(self.blob_path(f.sha), target)
+            except (AttributeError, OSError):
+                shutil.copyfile(self.blob_path(f.sha), target)
+            paths.append(target)
+        return paths
+
+    def gc(self):
+        """
+        Removes all but the newest keep_runs manifests, then the blobs none of the kept manifests points at.
+        :return: (removed manifests, removed blobs, freed bytes)
+        """
+        if not os.path.isdir(self.runs_dir):
+            return 0, 0, 0
+        manifests = [os.path.join(self.runs_dir, name) for name in os.listdir(self.runs_dir)
+                     if name.endswith(".manifest")]
+        manifests.sort(key=os.path.getmtime, reverse=True)
+        for manifest in manifests[self.keep_runs:]:
+            os.remove(manifest)
+        referenced = set()
+        for manifest in manifests[:self.keep_runs]:
+            referenced.update(f.sha for f in ArtifactStore.read_manifest(manifest))
+
+        cutoff = time.time() - self.grace_secs
+        blobs = 0
+        freed = 0
+        for prefix in os.listdir(self.blobs_dir) if os.path.isdir(self.blobs_dir) else []:
+            prefix_dir = os.path.join(self.blobs_dir, prefix)
+            for sha in os.listdir(prefix_dir):
+                blob = os.path.join(prefix_dir, sha)
+                if sha in referenced or os.path.getmtime(blob) > cutoff:
+                    continue
+                freed += os.path.getsize(blob)
+                os.remove(blob)
+                blobs += 1
+        for name in os.listdir(self.tmp_dir) if os.path.isdir(self.tmp_dir) else []:
+            if os.path.getmtime(os.path.join(self.tmp_dir, name)) < cutoff:
+                shutil.rmtree(os.path.join(self.tmp_dir, name), ignore_errors=True)
+
+        removed = max(0, len(manifests) - self.keep_runs)
+        mdl.println("Artifact store: removed %d run manifest(s) and %d unreferenced blob(s), freed %.1f MB" % (
+            removed, blobs, freed / (1024.0 * 1024.0)))
+        return removed, blobs, freed
@@ -0,0 +1,155 @@
+#
+#
+# Copyright 2019 XEBIALABS
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+#
+# THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND, EITHER EXPRESSED OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS
+# FOR A PARTICULAR PURPOSE. THIS CODE AND INFORMATION ARE NOT SUPPORTED BY XEBIALABS.
+#
+
+"""
+    Copies the artifacts of a lane from the fastlane host to the XL Release server.  The matching files
+    are listed in one command and then streamed as gzipped tars, one command per stream.
+"""
+import os
+import pipes
+import threading
+import time
+
+from fastlane.overthere import OverthereHostSession
+from fastlane.markdown_logger import MarkdownLogger as mdl
+
+LIST_SCRIPT = """cd %(base_dir)s || exit 1
+for f in %(patterns)s; do
+  [ -e "$f" ] && echo "$(du -sk "$f" | cut -f1) $f"
+done
+exit 0
+"""
+
+
+class ArtifactTransfer(object):
+    """Outcome of collecting artifacts"""
+
+    def __init__(self, paths, size_kb, received_bytes, secs, streams):
+        """
+        :param paths: collected paths, relative to the local directory
+        :param size_kb: size of the artifacts on the host
+        :param received_bytes: compressed bytes received
+        :param secs: duration of the transfer
+        :param streams: number of streams used
+        """
+        self.paths = paths
+        self.size_kb = size_kb
+        self.received_bytes = received_bytes
+        self.secs = secs
+        self.streams = streams
+
+    def throughput_mb_per_sec(self):
+        return self.received_bytes / (1024.0 * 1024.0) / max(self.secs, 0.001)
+
+
+class ArtifactCollector(object):
+    """Collects files matching glob patterns in a directory of the fastlane host"""
+
+    def __init__(self, host, base_dir, streams=1):
+        """
+        :param host: OverthereHost
+        :param base_dir: directory on the host the patterns are relative to, usually the working copy
+        :param streams: maximum number of tars streamed at the same time.  Each stream uses its own connection
+        """
+        self.host = host
+        self.base_dir = base_dir
+        self.streams = max(1, streams)
+
+    def list(self, patterns):
+        """
+        :param patterns: glob patterns relative to base_dir.  A matching directory is collected as a whole
+        :return: list of (path, size in KB) of the matching files and directories
+        """
+        session = OverthereHostSession(self.host, enable_logging=False, capture_max_lines=None)
+        with session:
+            response = session.execute_script(LIST_SCRIPT % {"base_dir": pipes.quote(self.base_dir),
+                                                             "patterns": " ".join(patterns)},
+                                              "list_artifacts.sh", show_script=False)
+        found = []
+        for line in response.stdout:
+            parts = line.split(" ", 1)
+            if len(parts) == 2 and parts[0].isdigit() and parts[1] not in [p for p, _ in found]:
+                found.append((parts[1], int(parts[0])))
+        return found
+
+    @staticmethod
+    def partition(entries, count):
+        """
+        Spreads the entries over at most count groups of about equal size, largest entries first.
+        :return: list of lists of paths
+        """
+        groups = [[0, []] for _ in range(min(count, len(entries)))]
+        for path, size_kb in sorted(entries, key=lambda e: -e[1]):
+            smallest = min(groups, key=lambda g: g[0])
+            smallest[0] += size_kb
+            smallest[1].append(path)
+        return [paths for _, paths in groups]
+
+    def download(self, entries, local_dir):
+        """
+        Streams the entries to local_dir over up to 'streams' parallel tars.
+        :param entries: list of (path relative to base_dir, size in KB)
+        :return: (compressed bytes received, seconds, number of streams used)
+        """
+        groups = ArtifactCollector.partition(entries, self.streams)
+        received = []
+        errors = []
+
+        def download(paths):
+            try:
+                session = OverthereHostSession(self.host, enable_logging=False)
+                with session:
+                    received.append(session.download_tar(self.base_dir, paths, local_dir))
+            except Exception, e:
+                errors.append(e)
+
+        start = time.time()
+        if len(groups) == 1:
+            download(groups[0])
+        else:
+            threads = [threading.Thread(target=download, args=(paths,), name="artifact-stream-%d" % i)
+                       for i, paths in enumerate(groups)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        if errors:
+            raise errors[0]
+        return sum(received), time.time() - start, len(groups)
+
+    def collect(self, patterns, local_dir):
+        """
+        Copies the files matching the patterns to local_dir, keeping their paths relative to base_dir.
+        :return: ArtifactTransfer
+        """
+        entries = self.list(patterns)
+        if not entries:
+            mdl.println("No artifacts match %s in '%s'" % (", ".join(patterns), self.base_dir))
+            return ArtifactTransfer([], 0, 0, 0, 0)
+
+        received, secs, streams = self.download(entries, local_dir)
+        transfer = ArtifactTransfer([p for p, _ in entries], sum(kb for _, kb in entries), received, secs, streams)
+        rows = [[path, "%d KB" % kb, os.path.join(local_dir, path)] for path, kb in entries]
+        mdl.print_table(["Artifact", "Size", "Copied To"], rows)
+        ArtifactCollector.print_transfer(transfer)
+        return transfer
+
+    @staticmethod
+    def print_transfer(transfer):
+        mdl.println("Received %.1f MB for %.1f MB of artifacts in %.1f s over %d stream(s): %.1f MB/s" % (
+            transfer.received_bytes / (1024.0 * 1024.0), transfer.size_kb / 1024.0, transfer.secs,
+            transfer.streams, transfer.throughput_mb_per_sec()))
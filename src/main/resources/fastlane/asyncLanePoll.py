@@ -0,0 +1,56 @@
+#
+#
+# Copyright 2019 XEBIALABS
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+#
+# THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND, EITHER EXPRESSED OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS
+# FOR A PARTICULAR PURPOSE. THIS CODE AND INFORMATION ARE NOT SUPPORTED BY XEBIALABS.
+#
+
+from fastlane.fastlane_host import FastlaneHost
+from fastlane.lane_job import LaneJob
+from fastlane.markdown_logger import MarkdownLogger as mdl
+
+
+def poll(task_vars):
+    """
+    Prints the lane output written since the previous poll.
+    :return: True while the lane is still running
+    """
+    host_ci = task_vars["clientHost"]
+    if task_vars["clientHosts"]:
+        host_ci = FastlaneHost.find(task_vars["clientHosts"], task_vars["selectedHost"])
+    job = LaneJob(FastlaneHost.new_host(host_ci), task_vars["jobDir"])
+    result = job.poll(task_vars["logOffset"] or 0)
+    task_vars["logOffset"] = result.offset
+
+    if len(result.lines) > 0:
+        mdl.print_code("\n".join(result.lines))
+
+    if result.running():
+        return True
+
+    if result.state == "lost":
+        raise Exception("Lane process is no longer running and did not record an exit code. Log: '%s'" % job.log_file)
+
+    task_vars["exitCode"] = result.rc
+    if result.rc != 0:
+        raise Exception(result.rc)
+    mdl.println("Lane finished")
+    return False
+
+
+if __name__ == '__main__' or __name__ == '__builtin__':
+    try:
+        if poll(locals()):
+            task.schedule("fastlane/asyncLanePoll.py", pollInterval)
+    finally:
+        mdl.flush()
@@ -0,0 +1,65 @@
+#
+#
+# Copyright 2019 XEBIALABS
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+#
+# THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND, EITHER EXPRESSED OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS
+# FOR A PARTICULAR PURPOSE. THIS CODE AND INFORMATION ARE NOT SUPPORTED BY XEBIALABS.
+#
+
+import uuid
+
+from fastlane.git_client import GitClient
+from fastlane.fastlane_client import FastlaneClient
+from fastlane.laneTask import find_result, preflight, prepare_repo, select_host
+from fastlane.markdown_logger import MarkdownLogger as mdl
+
+
+def process(task_vars):
+    """
+    :return: True when the lane was started, False when a cached result was used
+    """
+    # the host slot only covers starting the lane.  Once running, the lane is counted by the scheduler's probe
+    host, slot = select_host(task_vars)
+    git = GitClient.new_instance(task_vars, host=host)
+    try:
+        capabilities = preflight(task_vars, host, git)
+        prepare_repo(task_vars, git)
+
+        job_dir = "%s/.xlr-fastlane/jobs/%s" % (git.repo_base_dir, uuid.uuid4().hex)
+        fastlane = FastlaneClient.new_instance(git.git_dir, task_vars, host=host, capabilities=capabilities,
+                                               base_dir=git.repo_base_dir)
+        result = find_result(task_vars, fastlane)
+        if result is not None and result.hit():
+            git.release()
+            task_vars["exitCode"] = 0
+            return False
+        # the worktree is released on the host once the detached lane exits
+        job = fastlane.start_lane(task_vars["lane"], task_vars["options"], job_dir, cleanup_script=git.release_script(),
+                                  result=result)
+    except:
+        git.release()
+        raise
+    finally:
+        if slot is not None:
+            slot.release()
+
+    task_vars["jobDir"] = job.job_dir
+    task_vars["logOffset"] = 0
+    return True
+
+
+if __name__ == '__main__' or __name__ == '__builtin__':
+    try:
+        if process(locals()):
+            task.schedule("fastlane/asyncLanePoll.py", pollInterval)
+    finally:
+        mdl.flush()
@@ -0,0 +1,167 @@
+#
+#
+# Copyright 2019 XEBIALABS
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+#
+# THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND, EITHER EXPRESSED OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS
+# FOR A PARTICULAR PURPOSE. THIS CODE AND INFORMATION ARE NOT SUPPORTED BY XEBIALABS.
+#
+
+"""
+    Host-side cache of installed dependencies keyed by the lockfiles of the repository.  Each entry is
+    an uncompressed tar in the cache directory named '<kind>-<key>.tar'.  Entries are restored before
+    the lane, saved after a successful lane and evicted least recently used first once the cache grows
+    over its size budget.
+"""
+import pipes
+
+# Gradle user home of lanes run with a cache, unless GRADLE_USER_HOME is set.  Downloaded dependencies and
+# wrapper distributions live there, the project's .gradle directories only hold build state
+GRADLE_USER_HOME = ".xlr-gradle-home"
+
+# (kind, lockfiles, directories).  Lockfiles may be shell globs and are relative to the working copy.
+DEPENDENCY_KINDS = [
+    ("bundler", ["Gemfile.lock"], ["vendor/bundle"]),
+    ("cocoapods", ["Podfile.lock", "ios/Podfile.lock"], ["Pods", "ios/Pods"]),
+    ("gradle", ["gradle.lockfile", "*/gradle.lockfile", "gradle/dependency-locks/*.lockfile",
+                "gradle/libs.versions.toml", "android/gradle/libs.versions.toml",
+                "gradle/wrapper/gradle-wrapper.properties", "android/gradle/wrapper/gradle-wrapper.properties"],
+     ["%s/caches/modules-2" % GRADLE_USER_HOME, "%s/wrapper/dists" % GRADLE_USER_HOME]),
+]
+
+DEFAULT_MAX_MB = 20480
+
+SCRIPT_HEADER = """cache_dir=%(cache_dir)s
+mkdir -p "$cache_dir" || exit 1
+if command -v shasum >/dev/null 2>&1; then
+  sha() { shasum -a 256; }
+else
+  sha() { sha256sum; }
+fi
+# prints the cache key of the lockfiles given after the directories, nothing when no lockfile exists
+cache_key() {
+  dirs=$1
+  shift
+  found=""
+  for f in "$@"; do
+    [ -f "$f" ] && found="$found $f"
+  done
+  [ -n "$found" ] || return 0
+  { echo "$dirs"; cat $found; } | sha | cut -c1-16
+}
+# true when git tracks one of the directories.  Those are never replaced from the cache
+tracked() {
+  [ -n "$(git ls-files -- "$@" 2>/dev/null | head -n 1)" ]
+}
+"""
+
+RESTORE_TEMPLATE = """key=$(cache_key %(dirs_q)s %(lockfiles)s)
+if [ -n "$key" ] && [ -f "$cache_dir/%(kind)s-$key.tar" ] && ! tracked %(dirs)s; then
+  rm -rf %(dirs)s
+  if tar xf "$cache_dir/%(kind)s-$key.tar"; then
+    touch "$cache_dir/%(kind)s-$key.tar"
+    echo "Restored %(kind)s dependencies $key"
+  else
+    echo "Could not restore %(kind)s dependencies $key" >&2
+    rm -rf %(dirs)s
+  fi
+fi
+"""
+
+SAVE_TEMPLATE = """key=$(cache_key %(dirs_q)s %(lockfiles)s)
+if [ -n "$key" ] && [ ! -f "$cache_dir/%(kind)s-$key.tar" ] && ! tracked %(dirs)s; then
+  existing=""
+  for d in %(dirs)s; do
+    [ -d "$d" ] && existing="$existing $d"
+  done
+  if [ -n "$existing" ]; then
+    if tar cf "$cache_dir/.%(kind)s-$key.$$" $existing; then
+      mv "$cache_dir/.%(kind)s-$key.$$" "$cache_dir/%(kind)s-$key.tar"
+      echo "Saved %(kind)s dependencies $key"
+    else
+      rm -f "$cache_dir/.%(kind)s-$key.$$"
+    fi
+  fi
+fi
+"""
+
+EVICT_SCRIPT = """total=$(du -sk "$cache_dir" | cut -f1)
+for f in $(cd "$cache_dir" && ls -tr *.tar 2>/dev/null); do
+  [ $total -le %(max_kb)d ] && break
+  size=$(du -k "$cache_dir/$f" | cut -f1)
+  rm -f "$cache_dir/$f"
+  total=$((total - size))
+  echo "Evicted $f from the dependency cache"
+done
+"""
+
+
+class DependencyCache(object):
+    """Lockfile keyed cache of dependency directories on the fastlane host"""
+
+    def __init__(self, cache_dir, max_mb=DEFAULT_MAX_MB, kinds=None):
+        """
+        :param cache_dir: directory on the host holding the cache entries
+        :param max_mb: size budget of the cache.  Least recently used entries are removed above it
+        :param kinds: list of (kind, lockfiles, directories).  Defaults to DEPENDENCY_KINDS
+        """
+        self.cache_dir = cache_dir
+        self.max_mb = max_mb
+        self.kinds = kinds if kinds is not None else DEPENDENCY_KINDS
+
+    @staticmethod
+    def new_instance(params):
+        """
+        :return: DependencyCache, None when no cache directory is configured
+        """
+        if not params.get("dependencyCacheDir"):
+            return None
+        return DependencyCache(params["dependencyCacheDir"], max_mb=params.get("dependencyCacheMaxMb") or DEFAULT_MAX_MB)
+
+    def _header(self):
+        return SCRIPT_HEADER % {"cache_dir": pipes.quote(self.cache_dir)}
+
+    def _render(self, template):
+        parts = []
+        for kind, lockfiles, dirs in self.kinds:
+            parts.append(template % {"kind": kind, "lockfiles": " ".join(lockfiles),
+                                     "dirs": " ".join(dirs), "dirs_q": pipes.quote(" ".join(dirs))})
+        return "".join(parts)
+
+    def restore_script(self):
+        """
+        :return: shell script that restores the cached dependencies into the current directory
+        """
+        return self._header() + self._render(RESTORE_TEMPLATE)
+
+    def save_script(self):
+        """
+        :return: shell script that saves the dependencies of the current directory and evicts old entries
+        """
+        return self._header() + self._render(SAVE_TEMPLATE) + EVICT_SCRIPT % {"max_kb": self.max_mb * 1024}
+
+    def wrap(self, cmd):
+        """
+        Wraps a command so that it runs between restoring and saving the dependencies.
+        Dependencies are only saved when the command succeeds.  Cache failures never fail the command.
+        :param cmd: shell command run in the working copy
+        :return: shell script, exiting with the exit code of cmd
+        """
+        return "\n".join([
+            "( %s ) || true" % self.restore_script(),
+            "export BUNDLE_PATH=${BUNDLE_PATH:-vendor/bundle}",
+            "export GRADLE_USER_HOME=${GRADLE_USER_HOME:-$PWD/%s}" % GRADLE_USER_HOME,
+            cmd,
+            "cmd_rc=$?",
+            "if [ $cmd_rc -eq 0 ]; then",
+            "  ( %s ) || true" % self.save_script(),
+            "fi",
+            "exit $cmd_rc"])
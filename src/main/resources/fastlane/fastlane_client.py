@@ -16,46 +16,268 @@
 #
 
 import os
+import pipes
+import uuid
 
-from fastlane.overthere import LocalConnectionOptions, OverthereHost, OverthereHostSession, SshConnectionOptions
-from com.xebialabs.overthere import OperatingSystemFamily
+from org.python.core.util import FileUtil
+
+from fastlane.overthere import OverthereHostSession
+from fastlane.dependency_cache import DependencyCache
+from fastlane.lane_memo import LaneMemo
+from fastlane.lane_report import REPORT_FILE, ActionHistory, median, parse_report
+from fastlane.fastlane_host import FastlaneHost
+from fastlane.fastlane_preloader import FastlanePreloader
+from fastlane.lane_job import LaneJob
+from fastlane.running_lanes import LaneMarker
 from fastlane.markdown_logger import MarkdownLogger as mdl
+from fastlane.step_tracker import StepTracker
+from fastlane.phase_timer import timed
+
+LANE_OUTPUT_TAIL_LINES = 2000
+# full output of failed lanes, kept under the Working Dir for LANE_LOG_RETENTION_DAYS
+LANE_LOGS_DIR = ".xlr-fastlane/logs"
+LANE_LOG_RETENTION_DAYS = 7
 
 
 class FastlaneClient(object):
 
-    def __init__(self, git_dir, ssh_host=None, show_output=False):
+    def __init__(self, git_dir, ssh_host=None, show_output=False, host=None, dependency_cache=None, memo=None,
+                 preloader=None, timeout_secs=None, base_dir=None):
         self.show_output = show_output
         self.git_dir = git_dir
-
-        if ssh_host is None:
-            host_opts = LocalConnectionOptions(os=OperatingSystemFamily.UNIX)
-        else:
-            additional_props = ssh_host['connectionProperties']
-            host_opts = SshConnectionOptions(ssh_host['address'], ssh_host['username'], password=ssh_host["password"],
-                                             privateKeyFile=ssh_host["privateKeyFile"], **additional_props)
-        self.host = OverthereHost(host_opts)
+        self.host = host if host is not None else FastlaneHost.new_host(ssh_host)
+        self.dependency_cache = dependency_cache
+        self.memo = memo
+        self.preloader = preloader
+        self.timeout_secs = timeout_secs
+        """the lane and its processes on the host are killed when it runs longer than this.  None for no limit"""
+        self.base_dir = base_dir
+        self.marker = LaneMarker(base_dir) if base_dir else None
+        """marks the lane as running in the Working Dir base_dir, so host probes count it"""
 
 
     @staticmethod
-    def new_instance(git_dir, params, show_output=False):
-        return FastlaneClient(git_dir, ssh_host=params["clientHost"], show_output=show_output)
+    def new_instance(git_dir, params, show_output=False, host=None, capabilities=None, base_dir=None):
+        """
+        :param capabilities: HostCapabilities of the host.  The tool versions become part of the result key
+        :param base_dir: Working Dir on the host the lane is registered in while it runs
+        """
+        host_facts = capabilities.key_facts() if capabilities is not None else ()
+        return FastlaneClient(git_dir, ssh_host=params["clientHost"], show_output=show_output, host=host,
+                              dependency_cache=DependencyCache.new_instance(params),
+                              memo=LaneMemo.new_instance(params, host_facts=host_facts),
+                              preloader=FastlanePreloader.new_instance(params),
+                              timeout_secs=(params.get("laneTimeoutMins") or 0) * 60 or None, base_dir=base_dir)
+
 
+    def find_result(self, lane, options):
+        """
+        Looks up the result of a previous successful run of the lane on the current commit.
+        :return: LaneResult, None when results are not cached
+        """
+        if self.memo is None:
+            return None
+        with timed("result lookup"):
+            return self.memo.lookup(self.host, self.git_dir, lane, options)
 
-    def run_lane(self, lane, options):
+
+    def run_lane(self, lane, options, result=None):
+        """
+        :param result: LaneResult returned by find_result.  The run is recorded under its key when the lane succeeds
+        """
         mdl.println("Beginning lane '%s'" % lane)
-        session = OverthereHostSession(self.host, enable_logging=True, stream_command_output=False)
+        session = OverthereHostSession(self.host, enable_logging=True, stream_command_output=False,
+                                       capture_max_lines=LANE_OUTPUT_TAIL_LINES)
         with session:
-            mdl.println("Checking if '%s' is fastlane enabled" % self.git_dir)
-            ot_file = session.remote_file("%s/fastlane/Fastfile" % self.git_dir)
-            fastlane_exists = ot_file.exists()
+            # the full output is kept on the host, only its tail is kept in memory
+            log = session.work_dir_file("lane.log").path
+            # the Fastfile check is part of the lane command, saving a round trip
+            tracker = StepTracker()
+            with timed("lane"):
+                try:
+                    if self.dependency_cache is None and self.preloader is None:
+                        cmd = self.tee_cmd(self.checked_lane_cmd(lane, options), log)
+                        if self.marker is not None:
+                            cmd = self.marker.wrap_cmd(cmd)
+                        response = session.execute_cmd(cmd, show_output=False, listeners=[tracker],
+                                                       timeout_secs=self.timeout_secs, check_success=False)
+                    else:
+                        script = "%s\n%s" % (self.fastfile_check_script(), self.lane_script(lane, options))
+                        response = session.execute_script(self.tee_script(script, log), "lane.sh", check_success=False,
+                                                          show_script=False, listeners=[tracker],
+                                                          timeout_secs=self.timeout_secs)
+                except:
+                    tracker.finish(rc=1)
+                    raise
+            tracker.finish(rc=response.rc)
+
+            if response.rc != 0:
+                self.keep_failed_log(session, lane, log)
+                session.report_failure(response)
+
+            if result is not None and result.key:
+                with timed("result record"):
+                    session.execute_script(self.memo.record_result_script(result, self.git_dir, lane, log),
+                                           "lane_memo.sh", show_script=False)
 
+    @staticmethod
+    def tee_cmd(cmd, log_file):
+        """
+        :param cmd: lane command line as an Array of Strings
+        :param log_file: path on the host
+        :return: command line that copies the output of cmd, stderr merged into stdout, to log_file and exits with its exit code
+        """
+        rc_file = pipes.quote("%s.rc" % log_file)
+        return ["{", "("] + cmd + [");", "echo", "$?", ">", rc_file, ";", "}", "2>&1", "|", "tee", pipes.quote(log_file), ";",
+                                   "(", "exit", "$(cat", rc_file, "2>/dev/null", "||", "echo", "1)", ")"]
+
+    @staticmethod
+    def tee_script(script, log_file):
+        """
+        :param script: lane shell script
+        :param log_file: path on the host
+        :return: shell script that copies the output of script, stderr merged into stdout, to log_file and exits with its exit code
+        """
+        rc_file = pipes.quote("%s.rc" % log_file)
+        return "{ (\n%s\n) 2>&1; echo $? > %s; } | tee %s\nexit $(cat %s 2>/dev/null || echo 1)" % (
+            script, rc_file, pipes.quote(log_file), rc_file)
+
+    def keep_failed_log(self, session, lane, log):
+        """
+        Copies the full output of a failed lane out of the session's working directory, which is removed with the session,
+        into the Working Dir and removes the logs older than LANE_LOG_RETENTION_DAYS.
+        Without a Working Dir the output is only in the failure report.
+        :param log: path on the host of the lane's log in the session's working directory
+        """
+        if self.base_dir is None:
+            return
+        logs_dir = "%s/%s" % (self.base_dir, LANE_LOGS_DIR)
+        log_file = "%s/%s-%s.log" % (logs_dir, lane, uuid.uuid4().hex[:8])
+        keep = session.execute(["sh", "-c", pipes.quote("mkdir -p %s && find %s -name '*.log' -mtime +%d -exec rm -f {} + ; cp %s %s" % (
+            pipes.quote(logs_dir), pipes.quote(logs_dir), LANE_LOG_RETENTION_DAYS, pipes.quote(log), pipes.quote(log_file)))],
+                               check_success=False)
+        if keep.rc == 0:
+            mdl.println("Full output of lane '%s' on the host: `%s`" % (lane, log_file))
+
+
+    def start_lane(self, lane, options, job_dir, cleanup_script=None, result=None):
+        """
+        Starts the lane detached from the task.  Poll the returned job for its progress.
+        :param lane: lane to run
+        :param options: lane options
+        :param job_dir: directory on the host for the job's pid, log and exit code files
+        :param cleanup_script: shell script run on the host after the lane exits
+        :param result: LaneResult returned by find_result.  The run is recorded under its key when the lane succeeds
+        :return: LaneJob
+        """
+        mdl.println("Starting lane '%s'" % lane)
+        session = OverthereHostSession(self.host, enable_logging=True)
+        with session:
+            mdl.println("Checking if '%s' is fastlane enabled" % self.git_dir)
+            with timed("fastfile check"):
+                fastlane_exists = session.remote_file("%s/fastlane/Fastfile" % self.git_dir).exists()
             if not fastlane_exists:
-                raise Exception("fastlane not enabled for '%s'.  Run 'fastlane init' in your repository first." % self.git_dir)
+                raise Exception(self._not_enabled_msg())
+
+        job = LaneJob(self.host, job_dir)
+        if result is not None and result.key:
+            record = self.memo.record_result_script(result, self.git_dir, lane, job.log_file)
+            cleanup_script = "if [ $lane_rc -eq 0 ]; then\n( %s ) || true\nfi\n%s" % (record, cleanup_script or ":")
+        with timed("lane start"):
+            pid = job.start(self.lane_script(lane, options), cleanup_script=cleanup_script)
+        mdl.println("Lane '%s' running with pid %s. Output is written to '%s'" % (lane, pid, job.log_file))
+        return job
+
+
+    def lane_cmd(self, lane, options):
+        return ["cd", self.git_dir, "&&"] + self._fastlane_cmd(lane, options)
+
+
+    def checked_lane_cmd(self, lane, options):
+        """
+        :return: lane command line that fails with the 'not enabled' message when the Fastfile is missing
+        """
+        return ["[", "-f", "%s/fastlane/Fastfile" % self.git_dir, "]", "||", "{", "echo",
+                pipes.quote(self._not_enabled_msg()), ">&2;", "exit", "1;", "}", "&&"] + self.lane_cmd(lane, options)
+
+
+    def lane_script(self, lane, options):
+        """
+        :return: shell script running the lane, between restoring and saving dependencies when a cache is configured
+                 and in the preloaded fastlane worker when one is used.  The lane is marked as running while it runs
+        """
+        if self.dependency_cache is None and self.preloader is None:
+            script = " ".join(self.lane_cmd(lane, options))
+        else:
+            cmd = self._fastlane_cmd(lane, options)
+            cmd = self.preloader.command(cmd) if self.preloader is not None else " ".join(cmd)
+            if self.dependency_cache is not None:
+                cmd = self.dependency_cache.wrap(cmd)
+            script = "cd %s || exit 1\n%s" % (self.git_dir, cmd)
+        return self.marker.wrap_script(script) if self.marker is not None else script
+
+
+    def report_actions(self, history=None, slow_factor=1.5):
+        """
+        Reads the action durations of the last lane from fastlane/report.xml and prints them.
+        With a history, actions slower than slow_factor times their median duration are flagged
+        and the durations are added to the history.
+        :param history: ActionHistory of the lane
+        :return: (list of (action, seconds), list of SlowAction).  Both empty when fastlane wrote no report
+        """
+        session = OverthereHostSession(self.host, enable_logging=False)
+        with session:
+            report = session.remote_file("%s/%s" % (self.git_dir, REPORT_FILE))
+            if not report.exists():
+                mdl.println("No fastlane report found at '%s'" % report.path)
+                return [], []
+            stream = report.getInputStream()
+            try:
+                durations = parse_report(FileUtil.wrap(stream))
+            finally:
+                stream.close()
+            runs = []
+            if history is not None:
+                runs = history.load(session)
+                history.save(session, runs, durations)
+
+        slow = ActionHistory.slow_actions(durations, runs, slow_factor)
+        slow_names = [a.name for a in slow]
+        rows = []
+        for name, secs in durations:
+            previous = [run[name] for _, run in runs if name in run]
+            rows.append([name, "%.1f s" % secs, "%.1f s" % median(previous) if previous else "",
+                         "**slower than usual**" if name in slow_names else ""])
+        mdl.println("Action durations")
+        mdl.print_table(["Action", "Duration", "Median", "Flag"], rows)
+        for a in slow:
+            mdl.println("Action '%s' took %.1f s, %.1f times its median of %.1f s" % (a.name, a.secs, a.ratio(), a.median_secs))
+        return durations, slow
+
+
+    def memoized_lane_script(self, lane, options, force=False):
+        """
+        :return: shell script that skips the lane when a result for the current commit is cached and records successful runs
+        """
+        if self.memo is None:
+            return self.lane_script(lane, options)
+        return self.memo.guarded_script(self.git_dir, lane, options, self.lane_script(lane, options), force=force)
+
+
+    def _fastlane_cmd(self, lane, options):
+        cmd = ["fastlane", "--capture_output", lane]
+        if options:
+            for k in sorted(options.keys()):
+                cmd.append(pipes.quote("%s:%s" % (k, options[k])))
+        return cmd
+
+
+    def fastfile_check_script(self):
+        """
+        :return: shell script that fails when the Fastfile is missing
+        """
+        return "if [ ! -f %s/fastlane/Fastfile ]; then\n  echo %s >&2\n  exit 1\nfi" % (self.git_dir, pipes.quote(self._not_enabled_msg()))
 
-            cmd = ["cd", self.git_dir, "&&", "fastlane", "--capture_output", lane]
-            if options:
-                for k in options.keys:
-                    cmd.extend("%s:%s" % (k, options[k]))
 
-            session.execute_cmd(cmd, show_output=False)
+    def _not_enabled_msg(self):
+        return "fastlane not enabled for '%s'.  Run 'fastlane init' in your repository first." % self.git_dir
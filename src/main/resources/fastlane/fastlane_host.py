@@ -0,0 +1,62 @@
+#
+#
+# Copyright 2019 XEBIALABS
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+#
+# THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND, EITHER EXPRESSED OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS
+# FOR A PARTICULAR PURPOSE. THIS CODE AND INFORMATION ARE NOT SUPPORTED BY XEBIALABS.
+#
+
+from fastlane.overthere import LocalConnectionOptions, OverthereHost, SshConnectionOptions
+from com.xebialabs.overthere import OperatingSystemFamily
+from fastlane.markdown_logger import MarkdownLogger as mdl
+
+
+class FastlaneHost(object):
+
+    @staticmethod
+    def new_host(ssh_host=None):
+        """
+        Builds the OverthereHost for a fastlane.Host configuration item.
+        :param ssh_host: fastlane.Host ci.  When None, the local host is used.
+        :return: OverthereHost
+        """
+        if ssh_host is None:
+            mdl.println("SSH Host not configured.  Using local connection option.")
+            return OverthereHost(LocalConnectionOptions(os=OperatingSystemFamily.UNIX))
+
+        mdl.println("Using SSH Host %s" % ssh_host['address'])
+        additional_props = ssh_host['connectionProperties']
+        host_opts = SshConnectionOptions(ssh_host['address'], ssh_host['username'], password=ssh_host["password"],
+                                         privateKeyFile=ssh_host["privateKeyFile"], **additional_props)
+        return OverthereHost(host_opts, max_connections=ssh_host["maxConnections"])
+
+    @staticmethod
+    def name(ssh_host):
+        """
+        :param ssh_host: fastlane.Host ci or None for the local host
+        :return: display name of the host
+        """
+        if ssh_host is None:
+            return "local"
+        return ssh_host["title"] or ssh_host["address"]
+
+    @staticmethod
+    def find(ssh_hosts, name):
+        """
+        :param ssh_hosts: Array of fastlane.Host ci
+        :param name: display name of the host
+        :return: the fastlane.Host ci with the name
+        """
+        for ssh_host in ssh_hosts:
+            if FastlaneHost.name(ssh_host) == name:
+                return ssh_host
+        raise Exception("Fastlane host '%s' not found" % name)
@@ -0,0 +1,265 @@
+#
+#
+# Copyright 2019 XEBIALABS
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+#
+# THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND, EITHER EXPRESSED OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS
+# FOR A PARTICULAR PURPOSE. THIS CODE AND INFORMATION ARE NOT SUPPORTED BY XEBIALABS.
+#
+
+"""
+    Runs lanes in a preloaded fastlane worker instead of a cold 'fastlane' process.  The worker is a Ruby
+    process on the host that has loaded fastlane and its actions once.  It forks a child per lane request
+    received on a unix socket and streams the child's output back to a small client, which prints it and
+    exits with the lane's exit code.
+
+    There is one worker per repository, shared by its worktrees, in /tmp/xlr-fastlane-<uid>.  With a Gemfile the
+    worker loads the bundle's gems, as 'bundle exec' would.  A worker is restarted when Gemfile.lock or
+    fastlane/Pluginfile changes and exits after being idle.  When the worker
+    cannot be started the lane runs cold.
+"""
+RC_MARKER = "##xlr-fastlane-rc"
+SCRIPT_VERSION = "3"
+DEFAULT_IDLE_SECS = 1800
+
+SERVER_RB = r"""# Preloaded fastlane worker.  Usage: ruby server.rb <socket> <boot dir> <idle secs>
+require 'socket'
+require 'json'
+
+RC_MARKER = '##RC_MARKER##'
+sock_path, boot_dir, idle_secs = ARGV[0], ARGV[1], ARGV[2].to_i
+
+# a session of its own, so killing the process group of the lane that started the worker leaves it running
+Process.setsid rescue nil
+Dir.chdir(boot_dir)
+bundle_gemfile = File.exist?('Gemfile') ? File.expand_path('Gemfile') : nil
+if bundle_gemfile
+  ENV['BUNDLE_GEMFILE'] = bundle_gemfile
+  require 'bundler/setup'
+end
+require 'fastlane'
+require 'fastlane/cli_tools_distributor'
+begin
+  Fastlane.load_actions
+  Fastlane.plugin_manager.load_plugins if File.exist?(File.join('fastlane', 'Pluginfile'))
+rescue StandardError, LoadError => e
+  warn "Preloading fastlane actions failed: #{e}"
+end
+
+File.unlink(sock_path) if File.exist?(sock_path)
+server = UNIXServer.new(sock_path)
+File.chmod(0600, sock_path)
+server_pid = Process.pid
+# forked lanes run the at_exit handlers too, only the worker removes the socket
+at_exit { File.unlink(sock_path) rescue nil if Process.pid == server_pid }
+Signal.trap('TERM') { exit 0 }
+$stdout.sync = true
+puts "fastlane #{Fastlane::VERSION} preloaded in #{boot_dir}"
+
+lanes = []
+loop do
+  lanes.reject! { |t| !t.alive? }
+  unless IO.select([server], nil, nil, idle_secs)
+    next unless lanes.empty?
+    puts 'Idle, exiting'
+    break
+  end
+  client = server.accept
+  request = JSON.parse(client.gets || '{}') rescue nil
+  unless request
+    client.close
+    next
+  end
+  pid = fork do
+    server.close
+    Signal.trap('TERM', 'DEFAULT')
+    Process.setsid
+    $stdin.reopen(File::NULL)
+    $stdout.reopen(client)
+    $stderr.reopen(client)
+    $stdout.sync = true
+    $stderr.sync = true
+    ENV.replace(request['env'])
+    ENV['BUNDLE_GEMFILE'] = bundle_gemfile if bundle_gemfile
+    Dir.chdir(request['dir'])
+    ARGV.replace(request['args'])
+    Fastlane::CLIToolsDistributor.take_off
+    exit 0
+  end
+  puts "Lane #{request['args'].inspect} in #{request['dir']} running with pid #{pid}"
+  # a client that goes away, e.g. an aborted task, takes the lane and its process group with it
+  watcher = Thread.new(client, pid) do |c, p|
+    begin
+      c.read
+    rescue StandardError
+    end
+    begin
+      Process.kill('TERM', -p)
+      sleep 10
+      Process.kill('KILL', -p)
+    rescue StandardError
+    end
+  end
+  lanes << Thread.new(client, pid, watcher) do |c, p, w|
+    _, status = Process.wait2(p)
+    w.kill
+    rc = status.exitstatus || 128 + status.termsig.to_i
+    begin
+      c.write("#{RC_MARKER} #{rc}\n")
+      c.close
+    rescue StandardError
+    end
+    puts "Lane with pid #{p} exited with #{rc}"
+  end
+end
+""".replace("##RC_MARKER##", RC_MARKER)
+
+CLIENT_RB = r"""# Runs a lane in the preloaded worker.  Usage: ruby client.rb <socket> <fastlane arguments>
+require 'socket'
+require 'json'
+
+RC_MARKER = '##RC_MARKER##'
+sock = UNIXSocket.new(ARGV.shift)
+%w[TERM INT HUP].each do |signal|
+  Signal.trap(signal) do
+    sock.close rescue nil
+    exit 143
+  end
+end
+sock.puts(JSON.generate('dir' => Dir.pwd, 'args' => ARGV, 'env' => ENV.to_h))
+$stdout.sync = true
+rc = nil
+while (line = sock.gets)
+  i = line.index(RC_MARKER)
+  if i
+    puts line[0...i] if i > 0
+    rc = line[i + RC_MARKER.length..-1].to_i
+    break
+  end
+  $stdout.write(line)
+end
+unless rc
+  warn 'The fastlane worker closed the connection before the lane finished'
+  rc = 1
+end
+exit rc
+""".replace("##RC_MARKER##", RC_MARKER)
+
+ENSURE_TEMPLATE = """preload_root=/tmp/xlr-fastlane-$(id -u)
+mkdir -p $preload_root && chmod 700 $preload_root || exit 1
+preload_server=$preload_root/server-%(version)s.rb
+preload_client=$preload_root/client-%(version)s.rb
+if [ ! -f $preload_server ]; then
+  cat > $preload_server.$$ <<'XLR_FASTLANE_SERVER'
+%(server_rb)sXLR_FASTLANE_SERVER
+  mv $preload_server.$$ $preload_server
+fi
+if [ ! -f $preload_client ]; then
+  cat > $preload_client.$$ <<'XLR_FASTLANE_CLIENT'
+%(client_rb)sXLR_FASTLANE_CLIENT
+  mv $preload_client.$$ $preload_client
+fi
+preload_repo=$(cd "$(git rev-parse --git-common-dir 2>/dev/null || echo .)" && pwd)
+preload_key=$(echo "$preload_repo" | cksum | cut -d' ' -f1)
+preload_sock=$preload_root/$preload_key.sock
+preload_deps="%(version)s $(cat Gemfile.lock fastlane/Pluginfile 2>/dev/null | cksum)"
+# one task starts the worker, others wait for it.  A task that cannot get the lock runs the lane cold
+preload_lock=$preload_root/$preload_key.lock
+preload_waited=0
+until mkdir $preload_lock 2>/dev/null; do
+  if [ -n "$(find $preload_lock -maxdepth 0 -mmin +10 2>/dev/null)" ]; then
+    rm -rf $preload_lock
+    continue
+  fi
+  [ $preload_waited -ge %(lock_secs)d ] && exit 1
+  sleep 1
+  preload_waited=$((preload_waited + 1))
+done
+trap "rm -rf $preload_lock; exit 143" TERM INT HUP
+preload_pid=$(cat $preload_root/$preload_key.pid 2>/dev/null)
+if [ -n "$preload_pid" ] && kill -0 $preload_pid 2>/dev/null && [ -S $preload_sock ] && \\
+   [ "$(cat $preload_root/$preload_key.deps 2>/dev/null)" = "$preload_deps" ]; then
+  echo "Using the fastlane worker with pid $preload_pid" >&2
+else
+  if [ -n "$preload_pid" ] && kill $preload_pid 2>/dev/null; then
+    echo "Restarting the fastlane worker, Gemfile.lock or Pluginfile changed" >&2
+  fi
+  rm -f $preload_sock
+  echo "$preload_deps" > $preload_root/$preload_key.deps
+  nohup ruby $preload_server $preload_sock "$(pwd)" %(idle_secs)d > $preload_root/$preload_key.log 2>&1 < /dev/null &
+  preload_pid=$!
+  echo $preload_pid > $preload_root/$preload_key.pid
+  preload_waited=0
+  while [ ! -S $preload_sock ] && kill -0 $preload_pid 2>/dev/null && [ $preload_waited -lt %(start_secs)d ]; do
+    sleep 1
+    preload_waited=$((preload_waited + 1))
+  done
+  if [ -S $preload_sock ]; then
+    echo "Started the fastlane worker with pid $preload_pid in $preload_waited s" >&2
+  else
+    echo "The fastlane worker did not start, running the lane cold.  See $preload_root/$preload_key.log" >&2
+    tail -5 $preload_root/$preload_key.log >&2
+    kill $preload_pid 2>/dev/null
+    rm -f $preload_root/$preload_key.pid
+    preload_sock=""
+  fi
+fi
+rm -rf $preload_lock
+trap - TERM INT HUP
+[ -z "$preload_sock" ] || echo $preload_sock $preload_client"""
+
+
+class FastlanePreloader(object):
+    """Preloaded fastlane worker on the fastlane host"""
+
+    def __init__(self, idle_secs=DEFAULT_IDLE_SECS, start_secs=120):
+        """
+        :param idle_secs: a worker without lanes for this long exits
+        :param start_secs: maximum time to wait for a new worker to preload fastlane
+        """
+        self.idle_secs = idle_secs
+        self.start_secs = start_secs
+
+    @staticmethod
+    def new_instance(params):
+        """
+        :return: FastlanePreloader, None unless Warm fastlane is set
+        """
+        if not params.get("warmFastlane"):
+            return None
+        return FastlanePreloader()
+
+    def ensure_script(self):
+        """
+        :return: shell script run in the working copy that starts the worker when needed and prints
+                 '<socket> <client script>'.  Nothing is printed when the worker cannot be started
+        """
+        return ENSURE_TEMPLATE % {"version": SCRIPT_VERSION, "server_rb": SERVER_RB, "client_rb": CLIENT_RB,
+                                  "idle_secs": self.idle_secs, "start_secs": self.start_secs,
+                                  "lock_secs": self.start_secs + 60}
+
+    def command(self, fastlane_cmd):
+        """
+        :param fastlane_cmd: fastlane command line as an Array of Strings, 'fastlane' first
+        :return: shell script run in the working copy that runs the command in the worker, or cold when
+                 there is no worker.  Exits with the command's exit code
+        """
+        args = " ".join(fastlane_cmd[1:])
+        return "\n".join([
+            "preload_ensure() {",
+            self.ensure_script(),
+            "}",
+            "set -- $(preload_ensure)",
+            "if [ -n \"$1\" ]; then",
+            "  ruby \"$2\" \"$1\" %s" % args,
+            "else",
+            "  %s" % " ".join(fastlane_cmd),
+            "fi"])
@@ -15,16 +15,32 @@
 # FOR A PARTICULAR PURPOSE. THIS CODE AND INFORMATION ARE NOT SUPPORTED BY XEBIALABS.
 #
 
+import hashlib
 import os
+import pipes
+import re
+import uuid
 
-from fastlane.overthere import LocalConnectionOptions, OverthereHost, OverthereHostSession, SshConnectionOptions
-from com.xebialabs.overthere import OperatingSystemFamily
+from fastlane.overthere import OverthereHostSession
+from fastlane.fastlane_host import FastlaneHost
+from fastlane.host_lock import HostLock
+from fastlane.job_script import JobScript
 from fastlane.markdown_logger import MarkdownLogger as mdl
+from fastlane.phase_timer import timed
+from fastlane.workspaces import WorkspaceManager
+
+SHA_RE = re.compile(r'^[0-9a-f]{40}$')
+MIRROR_REMOTE = "xlr-mirror"
+
+WORKTREE_SHARED = "shared"
+WORKTREE_PER_BRANCH = "per-branch"
+WORKTREE_PER_TASK = "per-task"
 
 
 class GitClient(object):
 
-    def __init__(self, clone_url, repo_base_dir, ssh_host=None, show_output=False):
+    def __init__(self, clone_url, repo_base_dir, ssh_host=None, show_output=False, host=None, mirror_base_dir=None,
+                 worktree_mode=WORKTREE_SHARED, worktree_ref=None, workspaces=None):
         self.show_output = show_output
         self.repo_base_dir = repo_base_dir
         if not repo_base_dir.startswith("/"):
@@ -33,39 +49,271 @@ class GitClient(object):
         clone_url_parts = clone_url.split('/')
         self.repo_name = clone_url_parts[len(clone_url_parts) - 1]
         self.git_dir = "%s/%s" % (self.repo_base_dir, self.repo_name)
-        if ssh_host is None:
-            mdl.println("SSH Host not configured.  Using local connection option.")
-            host_opts = LocalConnectionOptions(os=OperatingSystemFamily.UNIX)
-        else:
-            mdl.println("Using SSH Host %s" % ssh_host['address'])
-            additional_props = ssh_host['connectionProperties']
-            host_opts = SshConnectionOptions(ssh_host['address'], ssh_host['username'], password=ssh_host["password"],
-                                             privateKeyFile=ssh_host["privateKeyFile"], **additional_props)
-        self.host = OverthereHost(host_opts)
+        self.host = host if host is not None else FastlaneHost.new_host(ssh_host)
+        self.mirror_dir = None
+        if mirror_base_dir:
+            url_hash = hashlib.sha1(clone_url).hexdigest()[:12]
+            self.mirror_dir = "%s/%s-%s.git" % (mirror_base_dir.rstrip("/"), self.repo_name.replace(".git", ""), url_hash)
+
+        # with worktrees, git_dir is a worktree of a bare store shared by all tasks building this repository
+        self.worktree_mode = worktree_mode if worktree_ref else WORKTREE_SHARED
+        self.store_dir = None
+        self.worktree_lock = None
+        if self.worktree_mode != WORKTREE_SHARED:
+            worktrees_dir = "%s/.xlr-fastlane/worktrees/%s" % (self.repo_base_dir, self.repo_name)
+            self.store_dir = "%s/store.git" % worktrees_dir
+            name = re.sub(r'[^A-Za-z0-9._-]', '_', worktree_ref)
+            if self.worktree_mode == WORKTREE_PER_TASK:
+                name = "%s-%s" % (name, uuid.uuid4().hex[:12])
+            self.git_dir = "%s/%s" % (worktrees_dir, name)
+            self.worktree_lock = HostLock("%s.lock" % self.git_dir, wait_secs=4 * 3600, stale_secs=12 * 3600)
+
+        # only working copies cloned from gitCloneUrl are managed, git_dir is the Working Dir itself otherwise
+        self.workspaces = workspaces if clone_url else None
 
 
     @staticmethod
-    def new_instance(params, show_output=False):
-        return GitClient(params["gitCloneUrl"], params["gitRepoBaseDir"], ssh_host=params["clientHost"], show_output=show_output)
+    def new_instance(params, show_output=False, host=None):
+        return GitClient(params["gitCloneUrl"], params["gitRepoBaseDir"], ssh_host=params["clientHost"], show_output=show_output, host=host,
+                         mirror_base_dir=params["gitMirrorDir"], worktree_mode=params["gitWorktreeMode"] or WORKTREE_SHARED,
+                         worktree_ref=params["gitBranch"],
+                         workspaces=WorkspaceManager.new_instance(params["gitRepoBaseDir"], params))
+
+
+    def cache_dirs(self):
+        """
+        :return: directories on the host that make syncing this repository cheaper when they exist
+        """
+        dirs = ["%s/%s/.git" % (self.repo_base_dir, self.repo_name), self.store_dir, self.mirror_dir]
+        return [d for d in dirs if d]
 
 
     def checkout(self, branch):
         session = OverthereHostSession(self.host, enable_logging=True)
         with session:
             mdl.println("Checking out '%s'" % branch)
-            session.execute_cmd(["cd", self.git_dir, "&&", "git", "checkout", branch])
+            with timed("git checkout"):
+                session.execute_cmd(self.checkout_cmd(branch))
         
 
     def fetch_repo(self):
         mdl.println("Checking if '%s' exists in dir '%s'" % (self.repo_name, self.git_dir))
         session = OverthereHostSession(self.host, enable_logging=True)
         with session:
-            ot_file = session.remote_file(self.git_dir)
-            dir_exists = ot_file.exists()
+            if self.workspaces:
+                with timed("workspace hold"):
+                    session.execute_script(self.workspaces.hold_script(self.git_dir), "workspace_hold.sh", show_script=False)
+            with timed("exists check"):
+                ot_file = session.remote_file(self.git_dir)
+                dir_exists = ot_file.exists()
 
             if dir_exists:
                 mdl.println("Already cloned. Pulling latest changes")
-                session.execute_cmd(["cd", self.git_dir, "&&", "git", "pull"])
+                with timed("git pull"):
+                    session.execute_cmd(self.pull_cmd())
+            elif self.mirror_dir:
+                mdl.println("Cloning to '%s' using mirror '%s'" % (self.git_dir, self.mirror_dir))
+                with timed("git clone"):
+                    session.execute_script(self.clone_script())
             else:
                 mdl.println("Cloning to '%s'" % self.git_dir)
-                session.execute_cmd(["git", "clone", self.clone_url, self.git_dir])
+                with timed("git clone"):
+                    session.execute_cmd(self.clone_cmd())
+
+
+    def sync_to_ref(self, ref, depth=None, partial=False):
+        """
+        Makes the working copy match a single branch, tag or commit.  Only that ref is fetched.
+        :param ref: branch, tag or commit SHA
+        :param depth: fetch only this many commits of history.  None or 0 for full history
+        :param partial: True to fetch without file contents (--filter=blob:none).  Contents are fetched on checkout
+        :return: SHA of the checked out commit
+        """
+        mdl.println("Syncing '%s' to '%s'" % (self.git_dir, ref))
+        job = JobScript(filename="git_sync.sh")
+        job.add_step("sync", self.sync_script(ref, depth, partial))
+        with timed("git sync"):
+            response = job.run(self.host, show_steps=False)
+        sha = response.outputs["commit"]
+        mdl.println("'%s' is at commit %s" % (ref, sha))
+        return sha
+
+
+    def sync_script(self, ref, depth=None, partial=False):
+        """
+        :return: job script step that fetches the ref, force checks it out and records the commit SHA as the 'commit' output.
+                 A branch is checked out as a local branch of the same name, tags and commits are checked out detached
+                 with the ref recorded in the working copy's 'xlr-fastlane.ref' git config
+        """
+        lines = []
+        if self.workspaces:
+            lines.append(self.workspaces.hold_script(self.git_dir))
+        if self.worktree_mode != WORKTREE_SHARED:
+            lines.append(self._worktree_sync_script(ref, depth, partial))
+            return "\n".join(lines)
+
+        remote = "origin"
+        if self.mirror_dir:
+            lines.append(self.refresh_mirror_script())
+            remote = MIRROR_REMOTE
+        lines.extend([
+            "if [ ! -d %s/.git ]; then" % self.git_dir,
+            "  mkdir -p %s && git -C %s init --quiet && git -C %s remote add origin %s || exit 1" % (self.git_dir, self.git_dir, self.git_dir, self.clone_url),
+            "fi",
+            "cd %s || exit 1" % self.git_dir])
+        if self.mirror_dir:
+            lines.append("git remote get-url %s > /dev/null 2>&1 || git remote add %s file://%s" % (remote, remote, self.mirror_dir))
+        if partial:
+            lines.append("git config remote.%s.promisor true && git config remote.%s.partialclonefilter blob:none" % (remote, remote))
+
+        lines.append("%s || exit $?" % " ".join(self._fetch_cmd(remote, ref, depth, partial)))
+        if SHA_RE.match(ref):
+            lines.append("git checkout --force --detach FETCH_HEAD || exit $?")
+        else:
+            # FETCH_HEAD describes the fetched ref as "branch '<name>' of <url>" or "tag '<name>' of <url>"
+            branch = ref[len("refs/heads/"):] if ref.startswith("refs/heads/") else ref
+            lines.extend([
+                "if head -1 .git/FETCH_HEAD | cut -f3 | grep -q \"^branch '\"; then",
+                "  git checkout --force -B %s FETCH_HEAD || exit $?" % pipes.quote(branch),
+                "else",
+                "  git checkout --force --detach FETCH_HEAD || exit $?",
+                "fi"])
+        lines.extend([
+            "git config xlr-fastlane.ref %s" % pipes.quote(ref),
+            "job_output commit $(git rev-parse HEAD)"])
+        return "\n".join(lines)
+
+
+    def _fetch_cmd(self, remote, ref, depth, partial):
+        fetch = ["git", "fetch", "--no-tags", "--force"]
+        if depth:
+            fetch.append("--depth=%d" % depth)
+        if partial:
+            fetch.append("--filter=blob:none")
+        fetch.extend([remote, pipes.quote(ref)])
+        return fetch
+
+
+    def _worktree_sync_script(self, ref, depth, partial):
+        # The worktree lock is held until release().  The store lock only covers the fetch and worktree
+        # bookkeeping, so tasks building other refs check out and run in parallel.
+        store_lock = HostLock("%s.lock" % self.store_dir)
+        remote = "origin"
+        lines = [self.worktree_lock.acquire_script()]
+        if self.mirror_dir:
+            lines.append(self.refresh_mirror_script())
+            remote = MIRROR_REMOTE
+        lines.extend([
+            store_lock.acquire_script(),
+            "(",
+            "  if [ ! -d %s ]; then" % self.store_dir,
+            "    git init --bare --quiet %s && git --git-dir=%s remote add origin %s || exit 1" % (self.store_dir, self.store_dir, self.clone_url),
+            "  fi",
+            "  cd %s || exit 1" % self.store_dir])
+        if self.mirror_dir:
+            lines.append("  git remote get-url %s > /dev/null 2>&1 || git remote add %s file://%s" % (remote, remote, self.mirror_dir))
+        if partial:
+            lines.append("  git config remote.%s.promisor true && git config remote.%s.partialclonefilter blob:none" % (remote, remote))
+        lines.extend([
+            "  %s || exit $?" % " ".join(self._fetch_cmd(remote, ref, depth, partial)),
+            "  git rev-parse FETCH_HEAD > %s.sha || exit $?" % self.worktree_lock.path,
+            "  if [ ! -f %s/.git ]; then" % self.git_dir,
+            "    git worktree prune && git worktree add --force --detach --no-checkout %s $(cat %s.sha) || exit $?" % (self.git_dir, self.worktree_lock.path),
+            "  fi",
+            ")",
+            "store_rc=$?",
+            store_lock.release_script(),
+            "[ $store_rc -eq 0 ] || exit $store_rc",
+            "sha=$(cat %s.sha) && rm -f %s.sha" % (self.worktree_lock.path, self.worktree_lock.path),
+            "git -C %s checkout --force --detach $sha || exit $?" % self.git_dir,
+            "job_output commit $sha",
+            "job_output worktree %s" % self.git_dir])
+        return "\n".join(lines)
+
+
+    def release(self):
+        """
+        Releases the worktree and working copy held by this task.  A per-task worktree is removed.
+        No-op without worktrees and workspace budget.
+        """
+        script = self.release_script()
+        if script is None:
+            return
+        session = OverthereHostSession(self.host, enable_logging=True)
+        with session:
+            mdl.println("Releasing '%s'" % self.git_dir)
+            with timed("git release"):
+                session.execute_script(script, "git_release.sh", show_script=False)
+
+
+    def release_script(self):
+        """
+        :return: shell script that releases the worktree and working copy held by this task, or None without
+                 worktrees and workspace budget
+        """
+        lines = []
+        if self.worktree_mode == WORKTREE_PER_TASK:
+            lines.extend([
+                "git --git-dir=%s worktree remove --force %s 2>/dev/null" % (self.store_dir, self.git_dir),
+                "rm -rf %s" % self.git_dir,
+                "git --git-dir=%s worktree prune" % self.store_dir])
+        if self.worktree_mode != WORKTREE_SHARED:
+            lines.append(self.worktree_lock.release_script())
+        if self.workspaces:
+            lines.append(self.workspaces.release_script(self.git_dir))
+        return "\n".join(lines) if lines else None
+
+
+    def checkout_cmd(self, branch):
+        return ["cd", self.git_dir, "&&", "git", "checkout", branch]
+
+
+    def pull_cmd(self):
+        return ["cd", self.git_dir, "&&", "git", "pull"]
+
+
+    def clone_cmd(self):
+        if self.mirror_dir:
+            return ["git", "clone", "--reference", self.mirror_dir, "--dissociate", self.clone_url, self.git_dir]
+        return ["git", "clone", self.clone_url, self.git_dir]
+
+
+    def clone_script(self):
+        """
+        :return: shell script that clones the repository.  With a mirror, the mirror is created or refreshed first.
+        """
+        if not self.mirror_dir:
+            return " ".join(self.clone_cmd())
+        return "\n".join([self.refresh_mirror_script(), " ".join(self.clone_cmd())])
+
+
+    def refresh_mirror_script(self):
+        """
+        :return: shell script that creates or fetches the bare mirror while holding the mirror's lock
+        """
+        lock = HostLock("%s.lock" % self.mirror_dir)
+        return "\n".join([
+            lock.acquire_script(),
+            "if [ -d %s ]; then" % self.mirror_dir,
+            "  git --git-dir=%s fetch --prune --quiet" % self.mirror_dir,
+            "else",
+            "  git clone --mirror --quiet %s %s" % (self.clone_url, self.mirror_dir),
+            "fi",
+            "mirror_rc=$?",
+            "git --git-dir=%s config uploadpack.allowFilter true" % self.mirror_dir,
+            "git --git-dir=%s config uploadpack.allowAnySHA1InWant true" % self.mirror_dir,
+            lock.release_script(),
+            "[ $mirror_rc -eq 0 ] || exit $mirror_rc"])
+
+
+    def fetch_repo_script(self):
+        """
+        :return: shell script that pulls when the repository is already cloned and clones it otherwise
+        """
+        if self.workspaces:
+            return "%s\n%s" % (self.workspaces.hold_script(self.git_dir), self._fetch_repo_script())
+        return self._fetch_repo_script()
+
+
+    def _fetch_repo_script(self):
+        return "if [ -d %s ]; then\n  %s\nelse\n%s\nfi" % (self.git_dir, " ".join(self.pull_cmd()), self.clone_script())
@@ -0,0 +1,66 @@
+#
+#
+# Copyright 2019 XEBIALABS
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+#
+# THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND, EITHER EXPRESSED OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS
+# FOR A PARTICULAR PURPOSE. THIS CODE AND INFORMATION ARE NOT SUPPORTED BY XEBIALABS.
+#
+
+"""
+    Locks shared by tasks running on the same fastlane host.  A lock is a directory created with mkdir,
+    so it can be acquired and released by separate commands and works on both macOS and Linux.
+"""
+import pipes
+
+
+class HostLock(object):
+    """Lock directory on the target host"""
+
+    def __init__(self, path, wait_secs=1800, stale_secs=7200):
+        """
+        :param path: absolute path of the lock directory on the host
+        :param wait_secs: maximum time to wait for the lock before failing
+        :param stale_secs: a lock older than this is considered abandoned and is broken
+        """
+        self.path = path
+        self.wait_secs = wait_secs
+        self.stale_secs = stale_secs
+
+    def acquire_script(self):
+        """
+        :return: shell script that blocks until the lock is acquired.  Exits with 1 on timeout.
+                 The lock is released when the shell is terminated, e.g. when the task is aborted, until release_script
+        """
+        lock = pipes.quote(self.path)
+        return "\n".join([
+            "mkdir -p $(dirname %s)" % lock,
+            "lock_waited=0",
+            "until mkdir %s 2>/dev/null; do" % lock,
+            "  if [ -n \"$(find %s -maxdepth 0 -mmin +%d 2>/dev/null)\" ]; then" % (lock, max(1, self.stale_secs / 60)),
+            "    echo \"Breaking stale lock %s\" >&2" % self.path,
+            "    rm -rf %s" % lock,
+            "    continue",
+            "  fi",
+            "  if [ $lock_waited -ge %d ]; then" % self.wait_secs,
+            "    echo \"Timed out waiting for lock %s\" >&2" % self.path,
+            "    exit 1",
+            "  fi",
+            "  sleep 1",
+            "  lock_waited=$((lock_waited + 1))",
+            "done",
+            "trap \"rm -rf %s; exit 143\" TERM INT HUP" % lock])
+
+    def release_script(self):
+        """
+        :return: shell command that releases the lock
+        """
+        return "rm -rf %s; trap - TERM INT HUP" % pipes.quote(self.path)
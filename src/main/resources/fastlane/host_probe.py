@@ -0,0 +1,174 @@
+#
+#
+# Copyright 2019 XEBIALABS
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+#
+# THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND, EITHER EXPRESSED OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS
+# FOR A PARTICULAR PURPOSE. THIS CODE AND INFORMATION ARE NOT SUPPORTED BY XEBIALABS.
+#
+
+"""
+    What a fastlane host can run: the fastlane, bundler, ruby, Xcode, Android build tools and Java versions,
+    plus its free disk and load when probed.  All values come from one command and are cached in the
+    XL Release JVM per host for a time to live, so most tasks do not probe at all.
+"""
+import pipes
+import threading
+import time
+
+from fastlane.overthere import OverthereHostSession
+from fastlane.markdown_logger import MarkdownLogger as mdl
+
+CAPABILITY_MARKER = "##xlr-fastlane-capability"
+
+CAPABILITY_SCRIPT = """FASTLANE_SKIP_UPDATE_CHECK=1
+export FASTLANE_SKIP_UPDATE_CHECK
+cap() {
+  echo "%(marker)s $1=$2"
+}
+cap fastlane "$(fastlane --version 2>/dev/null | grep -Eo 'fastlane [0-9][0-9.]*' | tail -1 | cut -d' ' -f2)"
+cap bundler "$(bundle --version 2>/dev/null | awk '{print $3}')"
+cap ruby "$(ruby -e 'print RUBY_VERSION' 2>/dev/null)"
+cap xcode "$(xcodebuild -version 2>/dev/null | awk 'NR==1 {v=$2} NR==2 {b=$3} END {if (v) print v " " b}')"
+android_sdk=${ANDROID_HOME:-$ANDROID_SDK_ROOT}
+cap android_build_tools "$(ls "$android_sdk/build-tools" 2>/dev/null | sort -t. -k1,1n -k2,2n -k3,3n | tail -1)"
+cap java "$(java -version 2>&1 | awk -F'"' 'NR==1 {print $2}')"
+cap os "$(uname -sr)"
+mkdir -p %(base_dir)s
+cap free_kb "$(df -Pk %(base_dir)s | awk 'NR==2 {print $4}')"
+load=$(sysctl -n vm.loadavg 2>/dev/null | awk '{print $2}')
+[ -n "$load" ] || load=$(awk '{print $1}' /proc/loadavg 2>/dev/null)
+cap load "$load"
+cap cpus "$(sysctl -n hw.ncpu 2>/dev/null || nproc 2>/dev/null || echo 1)"
+"""
+
+# tool versions that change what a lane builds, part of the lane result key
+KEY_TOOLS = ["fastlane", "bundler", "ruby", "xcode", "android_build_tools", "java"]
+TOOL_LABELS = [("fastlane", "fastlane"), ("bundler", "Bundler"), ("ruby", "Ruby"), ("xcode", "Xcode"),
+               ("android_build_tools", "Android Build Tools"), ("java", "Java"), ("os", "OS")]
+
+DEFAULT_TTL_SECS = 600
+
+
+def version_matches(version, required):
+    """
+    :return: True when the leading components of version are those of required, e.g. '15.2.1' matches '15.2'
+    """
+    if not version:
+        return False
+    return version.split(".")[:len(required.split("."))] == required.split(".")
+
+
+class HostCapabilities(object):
+    """Result of the capability probe of a host"""
+
+    def __init__(self, values, probed_at=None):
+        """
+        :param values: dict of name to value as printed by the probe.  Missing tools have empty values
+        :param probed_at: time of the probe in seconds
+        """
+        self.values = values
+        self.probed_at = probed_at if probed_at is not None else time.time()
+
+    def version(self, tool):
+        """
+        :return: version of the tool, None when it is not installed.  The Xcode build number is left out
+        """
+        value = self.values.get(tool)
+        return value.split()[0] if value else None
+
+    def free_mb(self):
+        value = self.values.get("free_kb")
+        return int(value) / 1024 if value and value.isdigit() else None
+
+    def key_facts(self):
+        """
+        :return: Array of 'tool=version' of the tools that change what a lane builds
+        """
+        return ["%s=%s" % (tool, self.values.get(tool) or "") for tool in KEY_TOOLS]
+
+    def unmet(self, xcode_version=None):
+        """
+        :param xcode_version: required Xcode version, e.g. '15.2'.  None when any Xcode will do
+        :return: Array of reasons the host cannot run the lane, empty when it can
+        """
+        problems = []
+        if not self.version("fastlane"):
+            problems.append("fastlane is not installed or not on the PATH")
+        if xcode_version and not version_matches(self.version("xcode"), xcode_version):
+            problems.append("Xcode %s is required, the host has %s" % (xcode_version, self.version("xcode") or "no Xcode"))
+        return problems
+
+    def print_table(self):
+        rows = [[label, self.values.get(name) or "-"] for name, label in TOOL_LABELS]
+        rows.append(["Free Disk (MB)", str(self.free_mb()) if self.free_mb() is not None else "-"])
+        rows.append(["Load / CPUs", "%s / %s" % (self.values.get("load") or "-", self.values.get("cpus") or "-")])
+        mdl.print_table(["Host Capability", "Value (probed %d s ago)" % (time.time() - self.probed_at)], rows)
+
+
+class HostProbe(object):
+    """Capability probes of the hosts, cached in the JVM.  Shared by all tasks."""
+
+    _cache = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def script(base_dir):
+        """
+        :param base_dir: working directory on the host, used to check free disk
+        :return: shell script printing the capabilities.  Can be appended to other probes
+        """
+        return CAPABILITY_SCRIPT % {"marker": CAPABILITY_MARKER, "base_dir": pipes.quote(base_dir)}
+
+    @staticmethod
+    def parse(lines):
+        """
+        :return: HostCapabilities, None when the lines have no capabilities
+        """
+        values = {}
+        for line in lines:
+            if line.startswith(CAPABILITY_MARKER + " ") and "=" in line:
+                name, value = line[len(CAPABILITY_MARKER) + 1:].split("=", 1)
+                values[name] = value.strip()
+        return HostCapabilities(values) if values else None
+
+    @staticmethod
+    def cached(host, ttl_secs=DEFAULT_TTL_SECS):
+        """
+        :return: HostCapabilities probed less than ttl_secs ago, None otherwise
+        """
+        with HostProbe._lock:
+            capabilities = HostProbe._cache.get(host.pool_key())
+        if capabilities is None or time.time() - capabilities.probed_at >= ttl_secs:
+            return None
+        return capabilities
+
+    @staticmethod
+    def store(host, capabilities):
+        with HostProbe._lock:
+            HostProbe._cache[host.pool_key()] = capabilities
+
+    @staticmethod
+    def capabilities(host, base_dir, ttl_secs=DEFAULT_TTL_SECS):
+        """
+        :return: HostCapabilities of the host, probed when the cached ones are older than ttl_secs
+        """
+        capabilities = HostProbe.cached(host, ttl_secs)
+        if capabilities is not None:
+            return capabilities
+        session = OverthereHostSession(host, enable_logging=False, capped=False)
+        with session:
+            response = session.execute_script(HostProbe.script(base_dir), "capabilities.sh", show_script=False)
+        capabilities = HostProbe.parse(response.stdout)
+        if capabilities is None:
+            raise Exception("Unexpected capability probe output: %s" % "\n".join(response.stdout))
+        HostProbe.store(host, capabilities)
+        return capabilities
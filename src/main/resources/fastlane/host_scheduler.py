@@ -0,0 +1,252 @@
+#
+#
+# Copyright 2019 XEBIALABS
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+#
+# THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND, EITHER EXPRESSED OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS
+# FOR A PARTICULAR PURPOSE. THIS CODE AND INFORMATION ARE NOT SUPPORTED BY XEBIALABS.
+#
+
+"""
+    Chooses the fastlane host a lane runs on from a pool of hosts, based on load, free disk, warm caches
+    and the tools installed on each host.
+"""
+import pipes
+import threading
+import time
+
+from fastlane.host_probe import DEFAULT_TTL_SECS, HostProbe
+from fastlane.overthere import OverthereHostSession
+from fastlane.running_lanes import count_script
+from fastlane.markdown_logger import MarkdownLogger as mdl
+
+PROBE_MARKER = "##xlr-fastlane-probe"
+
+PROBE_SCRIPT = """#!/bin/sh
+%(count_running)s
+load=$(sysctl -n vm.loadavg 2>/dev/null | awk '{print $2}')
+[ -n "$load" ] || load=$(awk '{print $1}' /proc/loadavg 2>/dev/null)
+cpus=$(sysctl -n hw.ncpu 2>/dev/null || nproc 2>/dev/null || echo 1)
+mkdir -p %(base_dir)s
+free_kb=$(df -Pk %(base_dir)s | awk 'NR==2 {print $4}')
+warm=0
+for d in %(warm_dirs)s; do
+  [ -e "$d" ] && warm=$((warm + 1))
+done
+echo "%(marker)s running=$running load=${load:-0} cpus=$cpus free_kb=${free_kb:-0} warm=$warm"
+"""
+
+
+class HostLoad(object):
+    """Result of probing a host"""
+
+    def __init__(self, values, capabilities=None):
+        self.capabilities = capabilities
+        """HostCapabilities of the host, possibly from an earlier probe"""
+        self.running = int(values.get("running", 0))
+        self.load = float(values.get("load", 0))
+        self.cpus = max(1, int(values.get("cpus", 1)))
+        self.free_mb = int(values.get("free_kb", 0)) / 1024
+        self.warm = int(values.get("warm", 0))
+        """number of the repository's checkout, worktree store and mirror present on the host"""
+
+    def score(self, in_flight):
+        """
+        :param in_flight: lanes started on the host by this server that may not show up as running yet
+        :return: lower is better
+        """
+        return max(self.running, in_flight) * 10 + (self.load / self.cpus) * 5 - self.warm * 3
+
+
+class LaneSlots(object):
+    """Number of lanes each host runs for tasks of this XL Release server.  Shared by all tasks in the JVM."""
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._in_use = {}
+
+    @staticmethod
+    def shared():
+        with LaneSlots._shared_lock:
+            if LaneSlots._shared is None:
+                LaneSlots._shared = LaneSlots()
+            return LaneSlots._shared
+
+    def in_use(self, key):
+        with self._cond:
+            return self._in_use.get(key, 0)
+
+    def try_acquire(self, key, limit):
+        with self._cond:
+            if limit and self._in_use.get(key, 0) >= limit:
+                return False
+            self._in_use[key] = self._in_use.get(key, 0) + 1
+            return True
+
+    def release(self, key):
+        with self._cond:
+            self._in_use[key] = max(0, self._in_use.get(key, 0) - 1)
+            self._cond.notifyAll()
+
+    def wait(self, timeout):
+        with self._cond:
+            self._cond.wait(timeout)
+
+
+class HostSlot(object):
+    """A host chosen by the HostScheduler.  Release it when the lane is done."""
+
+    def __init__(self, name, host, slots):
+        self.name = name
+        self.host = host
+        self._slots = slots
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._slots.release(self.host.pool_key())
+
+
+class HostScheduler(object):
+
+    def __init__(self, candidates, max_lanes_per_host=2, min_free_mb=0, requeue_secs=30, wait_secs=4 * 3600,
+                 probe_ttl_secs=DEFAULT_TTL_SECS, xcode_version=None, max_unreachable_rounds=3):
+        """
+        :param candidates: Array of (name, OverthereHost)
+        :param max_lanes_per_host: lanes a host runs at the same time.  0 for no limit.  Never more than the host's
+                                   Max Connections, since each running lane holds one of its connections
+        :param min_free_mb: hosts with less free disk in the working directory are not used
+        :param probe_ttl_secs: tool versions of a host are probed again once older than this
+        :param xcode_version: hosts without this Xcode version, e.g. '15.2', are not used.  None for any
+        :param requeue_secs: interval at which waiting tasks re-probe the hosts
+        :param wait_secs: maximum time a task waits for a host
+        :param max_unreachable_rounds: consecutive probe rounds in which no host could be probed before giving up
+        """
+        self.candidates = candidates
+        self.max_lanes_per_host = max_lanes_per_host
+        self.min_free_mb = min_free_mb
+        self.requeue_secs = requeue_secs
+        self.wait_secs = wait_secs
+        self.probe_ttl_secs = probe_ttl_secs
+        self.xcode_version = xcode_version
+        self.max_unreachable_rounds = max_unreachable_rounds
+        self._slots = LaneSlots.shared()
+
+    def acquire(self, base_dir, warm_dirs):
+        """
+        Waits for and reserves the best host
+        :param base_dir: working directory on the hosts, used to check free disk
+        :param warm_dirs: directories that indicate the host has a warm checkout or mirror of the repository
+        :return: HostSlot
+        """
+        deadline = time.time() + self.wait_secs
+        unreachable_rounds = 0
+        while True:
+            loads = self.probe_all(base_dir, warm_dirs)
+            # only wait for hosts that are reachable but busy
+            unreachable_rounds = unreachable_rounds + 1 if not loads else 0
+            if unreachable_rounds >= self.max_unreachable_rounds:
+                raise Exception("No fastlane host could be reached in %d attempts" % unreachable_rounds)
+            ranked = []
+            for name, host in self.candidates:
+                load = loads.get(name)
+                if load is None or load.free_mb < self.min_free_mb:
+                    continue
+                if load.capabilities is not None and load.capabilities.unmet(self.xcode_version):
+                    continue
+                in_flight = self._slots.in_use(host.pool_key())
+                if max(load.running, in_flight) >= self.lane_limit(host):
+                    continue
+                ranked.append((load.score(in_flight), name, host))
+            ranked.sort(key=lambda r: r[0])
+            for score, name, host in ranked:
+                if self._slots.try_acquire(host.pool_key(), self.lane_limit(host)):
+                    mdl.println("Selected host %s" % name)
+                    return HostSlot(name, host, self._slots)
+
+            if time.time() >= deadline:
+                raise Exception("No fastlane host available after waiting %d seconds" % self.wait_secs)
+            if loads and not [name for name, load in loads.items()
+                    if load.capabilities is None or not load.capabilities.unmet(self.xcode_version)]:
+                raise Exception("No fastlane host can run the lane: %s" % "; ".join(
+                    "%s: %s" % (name, ", ".join(load.capabilities.unmet(self.xcode_version)))
+                    for name, load in sorted(loads.items())))
+            mdl.println("No host could be reached. Probing again" if not loads else "All hosts are busy. Waiting for a free host")
+            mdl.flush()
+            self._slots.wait(self.requeue_secs)
+
+    def lane_limit(self, host):
+        """
+        :return: number of lanes the host runs at the same time
+        """
+        if self.max_lanes_per_host:
+            return min(self.max_lanes_per_host, host.max_connections)
+        return host.max_connections
+
+    def probe_all(self, base_dir, warm_dirs):
+        """
+        Probes all candidates in parallel and prints their load.
+        :return: dict of host name to HostLoad.  Hosts that could not be probed are left out
+        """
+        loads = {}
+        threads = [threading.Thread(target=self._probe_into, args=(loads, name, host, base_dir, warm_dirs))
+                   for name, host in self.candidates]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        rows = []
+        for name, host in self.candidates:
+            load = loads.get(name)
+            if load is None:
+                rows.append([name, "unreachable", "", "", "", "", "", ""])
+            else:
+                capabilities = load.capabilities
+                rows.append([name, str(load.running), str(self._slots.in_use(host.pool_key())),
+                             "%.2f / %d" % (load.load, load.cpus), str(load.free_mb), str(load.warm),
+                             capabilities and capabilities.version("fastlane") or "-",
+                             capabilities and capabilities.version("xcode") or "-"])
+        mdl.print_table(["Host", "Running Lanes", "Started Here", "Load / CPUs", "Free MB", "Warm Caches", "fastlane",
+                         "Xcode"], rows)
+        return loads
+
+    def _probe_into(self, loads, name, host, base_dir, warm_dirs):
+        try:
+            loads[name] = HostScheduler.probe(host, base_dir, warm_dirs, self.probe_ttl_secs)
+        except Exception, e:
+            mdl.println("Could not probe host %s: %s" % (name, e))
+
+    @staticmethod
+    def probe(host, base_dir, warm_dirs, ttl_secs=DEFAULT_TTL_SECS):
+        """
+        Probes the load of the host, and its capabilities in the same command when the cached ones are too old.
+        :return: HostLoad of the host
+        """
+        script = PROBE_SCRIPT % {"base_dir": pipes.quote(base_dir), "count_running": count_script(base_dir),
+                                 "warm_dirs": " ".join(pipes.quote(d) for d in warm_dirs if d), "marker": PROBE_MARKER}
+        capabilities = HostProbe.cached(host, ttl_secs)
+        if capabilities is None:
+            script += HostProbe.script(base_dir)
+        session = OverthereHostSession(host, enable_logging=False, capped=False)
+        with session:
+            response = session.execute_script(script, "probe.sh", show_script=False)
+        if capabilities is None:
+            capabilities = HostProbe.parse(response.stdout)
+            if capabilities is not None:
+                HostProbe.store(host, capabilities)
+        for line in response.stdout:
+            if line.startswith(PROBE_MARKER):
+                return HostLoad(dict(kv.split("=", 1) for kv in line.split()[1:]), capabilities)
+        raise Exception("Unexpected probe output: %s" % "\n".join(response.stdout))
@@ -0,0 +1,142 @@
+#
+#
+# Copyright 2019 XEBIALABS
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+#
+# THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND, EITHER EXPRESSED OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS
+# FOR A PARTICULAR PURPOSE. THIS CODE AND INFORMATION ARE NOT SUPPORTED BY XEBIALABS.
+#
+
+"""
+    Renders several shell commands into a single script that runs on the target host in one round trip.
+"""
+from fastlane.overthere import OverthereHostSession
+from fastlane.markdown_logger import MarkdownLogger as mdl
+
+STEP_MARKER = "##xlr-fastlane-step"
+OUTPUT_MARKER = "##xlr-fastlane-output"
+
+SCRIPT_HEADER = """#!/bin/sh
+now_ms() {
+  perl -MTime::HiRes=time -e 'printf("%d\\n", time() * 1000)' 2>/dev/null || echo "$(date +%s)000"
+}
+
+# step results and outputs are printed on exit so they are part of the retained output tail
+step_results=""
+job_outputs="$0.outputs"
+: > "$job_outputs"
+trap 'cat "$job_outputs" 2>/dev/null; printf "%s" "$step_results"' EXIT
+
+# records a named value, e.g. 'job_output commit <sha>'.  Available in CommandResponse.outputs
+job_output() {
+  echo "OUTPUT_MARKER $1 $2" >> "$job_outputs"
+}
+
+run_step() {
+  step_start=$(now_ms)
+  ( "$2" )
+  step_rc=$?
+  step_results="${step_results}MARKER $1 $step_rc $(( $(now_ms) - step_start ))
+"
+  return $step_rc
+}
+""".replace("OUTPUT_MARKER", OUTPUT_MARKER).replace("MARKER", STEP_MARKER)
+
+
+class JobStepResult(object):
+    """Outcome of one step of a job script"""
+
+    def __init__(self, name, rc, duration_ms):
+        self.name = name
+        self.rc = rc
+        self.duration_ms = duration_ms
+
+    def __getitem__(self, name):
+        return self.__getattribute__(name)
+
+
+class JobScript(object):
+    """Shell script made of named steps.  Execution stops at the first step that fails."""
+
+    def __init__(self, filename="xlr_fastlane_job.sh"):
+        """
+        :param filename: name of the script in the session's working directory
+        """
+        self.filename = filename
+        self._steps = []
+
+    def add_step(self, name, script):
+        """
+        :param name: step name reported in the results.  Must not contain spaces.
+        :param script: shell commands of the step.  Either a String or a command line as an Array of Strings
+        """
+        if not isinstance(script, basestring):
+            script = " ".join(script)
+        self._steps.append((name, script))
+
+    def render(self):
+        """
+        :return: the script content
+        """
+        lines = [SCRIPT_HEADER]
+        for i, (name, script) in enumerate(self._steps):
+            lines.append("step_%d() {\n%s\n}\n" % (i, script))
+        for i, (name, script) in enumerate(self._steps):
+            lines.append("run_step %s step_%d || exit $?" % (name, i))
+        lines.append("")
+        return "\n".join(lines)
+
+    def run(self, host, stream_command_output=False, show_steps=True, listeners=(), timeout_secs=None):
+        """
+        Uploads the script to the host and executes it in a single command.
+        :param host: OverthereHost
+        :param stream_command_output: True to stream the output of the steps to the task log
+        :param show_steps: True to log the steps and their results
+        :param listeners: output handlers that receive every stdout line while the script runs
+        :param timeout_secs: the script and its processes are killed when it runs longer than this.  None for no limit
+        :return: CommandResponse with the results of the executed steps
+        """
+        session = OverthereHostSession(host, enable_logging=True, stream_command_output=stream_command_output)
+        with session:
+            if show_steps:
+                mdl.println("Running steps %s" % ", ".join(name for name, _ in self._steps))
+            response = JobScript.parse(session.execute_script(self.render(), self.filename, check_success=False, show_script=False,
+                                                              listeners=listeners, timeout_secs=timeout_secs))
+            if show_steps:
+                JobScript.print_steps(response)
+            if response.rc != 0:
+                session.report_failure(response)
+            return response
+
+    @staticmethod
+    def parse(response):
+        """
+        Moves the step and output markers from the output of the script into the response's steps and outputs.
+        :param response: CommandResponse of the script
+        :return: the response
+        """
+        stdout = []
+        for line in response.stdout:
+            if line.startswith(STEP_MARKER):
+                _, name, rc, duration_ms = line.split()
+                response.steps.append(JobStepResult(name, int(rc), int(duration_ms)))
+            elif line.startswith(OUTPUT_MARKER):
+                parts = line.split(" ", 2)
+                response.outputs[parts[1]] = parts[2] if len(parts) > 2 else ""
+            else:
+                stdout.append(line)
+        response.stdout = stdout
+        return response
+
+    @staticmethod
+    def print_steps(response):
+        rows = [[s.name, str(s.rc), "%.1f s" % (s.duration_ms / 1000.0)] for s in response.steps]
+        mdl.print_table(["Step", "Exit Code", "Duration"], rows)
@@ -15,12 +15,126 @@
 # FOR A PARTICULAR PURPOSE. THIS CODE AND INFORMATION ARE NOT SUPPORTED BY XEBIALABS.
 #
 
+import os
+import re
+import sys
+
+from fastlane.artifacts import ArtifactCollector
+from fastlane.artifact_store import ArtifactStore
 from fastlane.git_client import GitClient
 from fastlane.fastlane_client import FastlaneClient
+from fastlane.fastlane_host import FastlaneHost
+from fastlane.host_probe import DEFAULT_TTL_SECS, HostProbe
+from fastlane.host_scheduler import HostScheduler
+from fastlane.job_script import JobScript
+from fastlane.lane_memo import LaneResult
+from fastlane.lane_report import ActionHistory
+from fastlane.markdown_logger import MarkdownLogger as mdl
+from fastlane.phase_timer import PhaseTimer, timed
+from fastlane.step_tracker import StepTracker
+
+
+# job script steps reported under the phase names of the step by step run
+JOB_STEP_PHASES = {"sync": "git sync", "fetch": "git fetch", "checkout": "git checkout", "fastfile": "fastfile check"}
 
 
 def process(task_vars):
-    git = GitClient.new_instance(task_vars)
+    # a caller that started a timer, e.g. a benchmark, collects the phases of this task in it
+    timer = PhaseTimer.current()
+    own_timer = timer is None
+    if own_timer:
+        timer = PhaseTimer.start()
+    try:
+        with timed("select host"):
+            host, slot = select_host(task_vars)
+        git = GitClient.new_instance(task_vars, host=host)
+
+        try:
+            capabilities = preflight(task_vars, host, git)
+            if task_vars["singleRoundTrip"]:
+                process_as_job_script(task_vars, host, git, capabilities)
+                return
+
+            prepare_repo(task_vars, git)
+
+            fastlane = FastlaneClient.new_instance(git.git_dir, task_vars, host=host, capabilities=capabilities,
+                                                   base_dir=git.repo_base_dir)
+            result = find_result(task_vars, fastlane)
+            if result is not None and result.hit():
+                return
+            fastlane.run_lane(task_vars["lane"], task_vars["options"], result=result)
+            report_actions(task_vars, git, fastlane)
+            collect_artifacts(task_vars, host, git)
+        finally:
+            try:
+                git.release()
+            finally:
+                if slot is not None:
+                    slot.release()
+    finally:
+        report_timings(task_vars, timer)
+        if own_timer:
+            PhaseTimer.stop()
+
+
+def report_timings(task_vars, timer):
+    """
+    Prints the phase durations and sets the duration outputs.
+    """
+    durations = timer.durations_ms()
+    mdl.println("Task duration by phase")
+    timer.print_summary()
+    task_vars["phaseDurations"] = dict((name, str(ms)) for name, ms in durations.items())
+    task_vars["totalDurationMs"] = int(timer.total_ms())
+    task_vars["gitDurationMs"] = int(sum(ms for name, ms in durations.items() if name.startswith("git ")))
+    task_vars["laneDurationMs"] = int(durations.get("lane", 0))
+
+
+def select_host(task_vars):
+    """
+    Chooses the host from the host pool when one is configured, otherwise uses the Fastlane Host.
+    :return: (OverthereHost, HostSlot).  The slot is None without a host pool and must be released otherwise
+    """
+    if not task_vars["clientHosts"]:
+        task_vars["selectedHost"] = FastlaneHost.name(task_vars["clientHost"])
+        return FastlaneHost.new_host(task_vars["clientHost"]), None
+
+    candidates = [(FastlaneHost.name(ci), FastlaneHost.new_host(ci)) for ci in task_vars["clientHosts"]]
+    paths = GitClient.new_instance(task_vars, host=candidates[0][1])
+    scheduler = HostScheduler(candidates, max_lanes_per_host=task_vars["maxLanesPerHost"] or 0,
+                              min_free_mb=task_vars["minFreeDiskMb"] or 0, probe_ttl_secs=probe_ttl_secs(task_vars),
+                              xcode_version=task_vars["xcodeVersion"])
+    slot = scheduler.acquire(paths.repo_base_dir, paths.cache_dirs())
+    task_vars["selectedHost"] = slot.name
+    return slot.host, slot
+
+
+def probe_ttl_secs(task_vars):
+    ttl = task_vars["hostProbeTtlSecs"]
+    return DEFAULT_TTL_SECS if ttl is None else ttl
+
+
+def preflight(task_vars, host, git):
+    """
+    Checks the host has the tools the lane needs before anything runs on it, and sets the Host Capabilities output.
+    The capabilities come from the host pool probe or an earlier task when they are recent enough.
+    :return: HostCapabilities
+    """
+    with timed("preflight"):
+        capabilities = HostProbe.capabilities(host, git.repo_base_dir, probe_ttl_secs(task_vars))
+    capabilities.print_table()
+    task_vars["hostCapabilities"] = dict(capabilities.values)
+    problems = capabilities.unmet(task_vars["xcodeVersion"])
+    if problems:
+        raise Exception("Host %s cannot run the lane: %s" % (task_vars["selectedHost"], "; ".join(problems)))
+    return capabilities
+
+
+def prepare_repo(task_vars, git):
+    if task_vars["gitCloneUrl"] and task_vars["gitBranch"]:
+        task_vars["gitCommitSha"] = git.sync_to_ref(task_vars["gitBranch"], depth=task_vars["gitFetchDepth"],
+                                                    partial=task_vars["gitPartialClone"])
+        return
 
     if task_vars["gitCloneUrl"]:
         git.fetch_repo()
@@ -28,9 +142,121 @@ def process(task_vars):
     if task_vars["gitBranch"]:
         git.checkout(task_vars["gitBranch"])
 
-    fastlane = FastlaneClient.new_instance(git.git_dir, task_vars)
-    fastlane.run_lane(task_vars["lane"], task_vars["options"])
+
+def report_actions(task_vars, git, fastlane):
+    """
+    Prints the action durations of the lane, flags slow actions and sets the action outputs.
+    The lane has passed at this point, so a failing report is logged instead of failing the task.
+    """
+    runs = task_vars["actionHistoryRuns"]
+    if not runs:
+        return
+    lane_name = re.sub(r'[^A-Za-z0-9._-]', '_', task_vars["lane"])
+    history = ActionHistory("%s/.xlr-fastlane/timings/%s/%s.tsv" % (git.repo_base_dir, git.repo_name or "local", lane_name),
+                            max_runs=runs)
+    try:
+        with timed("action report"):
+            durations, slow = fastlane.report_actions(history, slow_factor=(task_vars["slowActionPercent"] or 150) / 100.0)
+    except:
+        mdl.println("Warning: could not report the action durations of the lane: %s" % sys.exc_info()[1])
+        return
+    task_vars["actionDurations"] = dict((name, "%.3f" % secs) for name, secs in durations)
+    task_vars["slowActions"] = [a.name for a in slow]
+
+
+def collect_artifacts(task_vars, host, git):
+    """
+    Copies the files matching Collect Artifacts from the working copy to the Artifacts Dir of the server,
+    or into the Artifact Store Dir when one is set.
+    """
+    if not task_vars["collectArtifacts"]:
+        return
+    collector = ArtifactCollector(host, git.git_dir, streams=task_vars["artifactStreams"] or 1)
+    if task_vars["artifactStoreDir"]:
+        store = ArtifactStore(task_vars["artifactStoreDir"], keep_runs=task_vars["artifactStoreKeepRuns"] or 50)
+        with timed("artifacts"):
+            run = store.collect(collector, task_vars["collectArtifacts"])
+            if run.manifest is None:
+                return
+            task_vars["artifactManifest"] = run.manifest
+            if task_vars["artifactsDir"]:
+                task_vars["collectedArtifacts"] = store.checkout(run.manifest, task_vars["artifactsDir"])
+            else:
+                task_vars["collectedArtifacts"] = [store.blob_path(f.sha) for f in run.files]
+        with timed("artifact gc"):
+            store.gc()
+        return
+    if not task_vars["artifactsDir"]:
+        return
+    with timed("artifacts"):
+        transfer = collector.collect(task_vars["collectArtifacts"], task_vars["artifactsDir"])
+    task_vars["collectedArtifacts"] = [os.path.join(task_vars["artifactsDir"], p) for p in transfer.paths]
+
+
+def find_result(task_vars, fastlane):
+    """
+    Looks up a cached result of the lane for the checked out commit and sets the result outputs.
+    :return: LaneResult, None when results are not cached.  A hit is ignored when a rebuild is forced
+    """
+    result = fastlane.find_result(task_vars["lane"], task_vars["options"])
+    if result is None:
+        return None
+    task_vars["resultCacheKey"] = result.key
+    if result.hit() and task_vars["forceRebuild"]:
+        mdl.println("Ignoring the cached result of commit %s, rebuild forced" % result.commit)
+        result.manifest = None
+    if result.hit():
+        print_cached_result(task_vars, result.manifest, result.artifacts())
+    return result
+
+
+def print_cached_result(task_vars, manifest, artifacts):
+    mdl.println("Lane '%s' already succeeded for commit %s. Skipping the lane" % (task_vars["lane"], manifest.get("commit")))
+    rows = [[name, manifest[name]] for name in ["key", "commit", "finished", "log"] if name in manifest]
+    rows.extend([["artifact", path] for path in artifacts])
+    mdl.print_table(["Result", "Value"], rows)
+    task_vars["resultCached"] = True
+    task_vars["artifactPaths"] = artifacts
+
+
+def process_as_job_script(task_vars, host, git, capabilities=None):
+    job = JobScript()
+    if task_vars["gitCloneUrl"] and task_vars["gitBranch"]:
+        job.add_step("sync", git.sync_script(task_vars["gitBranch"], depth=task_vars["gitFetchDepth"],
+                                             partial=task_vars["gitPartialClone"]))
+    elif task_vars["gitCloneUrl"]:
+        job.add_step("fetch", git.fetch_repo_script())
+    elif task_vars["gitBranch"]:
+        job.add_step("checkout", git.checkout_cmd(task_vars["gitBranch"]))
+    fastlane = FastlaneClient.new_instance(git.git_dir, task_vars, host=host, capabilities=capabilities,
+                                           base_dir=git.repo_base_dir)
+    job.add_step("fastfile", fastlane.fastfile_check_script())
+    job.add_step("lane", fastlane.memoized_lane_script(task_vars["lane"], task_vars["options"], force=task_vars["forceRebuild"]))
+    tracker = StepTracker()
+    try:
+        response = job.run(host, listeners=[tracker], timeout_secs=fastlane.timeout_secs)
+    except:
+        tracker.finish(rc=1)
+        raise
+    tracker.finish()
+    timer = PhaseTimer.current()
+    if timer is not None:
+        for step in response.steps:
+            timer.record(JOB_STEP_PHASES.get(step.name, step.name), step.duration_ms * 1000000)
+    if "commit" in response.outputs:
+        task_vars["gitCommitSha"] = response.outputs["commit"]
+    if "memo_key" in response.outputs:
+        task_vars["resultCacheKey"] = response.outputs["memo_key"]
+    manifest = dict((name[5:], value) for name, value in response.outputs.items() if name.startswith("memo."))
+    if manifest:
+        print_cached_result(task_vars, manifest, LaneResult("", "", manifest).artifacts())
+    else:
+        report_actions(task_vars, git, fastlane)
+        collect_artifacts(task_vars, host, git)
 
 
 if __name__ == '__main__' or __name__ == '__builtin__':
-    process(locals())
+    try:
+        process(locals())
+    finally:
+        mdl.flush()
@@ -0,0 +1,148 @@
+#
+#
+# Copyright 2019 XEBIALABS
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+#
+# THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND, EITHER EXPRESSED OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS
+# FOR A PARTICULAR PURPOSE. THIS CODE AND INFORMATION ARE NOT SUPPORTED BY XEBIALABS.
+#
+
+"""
+    Lane runs that are detached from the task.  The lane runs in the background on the host and writes its output
+    to a log file in the job directory, which is read incrementally by polling.
+"""
+import pipes
+
+from fastlane.overthere import OverthereHostSession
+
+POLL_MARKER = "##xlr-fastlane-poll"
+
+RUN_SCRIPT = """#!/bin/sh
+( %(lane_cmd)s ) > %(job_dir)s/lane.log 2>&1
+lane_rc=$?
+( %(cleanup_script)s ) >> %(job_dir)s/lane.log 2>&1
+echo $lane_rc > %(job_dir)s/rc
+"""
+
+START_SCRIPT = """#!/bin/sh
+cd %(job_dir)s || exit 1
+nohup sh run.sh < /dev/null > /dev/null 2>&1 &
+echo $! > pid
+cat pid
+"""
+
+POLL_SCRIPT = """#!/bin/sh
+cd %(job_dir)s || exit 1
+offset=$1
+max_bytes=$2
+if [ -f rc ]; then
+  state="done $(cat rc)"
+elif kill -0 "$(cat pid)" 2>/dev/null; then
+  state=running
+else
+  state=lost
+fi
+size=$(( $(wc -c < lane.log 2>/dev/null || echo 0) ))
+end=$size
+if [ $(( end - offset )) -gt $max_bytes ]; then
+  end=$(( offset + max_bytes ))
+fi
+chunk() {
+  tail -c +$(( offset + 1 )) lane.log | head -c $(( end - offset ))
+}
+# while the log grows, only whole lines are read, so lines and multibyte characters are not split across polls
+if [ $end -gt $offset ] && { [ "$state" = running ] || [ $end -lt $size ]; } && [ "$(chunk | tail -c 1 | od -An -c | tr -d ' ')" != '\n' ]; then
+  partial=$(( $(chunk | tail -n 1 | wc -c) ))
+  # a line longer than max_bytes is read in pieces
+  [ $partial -lt $(( end - offset )) ] || [ $(( end - offset )) -lt $max_bytes ] || partial=0
+  end=$(( end - partial ))
+fi
+# report the exit code only once the whole log has been read
+[ $end -lt $size ] && state=running
+echo "%(marker)s $end $state"
+if [ $end -gt $offset ]; then
+  chunk
+fi
+"""
+
+
+class LanePollResult(object):
+    """Outcome of polling a detached lane"""
+
+    def __init__(self, offset, state, rc, lines):
+        """
+        :param offset: log offset to use for the next poll
+        :param state: 'running', 'done' or 'lost' when the process disappeared without an exit code
+        :param rc: exit code of the lane when done, otherwise None
+        :param lines: log lines written since the previous poll
+        """
+        self.offset = offset
+        self.state = state
+        self.rc = rc
+        self.lines = lines
+
+    def running(self):
+        return self.state == "running"
+
+    def __getitem__(self, name):
+        return self.__getattribute__(name)
+
+
+class LaneJob(object):
+    """A lane running detached on the host.  All files of the job are kept in job_dir."""
+
+    def __init__(self, host, job_dir):
+        """
+        :param host: OverthereHost
+        :param job_dir: absolute path of the job directory on the host
+        """
+        self.host = host
+        self.job_dir = job_dir
+        self.log_file = "%s/lane.log" % job_dir
+        self.pid_file = "%s/pid" % job_dir
+
+    def _script_vars(self):
+        return {"job_dir": pipes.quote(self.job_dir), "marker": POLL_MARKER}
+
+    def start(self, lane_cmd, cleanup_script=None):
+        """
+        Starts the lane in the background and returns immediately.
+        :param lane_cmd: lane shell script, or command line as an Array of Strings
+        :param cleanup_script: shell script run after the lane exits, before the exit code is recorded.
+                               The lane's exit code is in $lane_rc
+        :return: pid of the background process
+        """
+        script_vars = self._script_vars()
+        script_vars["lane_cmd"] = lane_cmd if isinstance(lane_cmd, basestring) else " ".join(lane_cmd)
+        script_vars["cleanup_script"] = cleanup_script or ":"
+        session = OverthereHostSession(self.host, enable_logging=True)
+        with session:
+            for name, template in [("run.sh", RUN_SCRIPT), ("start.sh", START_SCRIPT), ("poll.sh", POLL_SCRIPT)]:
+                session.copy_text_to_file(template % script_vars, session.remote_file("%s/%s" % (self.job_dir, name)))
+            response = session.execute(["sh", "%s/start.sh" % self.job_dir])
+            return response.stdout[0].strip()
+
+    def poll(self, offset, max_bytes=262144):
+        """
+        Reads the log written since offset and checks whether the lane is still running.
+        :param offset: number of log bytes already read
+        :param max_bytes: maximum number of log bytes to read
+        :return: LanePollResult
+        """
+        session = OverthereHostSession(self.host, enable_logging=False, capture_max_lines=None)
+        with session:
+            response = session.execute(["sh", "%s/poll.sh" % self.job_dir, str(offset), str(max_bytes)])
+        status = response.stdout[0].split()
+        if status[0] != POLL_MARKER:
+            raise Exception("Unexpected poll output for job '%s': %s" % (self.job_dir, response.stdout[0]))
+        state = status[2]
+        rc = int(status[3]) if state == "done" else None
+        return LanePollResult(int(status[1]), state, rc, response.stdout[1:])
@@ -0,0 +1,238 @@
+#
+#
+# Copyright 2019 XEBIALABS
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+#
+# THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND, EITHER EXPRESSED OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS
+# FOR A PARTICULAR PURPOSE. THIS CODE AND INFORMATION ARE NOT SUPPORTED BY XEBIALABS.
+#
+
+"""
+    Results of successful lane runs kept on the fastlane host, keyed by the commit, lane, options and
+    optionally environment variables and tool versions.  A lane whose key has a result is not run again.
+
+    Each result is a directory '<memo dir>/<key>' with a 'manifest' of 'name=value' lines, the lane log
+    and copies of the lane's artifacts.
+"""
+import pipes
+import re
+import uuid
+
+from fastlane.overthere import OverthereHostSession
+
+MEMO_MARKER = "##xlr-fastlane-memo"
+ENV_NAME_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+KEY_SCRIPT = """if command -v shasum >/dev/null 2>&1; then
+  sha() { shasum -a 256; }
+else
+  sha() { sha256sum; }
+fi
+cd %(git_dir)s || exit 1
+memo_dir=%(memo_dir)s
+memo_commit=$(git rev-parse HEAD 2>/dev/null)
+memo_key=""
+if [ -n "$memo_commit" ]; then
+  memo_key=$( {
+    echo %(descriptor)s
+    echo "$memo_commit"
+%(key_material)s
+  } | sha | cut -c1-32)
+fi
+"""
+
+RECORD_SCRIPT = """if [ -n "$memo_key" ]; then
+  memo_entry="$memo_dir/$memo_key"
+  memo_tmp="$memo_entry.tmp.$$"
+  rm -rf "$memo_tmp"
+  mkdir -p "$memo_tmp/artifacts" || exit 1
+  {
+    echo "key=$memo_key"
+    echo "commit=$memo_commit"
+    echo %(lane)s
+    echo "rc=0"
+    echo "finished=$(date -u +%%Y-%%m-%%dT%%H:%%M:%%SZ)"
+  } > "$memo_tmp/manifest"
+  if [ -f %(log_file)s ]; then
+    cp %(log_file)s "$memo_tmp/lane.log" && echo "log=$memo_entry/lane.log" >> "$memo_tmp/manifest"
+  fi
+  memo_artifacts=0
+  for f in %(artifacts)s; do
+    [ -f "$f" ] || continue
+    cp -p "$f" "$memo_tmp/artifacts/" || continue
+    echo "artifact.$memo_artifacts=$memo_entry/artifacts/$(basename "$f")" >> "$memo_tmp/manifest"
+    memo_artifacts=$((memo_artifacts + 1))
+  done
+  rm -rf "$memo_entry"
+  mv "$memo_tmp" "$memo_entry" && echo "Recorded lane result $memo_key"
+fi
+"""
+
+
+class LaneResult(object):
+    """Key of a lane run and the result of a previous successful run with the same key"""
+
+    def __init__(self, key, commit, manifest=None):
+        """
+        :param key: result key.  Empty when the working copy is not a git repository
+        :param commit: commit of the working copy
+        :param manifest: dict of the stored result, None when there is none
+        """
+        self.key = key
+        self.commit = commit
+        self.manifest = manifest
+
+    def hit(self):
+        return self.manifest is not None
+
+    def artifacts(self):
+        """
+        :return: paths on the host of the stored artifacts
+        """
+        names = [n for n in self.manifest.keys() if n.startswith("artifact.")]
+        return [self.manifest[n] for n in sorted(names, key=lambda n: int(n.split(".", 1)[1]))]
+
+    @staticmethod
+    def parse_manifest(lines):
+        manifest = {}
+        for line in lines:
+            if "=" in line:
+                name, value = line.split("=", 1)
+                manifest[name.strip()] = value.rstrip("\r\n")
+        return manifest
+
+
+class LaneMemo(object):
+    """Lane results stored on the fastlane host"""
+
+    def __init__(self, memo_dir, env_names=(), tool_cmds=(), artifact_patterns=(), host_facts=()):
+        """
+        :param memo_dir: directory on the host holding the results
+        :param env_names: environment variables of the host that are part of the key
+        :param tool_cmds: commands whose output is part of the key, e.g. 'xcodebuild -version'
+        :param artifact_patterns: glob patterns relative to the working copy of files stored with a result
+        :param host_facts: 'tool=version' strings of the host's probed capabilities that are part of the key
+        """
+        for name in env_names:
+            if not ENV_NAME_RE.match(name):
+                raise Exception("'%s' is not a valid environment variable name" % name)
+        self.memo_dir = memo_dir
+        self.env_names = list(env_names)
+        self.tool_cmds = list(tool_cmds)
+        self.artifact_patterns = list(artifact_patterns)
+        self.host_facts = list(host_facts)
+
+    @staticmethod
+    def new_instance(params, host_facts=()):
+        """
+        :param host_facts: see LaneMemo
+        :return: LaneMemo, None when no result cache directory is configured
+        """
+        if not params.get("resultCacheDir"):
+            return None
+        return LaneMemo(params["resultCacheDir"], env_names=params.get("resultCacheEnv") or (),
+                        tool_cmds=params.get("resultCacheTools") or (),
+                        artifact_patterns=params.get("resultArtifacts") or (), host_facts=host_facts)
+
+    @staticmethod
+    def descriptor(lane, options):
+        parts = ["lane=%s" % lane]
+        if options:
+            parts.extend("%s=%s" % (k, options[k]) for k in sorted(options.keys()))
+        return "\n".join(parts)
+
+    def key_script(self, git_dir, lane, options):
+        """
+        :return: shell script setting memo_dir, memo_commit and memo_key.  memo_key is empty outside a git repository
+        """
+        material = ["    echo %s" % pipes.quote(fact) for fact in self.host_facts]
+        for name in self.env_names:
+            material.append("    echo \"%s=$%s\"" % (name, name))
+        for cmd in self.tool_cmds:
+            material.append("    echo %s; sh -c %s 2>&1" % (pipes.quote(cmd), pipes.quote(cmd)))
+        return KEY_SCRIPT % {"git_dir": pipes.quote(git_dir), "memo_dir": pipes.quote(self.memo_dir),
+                             "descriptor": pipes.quote(LaneMemo.descriptor(lane, options)),
+                             "key_material": "\n".join(material) or "    :"}
+
+    def record_script(self, lane, log_file=None):
+        """
+        Shell script that stores the result of a successful run.  Expects the variables set by key_script.
+        :param lane: lane name
+        :param log_file: path on the host of the lane log to store with the result
+        """
+        return RECORD_SCRIPT % {"lane": pipes.quote("lane=%s" % lane), "log_file": pipes.quote(log_file or ""),
+                                "artifacts": " ".join(self.artifact_patterns) or "\"\""}
+
+    def record_result_script(self, result, git_dir, lane, log_file=None):
+        """
+        :param result: LaneResult returned by lookup
+        :return: shell script that stores the result of a successful run with the key of result
+        """
+        return "\n".join(["memo_dir=%s" % pipes.quote(self.memo_dir),
+                          "memo_key=%s" % pipes.quote(result.key),
+                          "memo_commit=%s" % pipes.quote(result.commit),
+                          "cd %s || exit 1" % pipes.quote(git_dir),
+                          self.record_script(lane, log_file)])
+
+    def lookup(self, host, git_dir, lane, options):
+        """
+        Computes the key of the lane run on the host and reads a stored result.
+        :return: LaneResult
+        """
+        script = self.key_script(git_dir, lane, options) + "\n".join([
+            "echo \"%s $memo_key $memo_commit\"" % MEMO_MARKER,
+            "if [ -n \"$memo_key\" ] && [ -f \"$memo_dir/$memo_key/manifest\" ]; then",
+            "  cat \"$memo_dir/$memo_key/manifest\"",
+            "fi"])
+        session = OverthereHostSession(host, enable_logging=False, capture_max_lines=None)
+        with session:
+            response = session.execute_script(script, "lane_memo.sh", show_script=False)
+        lines = list(response.stdout)
+        for i, line in enumerate(lines):
+            if line.startswith(MEMO_MARKER):
+                parts = line.split()
+                key = parts[1] if len(parts) > 1 else ""
+                commit = parts[2] if len(parts) > 2 else ""
+                manifest = LaneMemo._manifest(lines[i + 1:]) if key else None
+                return LaneResult(key, commit, manifest)
+        raise Exception("Could not compute the lane result key on the host")
+
+    @staticmethod
+    def _manifest(lines):
+        manifest = LaneResult.parse_manifest(lines)
+        return manifest if manifest.get("rc") == "0" else None
+
+    def guarded_script(self, git_dir, lane, options, lane_script, force=False):
+        """
+        Job script step that runs the lane only when no result is stored for its key, then stores the result.
+        The key is reported as job output 'memo_key' and a stored result as 'memo.<name>' outputs.
+        The output of the lane, stderr merged into stdout, is copied to a log in the memo dir that is stored with the result.
+        """
+        lane_log = "%s/.lane-%s.log" % (self.memo_dir, uuid.uuid4().hex)
+        lane_rc_file = "%s.rc" % lane_log
+        return "\n".join([
+            self.key_script(git_dir, lane, options),
+            "[ -n \"$memo_key\" ] && job_output memo_key \"$memo_key\"",
+            "if [ %s != true ] && [ -n \"$memo_key\" ] && [ -f \"$memo_dir/$memo_key/manifest\" ]; then" % ("true" if force else "false"),
+            "  echo %s\" already succeeded for commit $memo_commit. Skipping the lane\"" % pipes.quote("Lane '%s'" % lane),
+            "  while IFS= read -r line; do",
+            "    job_output \"memo.${line%%=*}\" \"${line#*=}\"",
+            "  done < \"$memo_dir/$memo_key/manifest\"",
+            "  exit 0",
+            "fi",
+            "mkdir -p %s" % pipes.quote(self.memo_dir),
+            "{ ( %s ) 2>&1; echo $? > %s; } | tee %s" % (lane_script, pipes.quote(lane_rc_file), pipes.quote(lane_log)),
+            "lane_rc=$(cat %s 2>/dev/null || echo 1)" % pipes.quote(lane_rc_file),
+            "if [ $lane_rc -eq 0 ]; then",
+            "  ( %s ) || true" % self.record_script(lane, lane_log),
+            "fi",
+            "rm -f %s %s" % (pipes.quote(lane_log), pipes.quote(lane_rc_file)),
+            "exit $lane_rc"])
@@ -0,0 +1,140 @@
+#
+#
+# Copyright 2019 XEBIALABS
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+#
+# THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND, EITHER EXPRESSED OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS
+# FOR A PARTICULAR PURPOSE. THIS CODE AND INFORMATION ARE NOT SUPPORTED BY XEBIALABS.
+#
+
+"""
+    Action durations from the JUnit report fastlane writes to 'fastlane/report.xml', and a history of
+    them per repository and lane to spot actions that became slower.
+"""
+import re
+import time
+from xml.etree.ElementTree import iterparse
+
+REPORT_FILE = "fastlane/report.xml"
+# fastlane prefixes each test case with the position of the action, e.g. '3: gym'
+ACTION_INDEX_RE = re.compile(r'^\d+: ')
+DEFAULT_HISTORY_RUNS = 20
+
+
+def parse_report(stream):
+    """
+    Reads the action durations from a fastlane report without loading the whole document.
+    An action that ran several times is reported with its total duration.
+    :param stream: file-like object with the report XML
+    :return: list of (action, seconds) in the order the actions first ran
+    """
+    names = []
+    durations = {}
+    for _, elem in iterparse(stream):
+        if elem.tag == "testcase":
+            name = ACTION_INDEX_RE.sub("", elem.get("name", "")).strip() or "unknown"
+            if name not in durations:
+                names.append(name)
+                durations[name] = 0.0
+            durations[name] += float(elem.get("time") or 0)
+        elem.clear()
+    return [(name, durations[name]) for name in names]
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) / 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+class SlowAction(object):
+    """An action that took longer than usual"""
+
+    def __init__(self, name, secs, median_secs):
+        self.name = name
+        self.secs = secs
+        self.median_secs = median_secs
+
+    def ratio(self):
+        return self.secs / self.median_secs
+
+
+class ActionHistory(object):
+    """
+    Action durations of the last runs of a lane, kept in a file on the fastlane host.
+    Each line is one run: '<epoch secs>' followed by tab separated '<action>=<seconds>' fields.
+    """
+
+    def __init__(self, path, max_runs=DEFAULT_HISTORY_RUNS):
+        """
+        :param path: absolute path of the history file on the host
+        :param max_runs: number of runs kept
+        """
+        self.path = path
+        self.max_runs = max_runs
+
+    def load(self, session):
+        """
+        :param session: OverthereHostSession
+        :return: list of (epoch secs, dict of action to seconds), oldest run first
+        """
+        if not session.remote_file(self.path).exists():
+            return []
+        runs = []
+        for line in session.read_file(self.path).splitlines():
+            fields = line.split("\t")
+            run = {}
+            for field in fields[1:]:
+                if "=" in field:
+                    name, secs = field.rsplit("=", 1)
+                    run[name] = float(secs)
+            if run:
+                runs.append((int(fields[0]), run))
+        return runs
+
+    def save(self, session, runs, durations):
+        """
+        Appends a run and drops the oldest runs above max_runs.
+        :param runs: runs returned by load
+        :param durations: list of (action, seconds) of the new run
+        """
+        lines = []
+        for epoch, run in runs[-(self.max_runs - 1):] if self.max_runs > 1 else []:
+            lines.append(ActionHistory._line(epoch, sorted(run.items())))
+        lines.append(ActionHistory._line(int(time.time()), durations))
+        session.copy_text_to_file("\n".join(lines) + "\n", session.remote_file(self.path))
+
+    @staticmethod
+    def _line(epoch, durations):
+        fields = ["%s=%.3f" % (name.replace("\t", " "), secs) for name, secs in durations]
+        return "\t".join([str(epoch)] + fields)
+
+    @staticmethod
+    def slow_actions(durations, runs, factor, min_runs=3, min_secs=1.0):
+        """
+        :param durations: list of (action, seconds) of the current run
+        :param runs: previous runs returned by load
+        :param factor: an action is slow when it took longer than factor times its median duration
+        :param min_runs: actions with fewer previous runs are never slow
+        :param min_secs: actions shorter than this are never slow
+        :return: list of SlowAction
+        """
+        slow = []
+        for name, secs in durations:
+            previous = [run[name] for _, run in runs if name in run]
+            if len(previous) < min_runs or secs < min_secs:
+                continue
+            median_secs = median(previous)
+            if median_secs > 0 and secs > median_secs * factor:
+                slow.append(SlowAction(name, secs, median_secs))
+        return slow
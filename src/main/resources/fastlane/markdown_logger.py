@@ -15,17 +15,151 @@
 # FOR A PARTICULAR PURPOSE. THIS CODE AND INFORMATION ARE NOT SUPPORTED BY XEBIALABS.
 #
 
+import sys
+import threading
+import time
+
+
+class StreamBuffer(object):
+    """Text buffered for one output stream"""
+
+    def __init__(self, out):
+        self.out = out
+        self.chunks = []
+        self.size = 0
+        self.started = None
+        """time the oldest buffered text was written.  None when the buffer is empty"""
+        self.last_flush = 0
+
+
+class BufferedLogWriter(object):
+    """
+    Coalesces writes to the task log.  Text is buffered per output stream, i.e. per task since each script gets its
+    own sys.stdout.  A buffer is written out once it reaches max_buffer_chars or holds text older than
+    flush_interval_secs, but no more than max_flushes_per_sec times per second, and when the task's entry script
+    or print_error calls flush().  Buffers that no write fills up are written out by a flusher thread, so text
+    logged before a long silent command shows up without waiting for the next write.
+    """
+
+    def __init__(self, max_buffer_chars=8192, flush_interval_secs=1.0, max_flushes_per_sec=2):
+        """
+        :param max_buffer_chars: buffer size that triggers a flush
+        :param flush_interval_secs: maximum time buffered text waits before being flushed
+        :param max_flushes_per_sec: cap on the number of unforced flushes per second of one output stream
+        """
+        self.max_buffer_chars = max_buffer_chars
+        self.flush_interval_secs = flush_interval_secs
+        self.min_flush_interval_secs = 1.0 / max_flushes_per_sec
+        self._lock = threading.RLock()
+        self._buffers = {}
+        """id of the output stream -> StreamBuffer"""
+        self._flusher = None
+
+    def write(self, text):
+        out = sys.stdout
+        with self._lock:
+            buf = self._buffers.get(id(out))
+            if buf is None or buf.out is not out:
+                buf = self._buffers[id(out)] = StreamBuffer(out)
+            if buf.started is None:
+                buf.started = time.time()
+            buf.chunks.append(text)
+            buf.size += len(text)
+            if buf.size >= self.max_buffer_chars and time.time() - buf.last_flush >= self.min_flush_interval_secs:
+                self._flush(buf)
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._run_flusher, name="log-flusher")
+                self._flusher.daemon = True
+                self._flusher.start()
+
+    def flush(self):
+        """Writes out the text buffered for the current sys.stdout"""
+        out = sys.stdout
+        with self._lock:
+            buf = self._buffers.get(id(out))
+            if buf is not None and buf.out is out:
+                self._flush(buf)
+                del self._buffers[id(out)]
+
+    def _due(self, buf):
+        """:return: time the buffer is to be written out.  None when it is empty"""
+        if buf.started is None:
+            return None
+        due = buf.started + self.flush_interval_secs
+        if buf.size >= self.max_buffer_chars:
+            due = buf.started
+        return max(due, buf.last_flush + self.min_flush_interval_secs)
+
+    def _run_flusher(self):
+        """Writes out due buffers and exits once no text has been buffered for a rate limit interval"""
+        while True:
+            with self._lock:
+                now = time.time()
+                wait = self.flush_interval_secs
+                for key, buf in self._buffers.items():
+                    due = self._due(buf)
+                    if due is not None and due <= now:
+                        self._flush(buf)
+                    elif due is not None:
+                        wait = min(wait, due - now)
+                    elif now - buf.last_flush >= self.min_flush_interval_secs:
+                        del self._buffers[key]
+                if not self._buffers:
+                    self._flusher = None
+                    return
+            time.sleep(max(wait, 0.05))
+
+    def _flush(self, buf):
+        text = "".join(buf.chunks)
+        buf.chunks = []
+        buf.size = 0
+        buf.started = None
+        buf.last_flush = time.time()
+        if text:
+            buf.out.write(text)
+            buf.out.flush()
+
+
+class UnbufferedLogWriter(object):
+    """Writes straight through to stdout"""
+
+    def write(self, text):
+        sys.stdout.write(text)
+
+    def flush(self):
+        sys.stdout.flush()
+
+
 class MarkdownLogger(object):
 
+    writer = BufferedLogWriter()
+
+    @staticmethod
+    def set_writer(writer):
+        """
+        Replaces the writer all output goes through
+        :param writer: object with write(text) and flush() methods
+        """
+        MarkdownLogger.flush()
+        MarkdownLogger.writer = writer
+
+    @staticmethod
+    def write(text):
+        MarkdownLogger.writer.write(text)
+
+    @staticmethod
+    def flush():
+        MarkdownLogger.writer.flush()
+
     @staticmethod
     def println(msg, bold=False, italic=False):
         new_msg = msg if not bold else "__%s__" % msg
         new_msg = new_msg if not italic else "_%s_" % new_msg
-        print new_msg, "  "
+        MarkdownLogger.write("%s   \n" % new_msg)
 
     @staticmethod
     def print_header(header, level=1):
-        print "\n", "#"*level, header
+        MarkdownLogger.write("\n%s %s\n" % ("#"*level, header))
 
     @staticmethod
     def print_header2(header):
@@ -37,36 +171,34 @@ class MarkdownLogger(object):
 
     @staticmethod
     def print_url(label, url):
-        print "[%s](%s)" % (label, url)
+        MarkdownLogger.write("[%s](%s)\n" % (label, url))
 
     @staticmethod
     def print_para(msg):
-        print "\n", msg, "\n"
+        MarkdownLogger.write("\n%s \n\n" % msg)
 
     @staticmethod
     def print_hr():
-        print "***"
+        MarkdownLogger.write("***\n")
 
     @staticmethod
     def print_code(msg):
-        print "\n", "```"
-        print msg
-        print "```\n"
+        MarkdownLogger.write("\n```\n%s\n```\n\n" % msg)
 
     @staticmethod
     def print_list(items, ordered=False):
         delimiter = "1." if ordered else "*"
-        for item in items:
-            print delimiter, item
-        print "\n"
+        lines = ["%s %s\n" % (delimiter, item) for item in items]
+        lines.append("\n\n")
+        MarkdownLogger.write("".join(lines))
 
     @staticmethod
     def print_table(headers, rows):
-        print "\n|", "|".join(headers), "|"
-        print "|", " ------ |" * len(headers)
+        lines = ["\n| %s |\n" % "|".join(headers), "| %s\n" % (" ------ |" * len(headers))]
         for r in rows:
-            print "| ", "  |".join(r), " |"
-        print "\n"
+            lines.append("|  %s  |\n" % "  |".join(r))
+        lines.append("\n\n")
+        MarkdownLogger.write("".join(lines))
 
     @staticmethod
     def print_error(msg):
@@ -78,9 +210,8 @@ class MarkdownLogger(object):
         else:
             MarkdownLogger.print_para(msg)
         MarkdownLogger.print_hr()
+        MarkdownLogger.flush()
 
     @staticmethod
     def print_link(link_name, url, prefix_msg=""):
         MarkdownLogger.println("%s [%s](%s)" % (prefix_msg, link_name, url))
-
-
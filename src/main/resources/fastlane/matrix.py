@@ -0,0 +1,183 @@
+#
+#
+# Copyright 2019 XEBIALABS
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+#
+# THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND, EITHER EXPRESSED OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS
+# FOR A PARTICULAR PURPOSE. THIS CODE AND INFORMATION ARE NOT SUPPORTED BY XEBIALABS.
+#
+
+"""
+    Runs a lane for each cell of a matrix of repositories, branches and lanes, spread over one or more hosts.
+"""
+import threading
+import time
+from Queue import Queue, Empty
+
+from fastlane.git_client import GitClient, WORKTREE_PER_TASK
+from fastlane.fastlane_client import FastlaneClient
+from fastlane.markdown_logger import MarkdownLogger as mdl
+
+
+class MatrixCell(object):
+    """One lane run of the matrix"""
+
+    def __init__(self, index, clone_url, branch, lane, options):
+        self.index = index
+        self.clone_url = clone_url
+        self.branch = branch
+        self.lane = lane
+        self.options = options
+        self.host_name = ""
+        self.status = "pending"
+        self.duration = 0
+        self.commit = ""
+        self.error = None
+
+    @staticmethod
+    def parse(index, entry):
+        """
+        Parses a cell definition of the form 'clone url|branch|lane|key=value,key=value'.  The options are optional.
+        :return: MatrixCell
+        """
+        parts = [p.strip() for p in entry.split("|")]
+        if len(parts) < 3 or len(parts) > 4 or not parts[2]:
+            raise Exception("Invalid matrix entry '%s'. Expected 'clone url|branch|lane|key=value,key=value'" % entry)
+        options = {}
+        if len(parts) == 4 and parts[3]:
+            for option in parts[3].split(","):
+                k, _, v = option.partition("=")
+                options[k.strip()] = v.strip()
+        return MatrixCell(index, parts[0], parts[1], parts[2], options)
+
+    def row(self):
+        return [str(self.index), self.clone_url, self.branch, self.lane, self.host_name, self.status,
+                "%.1f s" % self.duration, self.commit]
+
+    def __getitem__(self, name):
+        return self.__getattribute__(name)
+
+
+class HostSlots(object):
+    """
+    Hands out hosts to cells, least busy host first.  At most max_per_host cells run on a host at a time, and no more
+    than the host's Max Connections, since each running lane holds one of its connections
+    """
+
+    def __init__(self, hosts, max_per_host):
+        """
+        :param hosts: Array of (name, OverthereHost)
+        :param max_per_host: number of cells that may run on a host at the same time
+        """
+        self._hosts = hosts
+        self._max = [min(max_per_host, host.max_connections) for _, host in hosts]
+        self._running = [0] * len(hosts)
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """
+        Blocks until a host has a free slot
+        :return: index of the host
+        """
+        with self._cond:
+            while True:
+                free = [i for i in range(len(self._hosts)) if self._running[i] < self._max[i]]
+                if free:
+                    index = min(free, key=lambda i: self._running[i])
+                    self._running[index] += 1
+                    return index
+                self._cond.wait()
+
+    def release(self, index):
+        with self._cond:
+            self._running[index] -= 1
+            self._cond.notifyAll()
+
+    def host(self, index):
+        return self._hosts[index]
+
+
+class LaneMatrix(object):
+
+    def __init__(self, hosts, task_vars, max_parallel=4, max_per_host=2):
+        """
+        :param hosts: Array of (name, OverthereHost) the cells are spread over
+        :param task_vars: task properties with the git settings shared by all cells
+        :param max_parallel: number of cells running at the same time
+        :param max_per_host: number of cells running on one host at the same time
+        """
+        self.task_vars = task_vars
+        self.max_parallel = max_parallel
+        self.slots = HostSlots(hosts, max_per_host)
+
+    def run(self, cells):
+        """
+        Runs all cells and prints a summary table.
+        :param cells: Array of MatrixCell
+        :return: Array of the cells that failed
+        """
+        # python threads rather than a java executor, so the workers log to the task's output
+        pending = Queue()
+        for cell in cells:
+            pending.put(cell)
+        workers = [threading.Thread(target=self._worker, args=(pending,), name="matrix-%d" % i)
+                   for i in range(min(self.max_parallel, len(cells)))]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+
+        mdl.print_header3("Matrix results")
+        mdl.print_table(["Cell", "Repository", "Branch", "Lane", "Host", "Status", "Duration", "Commit"],
+                        [cell.row() for cell in cells])
+        return [cell for cell in cells if cell.status != "success"]
+
+    def _worker(self, pending):
+        try:
+            while True:
+                try:
+                    cell = pending.get_nowait()
+                except Empty:
+                    return
+                self.run_cell(cell)
+        finally:
+            # the log is flushed by the thread that wrote it
+            mdl.flush()
+
+    def run_cell(self, cell):
+        index = self.slots.acquire()
+        start = time.time()
+        git = None
+        try:
+            cell.host_name, host = self.slots.host(index)
+            cell.status = "running"
+            mdl.println("Cell %d: lane '%s' of '%s' (%s) on %s" % (cell.index, cell.lane, cell.clone_url, cell.branch, cell.host_name))
+            git = GitClient(cell.clone_url, self.task_vars["gitRepoBaseDir"], host=host,
+                            mirror_base_dir=self.task_vars["gitMirrorDir"],
+                            worktree_mode=self.task_vars["gitWorktreeMode"] or WORKTREE_PER_TASK, worktree_ref=cell.branch)
+            if cell.branch:
+                cell.commit = git.sync_to_ref(cell.branch, depth=self.task_vars["gitFetchDepth"],
+                                              partial=self.task_vars["gitPartialClone"])
+            else:
+                git.fetch_repo()
+            FastlaneClient(git.git_dir, host=host, base_dir=git.repo_base_dir).run_lane(cell.lane, cell.options)
+            cell.status = "success"
+        except Exception, e:
+            cell.status = "failed"
+            cell.error = e
+            mdl.println("Cell %d failed: %s" % (cell.index, e), bold=True)
+        finally:
+            cell.duration = time.time() - start
+            try:
+                if git is not None:
+                    git.release()
+            finally:
+                self.slots.release(index)
@@ -0,0 +1,44 @@
+#
+#
+# Copyright 2019 XEBIALABS
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+#
+# THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND, EITHER EXPRESSED OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS
+# FOR A PARTICULAR PURPOSE. THIS CODE AND INFORMATION ARE NOT SUPPORTED BY XEBIALABS.
+#
+
+from fastlane.fastlane_host import FastlaneHost
+from fastlane.matrix import LaneMatrix, MatrixCell
+from fastlane.markdown_logger import MarkdownLogger as mdl
+
+
+def process(task_vars):
+    cells = [MatrixCell.parse(i + 1, entry) for i, entry in enumerate(task_vars["cells"])]
+    if len(cells) == 0:
+        raise Exception("No matrix cells defined")
+
+    if task_vars["clientHosts"]:
+        hosts = [(FastlaneHost.name(ci), FastlaneHost.new_host(ci)) for ci in task_vars["clientHosts"]]
+    else:
+        hosts = [("local", FastlaneHost.new_host(None))]
+
+    matrix = LaneMatrix(hosts, task_vars, max_parallel=task_vars["maxParallel"] or 4,
+                        max_per_host=task_vars["maxPerHost"] or 2)
+    failed = matrix.run(cells)
+    if len(failed) > 0:
+        raise Exception("%d of %d cells failed: %s" % (len(failed), len(cells), ", ".join(str(c.index) for c in failed)))
+
+
+if __name__ == '__main__' or __name__ == '__builtin__':
+    try:
+        process(locals())
+    finally:
+        mdl.flush()
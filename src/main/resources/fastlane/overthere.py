@@ -22,14 +22,21 @@
 import sys
 import time
 import re
+import jarray
+import pipes
+import threading
+from collections import deque
 
-from com.xebialabs.overthere import CmdLine, ConnectionOptions, Overthere, OperatingSystemFamily
+from com.xebialabs.overthere import CmdLine, ConnectionOptions, Overthere, OperatingSystemFamily, OverthereExecutionOutputHandler
 from com.xebialabs.overthere.ssh import SshConnectionType
 from com.xebialabs.overthere.local import LocalFile
-from com.xebialabs.overthere.util import OverthereUtils, CapturingOverthereExecutionOutputHandler,\
-    ConsoleOverthereExecutionOutputHandler, MultipleOverthereExecutionOutputHandler
+from com.xebialabs.overthere.util import OverthereUtils
+from java.io import BufferedReader, BufferedWriter, File, InputStreamReader, OutputStreamWriter
+from java.lang import ProcessBuilder
+from java.util.zip import GZIPOutputStream
 from java.lang import Integer
 from fastlane.markdown_logger import MarkdownLogger as mdl
+from fastlane.phase_timer import CONNECT_PHASE, COMMAND_PHASE, timed
 
 
 class LocalConnectionOptions(object):
@@ -131,16 +138,19 @@ class SshConnectionOptions(RemoteConnectionOptions):
 
 class OverthereHost(object):
     """Represents an Overthere host.  Compatible with XL Deploy's HostContainer class. """
-    def __init__(self, options):
+    def __init__(self, options, max_connections=None):
         """
         :param options: an instance of either SshConnectionOptions, CifsConnectionOptions or LocalConnectionOptions
+        :param max_connections: maximum number of pooled connections open to this host at any time
         """
         self._options = options
         self.host = self
         """host variable contains a reference to this instance"""
         self.os = options.os
         """os variable containers a reference to the target host's com.xebialabs.overthere.OperatingSystemFamily"""
+        self.protocol = options.protocol
         self.temporaryDirectoryPath = options.os.defaultTemporaryDirectoryPath
+        self.max_connections = max_connections or OverthereConnectionPool.DEFAULT_MAX_PER_HOST
 
 
     def __getattr__(self, name):
@@ -154,6 +164,162 @@ class OverthereHost(object):
         """
         return Overthere.getConnection(self._options.protocol, self._options.build())
 
+    def pool_key(self):
+        """
+        :return: key identifying hosts that can share pooled connections, i.e. the same account on the same address.
+                 Credentials are left out, the key is kept for the life of the pool
+        """
+        options = self._options.__dict__
+        return "%s://%s@%s:%s" % (self._options.protocol, options.get("username", ""), options.get("address", ""),
+                                  options.get("port", ""))
+
+
+class OverthereConnectionPool(object):
+    """
+    Pool of Overthere connections shared by all sessions in the XL Release JVM.
+    Connections are keyed by OverthereHost.pool_key(), health checked when borrowed and closed when idle for too long.
+    """
+    DEFAULT_MAX_PER_HOST = 4
+    DEFAULT_IDLE_TIMEOUT_SECS = 300
+    DEFAULT_BORROW_TIMEOUT_SECS = None
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, idle_timeout_secs=DEFAULT_IDLE_TIMEOUT_SECS, borrow_timeout_secs=DEFAULT_BORROW_TIMEOUT_SECS):
+        """
+        :param idle_timeout_secs: idle connections older than this are closed
+        :param borrow_timeout_secs: maximum time to wait for a connection when a host is at its connection cap.
+                                    None to wait until one is released, lanes hold their connection while they run
+        """
+        self.idle_timeout_secs = idle_timeout_secs
+        self.borrow_timeout_secs = borrow_timeout_secs
+        self._cond = threading.Condition()
+        self._idle = {}
+        """pool key -> list of (connection, last used timestamp)"""
+        self._leased = {}
+        """pool key -> number of connections currently borrowed"""
+        self._reaper = None
+        """daemon thread closing idle connections while there are any"""
+
+    @staticmethod
+    def shared():
+        """
+        :return: the JVM-wide pool instance
+        """
+        with OverthereConnectionPool._shared_lock:
+            if OverthereConnectionPool._shared is None:
+                OverthereConnectionPool._shared = OverthereConnectionPool()
+            return OverthereConnectionPool._shared
+
+    def borrow(self, host, capped=True):
+        """
+        Borrow a healthy connection to the host.  Blocks while the host is at its connection cap.
+        :param host: OverthereHost
+        :param capped: False for short commands, e.g. probes, that must not wait for long running lanes.  They reuse an
+                       idle connection when there is one and open a new one otherwise
+        :return: com.xebialabs.overthere.OverthereConnection
+        """
+        key = host.pool_key()
+        deadline = time.time() + self.borrow_timeout_secs if self.borrow_timeout_secs else None
+        while True:
+            conn = None
+            with self._cond:
+                self._evict_idle()
+                idle = self._idle.get(key, [])
+                waiting = False
+                while capped and len(idle) == 0 and self._leased.get(key, 0) >= host.max_connections:
+                    if not waiting:
+                        mdl.println("Waiting for a free connection to the host. %s connections in use" % host.max_connections)
+                        waiting = True
+                    if deadline is None:
+                        self._cond.wait(60)
+                    else:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise Exception("Timed out waiting for a connection to host. %s connections in use" % host.max_connections)
+                        self._cond.wait(remaining)
+                    self._evict_idle()
+                    idle = self._idle.get(key, [])
+                if len(idle) > 0:
+                    conn = idle.pop()[0]
+                self._leased[key] = self._leased.get(key, 0) + 1
+
+            if conn is None:
+                try:
+                    return host.getConnection()
+                except:
+                    self._discard(key, None)
+                    raise
+            if self._healthy(conn, host):
+                return conn
+            self._discard(key, conn)
+
+    def release(self, host, conn):
+        """
+        Return a borrowed connection to the pool
+        :param host: OverthereHost the connection was borrowed for
+        :param conn: com.xebialabs.overthere.OverthereConnection
+        """
+        key = host.pool_key()
+        with self._cond:
+            self._leased[key] = self._leased.get(key, 1) - 1
+            self._idle.setdefault(key, []).append((conn, time.time()))
+            self._evict_idle()
+            if self._reaper is None:
+                self._reaper = threading.Thread(target=self._reap, name="overthere-pool-reaper")
+                self._reaper.daemon = True
+                self._reaper.start()
+            self._cond.notifyAll()
+
+    def invalidate(self, host, conn):
+        """
+        Close a borrowed connection that should not be reused
+        :param host: OverthereHost the connection was borrowed for
+        :param conn: com.xebialabs.overthere.OverthereConnection
+        """
+        self._discard(host.pool_key(), conn)
+
+    def _discard(self, key, conn):
+        with self._cond:
+            self._leased[key] = self._leased.get(key, 1) - 1
+            self._cond.notifyAll()
+        if conn is not None:
+            OverthereConnectionPool._close_quietly(conn)
+
+    def _reap(self):
+        """Closes idle connections once they time out.  Exits when no connection is idle"""
+        with self._cond:
+            while self._idle:
+                oldest = min(e[1] for idle in self._idle.values() for e in idle)
+                self._cond.wait(max(1, oldest + self.idle_timeout_secs - time.time()))
+                self._evict_idle()
+            self._reaper = None
+
+    def _evict_idle(self):
+        # caller holds self._cond
+        expiry = time.time() - self.idle_timeout_secs
+        for key, idle in self._idle.items():
+            for entry in [e for e in idle if e[1] < expiry]:
+                idle.remove(entry)
+                OverthereConnectionPool._close_quietly(entry[0])
+            if len(idle) == 0:
+                del self._idle[key]
+
+    @staticmethod
+    def _healthy(conn, host):
+        try:
+            return conn.getFile(host.temporaryDirectoryPath).exists()
+        except:
+            return False
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except:
+            pass
+
 
 class CommandResponse(object):
     """Response from the execution of a remote os command"""
@@ -168,6 +334,22 @@ class CommandResponse(object):
         self.rc = rc
         self.stdout = stdout
         self.stderr = stderr
+        self.stdout_digest = None
+        """FailureDigest of the standard output"""
+        self.stderr_digest = None
+        """FailureDigest of the standard error"""
+        self.stdout_log = None
+        """com.xebialabs.overthere.OverthereFile with the full gzipped standard output, when spilled. Valid while the session is open"""
+        self.stderr_log = None
+        """com.xebialabs.overthere.OverthereFile with the full gzipped standard error, when spilled. Valid while the session is open"""
+        self.truncated = False
+        """True when stdout or stderr only hold the tail of the output"""
+        self.pgid = None
+        """Process group id of the command on the host, when it ran in its own group"""
+        self.steps = []
+        """Results of the individual steps when the command was a job script"""
+        self.outputs = {}
+        """Named values recorded by a job script"""
 
     def __getitem__(self, name):
         return self.__getattribute__(name)
@@ -188,23 +370,245 @@ class OverthereSessionLogger(object):
 
     def info(self, msg):
         if self._enabled:
-            print msg
+            mdl.write("%s\n" % msg)
         if self._capture:
             self.output_lines.append(msg)
 
     def error(self, msg):
         if self._enabled:
+            mdl.flush()
             print >> sys.stderr, msg
         if self._capture:
             self.error_lines.append(msg)
 
 
+class LogWriterOutputHandler(OverthereExecutionOutputHandler):
+    """Output handler that writes each line to the task log through the MarkdownLogger writer"""
+
+    def handleChar(self, c):
+        pass
+
+    def handleLine(self, line):
+        mdl.write("%s\n" % line)
+
+
+class OutputStreamPump(threading.Thread):
+    """Feeds the lines of a process output stream to an output handler and signals when the stream reaches EOF"""
+
+    def __init__(self, stream, handler, name="output-pump"):
+        """
+        :param stream: java.io.InputStream of the process
+        :param handler: com.xebialabs.overthere.OverthereExecutionOutputHandler receiving each line
+        :param name: thread name
+        """
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self._stream = stream
+        self._handler = handler
+        self.eof = threading.Event()
+        """set when the stream has been fully read"""
+
+    def run(self):
+        try:
+            reader = BufferedReader(InputStreamReader(self._stream))
+            try:
+                line = reader.readLine()
+                while line is not None:
+                    self._handler.handleLine(line)
+                    line = reader.readLine()
+            finally:
+                reader.close()
+        finally:
+            self.eof.set()
+
+    def await_eof(self, deadline=None):
+        """
+        Blocks until the stream reaches EOF
+        :param deadline: time.time() after which to stop waiting.  None to wait for ever
+        :return: True when the stream reached EOF, False when the deadline passed first
+        """
+        while not self.eof.is_set():
+            if deadline is not None and time.time() >= deadline:
+                return False
+            self.eof.wait(1)
+        return True
+
+
+GROUP_MARKER = "##xlr-fastlane-pgid"
+
+
+class ProcessGroupRecorder(OverthereExecutionOutputHandler):
+    """Output handler that takes the process group id printed by GROUP_SCRIPT off stderr and forwards all other lines"""
+
+    def __init__(self, handler):
+        """
+        :param handler: com.xebialabs.overthere.OverthereExecutionOutputHandler receiving the other lines
+        """
+        self._handler = handler
+        self.pgid = None
+        """process group id of the command on the host, once received"""
+
+    def handleChar(self, c):
+        pass
+
+    def handleLine(self, line):
+        if self.pgid is None and line.startswith(GROUP_MARKER):
+            self.pgid = int(line.split()[1])
+            return
+        self._handler.handleLine(line)
+
+
+class StreamingOutputHandler(OverthereExecutionOutputHandler):
+    """
+    Output handler that forwards lines as they arrive and only retains the last lines in memory.
+    Optionally writes the full output to a gzipped file.
+    """
+
+    def __init__(self, max_lines=None, max_bytes=None, forward=(), spill_file=None):
+        """
+        :param max_lines: number of trailing lines to retain.  None for no limit
+        :param max_bytes: number of trailing characters to retain.  None for no limit
+        :param forward: com.xebialabs.overthere.OverthereExecutionOutputHandler instances that receive every line
+        :param spill_file: com.xebialabs.overthere.OverthereFile the gzipped output is written to
+        """
+        self._max_bytes = max_bytes
+        self._forward = [h for h in forward if h is not None]
+        self._tail = deque(maxlen=max_lines)
+        self._tail_bytes = 0
+        self.line_count = 0
+        """total number of lines handled"""
+        self.spill_file = spill_file
+        self._spill_writer = None
+        if spill_file is not None:
+            self._spill_writer = BufferedWriter(OutputStreamWriter(GZIPOutputStream(spill_file.getOutputStream()), "UTF-8"))
+
+    def handleChar(self, c):
+        for h in self._forward:
+            h.handleChar(c)
+
+    def handleLine(self, line):
+        for h in self._forward:
+            h.handleLine(line)
+        if self._spill_writer is not None:
+            self._spill_writer.write(line)
+            self._spill_writer.newLine()
+        self.line_count += 1
+        if self._tail.maxlen is not None and len(self._tail) == self._tail.maxlen:
+            self._tail_bytes -= len(self._tail[0])
+        self._tail.append(line)
+        self._tail_bytes += len(line)
+        while self._max_bytes is not None and self._tail_bytes > self._max_bytes and len(self._tail) > 1:
+            self._tail_bytes -= len(self._tail.popleft())
+
+    def close(self):
+        """Flushes and closes the spill file"""
+        if self._spill_writer is not None:
+            self._spill_writer.close()
+            self._spill_writer = None
+
+    @property
+    def outputLines(self):
+        """
+        :return: the retained trailing lines
+        """
+        return list(self._tail)
+
+    @property
+    def truncated(self):
+        """
+        :return: True when lines were dropped from the retained output
+        """
+        return self.line_count > len(self._tail)
+
+
+FASTLANE_ERROR_MARKERS = ("[!]", "ERROR [", "** BUILD FAILED **")
+
+
+class FailureDigest(OverthereExecutionOutputHandler):
+    """
+    Output handler that extracts what is needed to report a failed command in a single pass over its output.
+    Keeps the blocks of lines around error markers and the last lines of the output.
+    """
+
+    def __init__(self, markers=FASTLANE_ERROR_MARKERS, context_before=5, context_after=20, max_blocks=10, tail_lines=50):
+        """
+        :param markers: a line containing any of these strings starts an error block
+        :param context_before: lines preceding a marker that are included in its block
+        :param context_after: lines following a marker that are included in its block
+        :param max_blocks: maximum number of error blocks kept.  Later blocks are only counted
+        :param tail_lines: number of trailing lines kept
+        """
+        self._markers = markers
+        self._context_after = context_after
+        self._max_blocks = max_blocks
+        self._before = deque(maxlen=context_before)
+        self._tail = deque(maxlen=tail_lines)
+        self._block = None
+        self._block_remaining = 0
+        self.blocks = []
+        """error blocks, each an Array of lines"""
+        self.dropped_marker_count = 0
+        """number of error marker lines outside the kept blocks"""
+        self.line_count = 0
+
+    def handleChar(self, c):
+        pass
+
+    def handleLine(self, line):
+        line = StringUtils.strip_ansi(line)
+        self.line_count += 1
+        self._tail.append(line)
+        if self._is_marker(line):
+            if self._block is None and len(self.blocks) < self._max_blocks:
+                self._block = list(self._before)
+                self.blocks.append(self._block)
+            if self._block is not None:
+                self._block.append(line)
+                self._block_remaining = self._context_after
+            else:
+                self.dropped_marker_count += 1
+        elif self._block is not None:
+            self._block.append(line)
+            self._block_remaining -= 1
+            if self._block_remaining <= 0:
+                self._block = None
+                self._before.clear()
+        else:
+            self._before.append(line)
+
+    def _is_marker(self, line):
+        for m in self._markers:
+            if m in line:
+                return True
+        return False
+
+    def close(self):
+        pass
+
+    def render(self):
+        """
+        :return: markdown with the error blocks followed by the tail of the output.  Empty string when there was no output.
+        """
+        if self.line_count == 0:
+            return ""
+        parts = []
+        for block in self.blocks:
+            parts.append("```\n%s\n```" % StringUtils.concat(block))
+        if self.dropped_marker_count > 0:
+            parts.append("_%d more error lines not shown_" % self.dropped_marker_count)
+        parts.append("Last %d of %d lines:" % (len(self._tail), self.line_count))
+        parts.append("```\n%s\n```" % StringUtils.concat(self._tail))
+        return "\n\n".join(parts)
+
+
+ANSI_RE = re.compile(r'\x1B\[[0-?]*[ -/]*[@-~]')
+
+
 class StringUtils(object):
 
     @staticmethod
     def strip_ansi(s):
-        ansi_re = re.compile(r'\x1B\[[0-?]*[ -/]*[@-~]')
-        return ansi_re.sub('', s)
+        return ANSI_RE.sub('', s)
 
     @staticmethod
     def concat(sarray, delimiter='\n'):
@@ -245,13 +649,61 @@ class StringUtils(object):
         return not StringUtils.empty(s)
 
 
+DEFAULT_CAPTURE_MAX_LINES = 10000
+# longest command line sent by delete_from_bulk, well below the ARG_MAX of macOS and Linux
+MAX_BATCH_CHARS = 65536
+# seconds between TERM and KILL when a command's process group is killed
+KILL_GRACE_SECS = 10
+
+# Runs a command in its own process group and prints the group id on stderr.  A watcher reading stdin kills
+# the group when stdin is closed before the command exits, i.e. when the task is aborted or the connection drops.
+# setpgrp through perl because the sh of Linux does no job control without a terminal.  Background commands get
+# /dev/null as stdin, so the watcher reads the connection's stdin from fd 3.
+GROUP_SCRIPT = """group_cmd=%(cmd)s
+exec 3<&0
+if command -v perl > /dev/null 2>&1; then
+  perl -e 'setpgrp(0, 0); exec @ARGV or exit 127' /bin/sh -c "$group_cmd" < /dev/null 3<&- &
+elif command -v setsid > /dev/null 2>&1; then
+  setsid /bin/sh -c "$group_cmd" < /dev/null 3<&- &
+else
+  /bin/sh -c "$group_cmd" < /dev/null 3<&- &
+fi
+group_pgid=$!
+echo "%(marker)s $group_pgid" >&2
+( cat <&3 > /dev/null; kill -TERM -$group_pgid 2>/dev/null && { sleep %(grace)d; kill -KILL -$group_pgid 2>/dev/null; } ) > /dev/null 2>&1 &
+group_watcher=$!
+exec 3<&-
+wait $group_pgid
+group_rc=$?
+kill $group_watcher 2>/dev/null
+exit $group_rc"""
+
+KILL_GROUP_SCRIPT = """kill -TERM -%(pgid)d 2>/dev/null || exit 0
+waited=0
+while kill -0 -%(pgid)d 2>/dev/null && [ $waited -lt %(grace)d ]; do
+  sleep 1
+  waited=$((waited + 1))
+done
+kill -KILL -%(pgid)d 2>/dev/null
+exit 0"""
+
+
 class OverthereHostSession(object):
     """ Session with a target host """
-    def __init__(self, host, enable_logging=True, stream_command_output=False):
+    def __init__(self, host, enable_logging=True, stream_command_output=False, pooled=True,
+                 capture_max_lines=DEFAULT_CAPTURE_MAX_LINES, capture_max_bytes=None, spill_output=False,
+                 process_groups=True, capped=True):
         """
         :param host: to connect to. Can either be an OverthereHost or an XL Deploy's HostContainer class
         :param enable_logging: Enables info logging to console.
-        :param stream_command_output: True when remote command execution output is to be send to stdout and stderr
+        :param stream_command_output: True when remote command execution output is to be written to the task log
+        :param pooled: True to borrow the connection from the shared OverthereConnectionPool. Only supported for OverthereHost.
+        :param capture_max_lines: number of trailing stdout and stderr lines kept in the CommandResponse. None for no limit
+        :param capture_max_bytes: number of trailing stdout and stderr characters kept in the CommandResponse. None for no limit
+        :param spill_output: True to write the full stdout and stderr of each command to gzipped files in the working directory
+        :param process_groups: True to run each command in its own process group on the host, which is killed when the command
+                               is interrupted, times out or loses its connection.  Only for remote Unix OverthereHosts
+        :param capped: False to borrow a pooled connection even when the host is at its connection cap.  For short commands only
         """
         self.os = host.os
         self._host = host
@@ -259,9 +711,18 @@ class OverthereHostSession(object):
         self._work_dir = None
         self.logger = OverthereSessionLogger(enabled=enable_logging)
         self._stream_command_output = stream_command_output
+        self._pool = OverthereConnectionPool.shared() if pooled and isinstance(host, OverthereHost) else None
+        self._capped = capped
+        self._capture_max_lines = capture_max_lines
+        self._capture_max_bytes = capture_max_bytes
+        self._spill_output = spill_output
+        self._spill_count = 0
+        self._local_shell = isinstance(host, OverthereHost) and host.protocol == "local" and not self.is_windows()
+        """local processes are not started through a shell, commands are passed to sh -c instead"""
+        self._process_groups = process_groups and isinstance(host, OverthereHost) and host.protocol != "local" \
+            and not self.is_windows()
 
     def __enter__(self):
-        self.work_dir()
         return self
 
     def __exit__(self, type, value, traceback):
@@ -278,18 +739,34 @@ class OverthereHostSession(object):
         :return: com.xebialabs.overthere.OverthereConnection.
         """
         if self._conn is None:
-            self._conn = self._host.connection
+            with timed(CONNECT_PHASE):
+                if self._pool is not None:
+                    self._conn = self._pool.borrow(self._host, capped=self._capped)
+                else:
+                    self._conn = self._host.connection
         return self._conn
 
     def close_conn(self):
-        """Close connection to target host"""
-        if self._conn is not None:
+        """Close connection to target host.  A pooled connection is returned to the pool instead."""
+        if self._conn is None:
+            return
+        if self._pool is None:
             self._conn.close()
-            self._conn = None
+        else:
+            try:
+                if self._work_dir is not None:
+                    self._work_dir.deleteRecursively()
+            except:
+                self._pool.invalidate(self._host, self._conn)
+            else:
+                self._pool.release(self._host, self._conn)
+        self._conn = None
+        self._work_dir = None
 
     def work_dir(self):
         """
         Get the temporary working directory on the target system for the current session.
+        The directory is created on first use.
         :return: com.xebialabs.overthere.OverthereFile
         """
         if self._work_dir is None:
@@ -406,6 +883,76 @@ class OverthereHostSession(object):
         elif not target_dir_shared and not remove_basedir:
             self.logger.info("Target directory [%s] is not shared, but still has content from an external source. Will not delete" % target.path)
 
+    def delete_from_bulk(self, source, target, target_dir_shared=False):
+        """
+        Same as delete_from, but lists both directories in one command and removes the entries in one
+        batched 'rm -rf' instead of several round trips per entry.  Only for Unix hosts.
+        :param source: directory of files to be deleted.  Listed in the same command when on this session's host.
+        :param target: directory or file on this session's host to be deleted.
+        :param target_dir_shared: When True, the target directory itself will not be deleted.
+        :return: number of entries removed, counting the target directory itself
+        """
+        if self.is_windows():
+            raise Exception("delete_from_bulk needs a Unix host, use delete_from for [%s]" % target.path)
+        same_host = source.getConnection() == self.get_conn()
+        t = pipes.quote(target.path)
+        cmd = ["if", "[", "!", "-e", t, "];", "then", "echo", "missing;",
+               "elif", "[", "!", "-d", t, "];", "then", "echo", "file;",
+               "else", "echo", "dir;", "ls", "-A", t, "|", "sed", "'s/^/t /';"]
+        if same_host:
+            s = pipes.quote(source.path)
+            cmd += ["if", "[", "-d", s, "];", "then", "ls", "-A", s, "|", "sed", "'s/^/s /';",
+                    "else", "echo", "nosource;", "fi;"]
+        cmd += ["fi"]
+        # the session may keep only the tail of the output, the listing is needed in full
+        listing = StreamingOutputHandler()
+        self.execute(cmd, suppress_streaming_output=True, listeners=[listing])
+        lines = listing.outputLines
+
+        kind = lines[0] if lines else "missing"
+        if kind == "missing":
+            self.logger.info("Target [%s] does not exist. No deletion to be performed" % target.path)
+            return 0
+        if kind == "file":
+            self.logger.info("Deleting [%s]" % target.path)
+            self.execute(["rm", "-f", "--", t])
+            return 1
+        if same_host:
+            assert "nosource" not in lines, "Source [%s] is not a directory" % source.path
+            source_names = set(line[2:] for line in lines if line.startswith("s "))
+        else:
+            assert source.isDirectory(), "Source [%s] is not a directory" % source.path
+            source_names = set(f.getName() for f in source.listFiles())
+        target_names = [line[2:] for line in lines if line.startswith("t ")]
+        names = [n for n in target_names if n in source_names]
+        remove_basedir = len(names) == len(target_names)
+
+        batches = [[]]
+        length = 0
+        for name in names:
+            quoted = pipes.quote(name)
+            if batches[-1] and length + len(quoted) > MAX_BATCH_CHARS:
+                batches.append([])
+                length = 0
+            batches[-1].append(quoted)
+            length += len(quoted) + 1
+        removed = len(names)
+        self.logger.info("Deleting %d of %d entries of [%s]" % (len(names), len(target_names), target.path))
+        for i, batch in enumerate(batches):
+            cmd = ["cd", t, "&&", "rm", "-rf", "--"] + batch if batch else []
+            if i == len(batches) - 1 and remove_basedir and not target_dir_shared:
+                self.logger.info("Deleting directory [%s]" % target.path)
+                cmd += (["&&"] if cmd else []) + ["rmdir", t]
+                removed += 1
+            if cmd:
+                self.execute(cmd)
+
+        if remove_basedir and target_dir_shared:
+            self.logger.info("Target directory [%s] is shared. Will not delete" % target.path)
+        elif not target_dir_shared and not remove_basedir:
+            self.logger.info("Target directory [%s] is not shared, but still has content from an external source. Will not delete" % target.path)
+        return removed
+
     def copy_text_to_file(self, content, target, mkdirs=True):
         """
         Copies the content to the specified file
@@ -446,60 +993,235 @@ class OverthereHostSession(object):
             target.setExecutable(executable)
         return target
 
-    def execute_cmd(self, cmd_line, show_output=False):
+    def execute_cmd(self, cmd_line, show_output=False, listeners=(), timeout_secs=None, check_success=True):
         """
         Logs command line and, optionally, output (stdout) of the command.
         :param cmd_line: Command line as an Array of Strings.
+        :param check_success: checks the return code is 0
+        :param listeners: output handlers that receive every stdout line while the command runs
+        :param timeout_secs: the command is killed when it runs longer than this.  None for no limit
         :return: CommandResponse
         """
         mdl.println("Executing command line:")
         mdl.print_code(" ".join(cmd_line))
 
-        result = self.execute(cmd_line)
+        result = self.execute(cmd_line, check_success=check_success, listeners=listeners, timeout_secs=timeout_secs)
         if show_output:
             mdl.println("Output:")
             mdl.print_code("\n".join(result.stdout))
 
         return result
 
-    def execute(self, cmd, check_success=True, suppress_streaming_output=False):
+    def execute_script(self, content, filename="script.sh", check_success=True, show_script=True, listeners=(),
+                       timeout_secs=None):
         """
-        Executes the command on the remote system and returns the result
+        Uploads a shell script to the session's working directory and executes it.
+        :param content: script content. A '#!/bin/sh' line is added when the script has none.
+        :param filename: name of the script in the working directory
+        :param check_success: checks the return code is 0
+        :param show_script: logs the script content
+        :param listeners: output handlers that receive every stdout line while the script runs
+        :param timeout_secs: the script is killed when it runs longer than this.  None for no limit
+        :return: CommandResponse
+        """
+        if not content.startswith("#!"):
+            content = "#!/bin/sh\n%s\n" % content
+        if show_script:
+            mdl.println("Executing script:")
+            mdl.print_code(content)
+        script = self.upload_text_content_to_work_dir(content, filename, executable=True)
+        return self.execute([script.path], check_success=check_success, listeners=listeners, timeout_secs=timeout_secs)
+
+    def execute(self, cmd, check_success=True, suppress_streaming_output=False, listeners=(), timeout_secs=None):
+        """
+        Executes the command on the remote system and returns the result.
+        With process groups, the command's process group is killed, TERM first and KILL after KILL_GRACE_SECS,
+        when the execution is interrupted, e.g. by aborting the task, or times out.
         :param cmd: Command line as an Array of Strings or String.  A String is split by space.
         :param check_success: checks the return code is 0. On failure the output is printed to stdout and a system exit is performed
         :param suppress_streaming_output:  suppresses the output of the execution when the session is in streaming mode.
+        :param listeners: com.xebialabs.overthere.OverthereExecutionOutputHandler instances that receive every stdout line
+        :param timeout_secs: the command is killed and an exception raised when it runs longer than this.  None for no limit
         :return: CommandResponse
         """
-        
-        capture_so_handler = CapturingOverthereExecutionOutputHandler.capturingHandler()
-        capture_se_handler = CapturingOverthereExecutionOutputHandler.capturingHandler()
 
+        stream_so_handler = None
+        stream_se_handler = None
         if self._stream_command_output and not suppress_streaming_output:
-            console_so_handler = ConsoleOverthereExecutionOutputHandler.sysoutHandler()
-            console_se_handler = ConsoleOverthereExecutionOutputHandler.syserrHandler()
-            so_handler = MultipleOverthereExecutionOutputHandler.multiHandler([capture_so_handler, console_so_handler])
-            se_handler = MultipleOverthereExecutionOutputHandler.multiHandler([capture_se_handler, console_se_handler])
-        else:
-            so_handler = capture_so_handler
-            se_handler = capture_se_handler
+            stream_so_handler = LogWriterOutputHandler()
+            stream_se_handler = LogWriterOutputHandler()
+
+        so_digest = FailureDigest()
+        se_digest = FailureDigest()
+        so_handler = self._new_output_handler("stdout", [stream_so_handler, so_digest] + list(listeners))
+        se_handler = self._new_output_handler("stderr", [stream_se_handler, se_digest])
 
         if isinstance(cmd, basestring):
             cmd = cmd.split()
 
+        group = None
+        if self._process_groups:
+            group = ProcessGroupRecorder(se_handler)
+            cmd = ["sh", "-c", pipes.quote(GROUP_SCRIPT % {"cmd": pipes.quote(" ".join(cmd)), "marker": GROUP_MARKER,
+                                                           "grace": KILL_GRACE_SECS})]
+
+        cmdline = self._cmdline(cmd)
+
+        conn = self.get_conn()
+        deadline = time.time() + timeout_secs if timeout_secs else None
+        with timed(COMMAND_PHASE):
+            process = conn.startProcess(cmdline)
+            try:
+                # with process groups stdin stays open until the command exits.  Closing it kills the group
+                if group is None:
+                    process.getStdin().close()
+                so_pump = OutputStreamPump(process.getStdout(), so_handler, name="stdout-pump")
+                se_pump = OutputStreamPump(process.getStderr(), group or se_handler, name="stderr-pump")
+                so_pump.start()
+                se_pump.start()
+                if not (so_pump.await_eof(deadline) and se_pump.await_eof(deadline)):
+                    raise Exception("Command timed out after %d s" % timeout_secs)
+                rc = process.waitFor()
+            except:
+                if group is not None:
+                    self._kill_group(group.pgid)
+                process.destroy()
+                raise
+            finally:
+                if group is not None:
+                    OverthereHostSession._close_quietly(process.getStdin())
+                so_handler.close()
+                se_handler.close()
+
+        response = CommandResponse(rc=rc, stdout=so_handler.outputLines, stderr=se_handler.outputLines)
+        response.stdout_digest = so_digest
+        response.stderr_digest = se_digest
+        response.stdout_log = so_handler.spill_file
+        response.stderr_log = se_handler.spill_file
+        response.truncated = so_handler.truncated or se_handler.truncated
+        response.pgid = group.pgid if group is not None else None
+
+        if response.rc != 0 and check_success:
+            self.report_failure(response, print_output=not suppress_streaming_output)
+
+        return response
+
+    def _kill_group(self, pgid):
+        """
+        Kills a process group on the host over a separate connection, TERM first and KILL after KILL_GRACE_SECS.
+        The connection is not pooled, so it is not held up by the host's connection cap.
+        Without a group id, killing is left to the watcher of GROUP_SCRIPT once the command's connection closes.
+        """
+        if pgid is None:
+            return
+        mdl.println("Killing process group %d on the host" % pgid)
+        try:
+            session = OverthereHostSession(self._host, enable_logging=False, pooled=False, process_groups=False)
+            with session:
+                session.execute(["sh", "-c", pipes.quote(KILL_GROUP_SCRIPT % {"pgid": pgid, "grace": KILL_GRACE_SECS})],
+                                check_success=False)
+        except:
+            mdl.println("Could not kill process group %d: %s" % (pgid, sys.exc_info()[1]))
+
+    @staticmethod
+    def _close_quietly(stream):
+        try:
+            stream.close()
+        except:
+            pass
+
+    def download_tar(self, remote_dir, paths, local_dir):
+        """
+        Streams files and directories from the remote host as one gzipped tar over a single command
+        and unpacks it locally with tar.
+        :param remote_dir: directory on the remote host the paths are relative to
+        :param paths: Array of paths relative to remote_dir
+        :param local_dir: local directory the paths are unpacked into.  Created when missing
+        :return: number of compressed bytes received
+        """
+        # COPYFILE_DISABLE keeps macOS tar from adding ._ files with extended attributes
+        cmdline = self._cmdline(["cd", pipes.quote(remote_dir), "&&", "COPYFILE_DISABLE=1", "tar", "czf", "-", "--"] +
+                                [pipes.quote(p) for p in paths])
+
+        File(local_dir).mkdirs()
+        unpack = ProcessBuilder(["tar", "xzf", "-", "-C", local_dir]).redirectErrorStream(True).start()
+        # read while copying, a full pipe would block the local tar and the copy with it
+        unpack_handler = StreamingOutputHandler(max_lines=DEFAULT_CAPTURE_MAX_LINES)
+        unpack_pump = OutputStreamPump(unpack.getInputStream(), unpack_handler, name="unpack-pump")
+        unpack_pump.start()
+        se_digest = FailureDigest()
+        se_handler = self._new_output_handler("stderr", [se_digest])
+        received = 0
+        process = self.get_conn().startProcess(cmdline)
+        try:
+            process.getStdin().close()
+            se_pump = OutputStreamPump(process.getStderr(), se_handler, name="stderr-pump")
+            se_pump.start()
+            source = process.getStdout()
+            sink = unpack.getOutputStream()
+            buf = jarray.zeros(65536, "b")
+            while True:
+                n = source.read(buf)
+                if n < 0:
+                    break
+                sink.write(buf, 0, n)
+                received += n
+            sink.close()
+            se_pump.await_eof()
+            rc = process.waitFor()
+        except:
+            process.destroy()
+            unpack.destroy()
+            raise
+        finally:
+            se_handler.close()
+
+        unpack_pump.await_eof()
+        unpack_rc = unpack.waitFor()
+        # a failed remote tar leaves the local tar a truncated stream, its error explains the failure
+        if rc != 0:
+            response = CommandResponse(rc=rc, stdout=[], stderr=se_handler.outputLines)
+            response.stderr_digest = se_digest
+            self.report_failure(response)
+        if unpack_rc != 0:
+            raise Exception("Unpacking into '%s' failed: %s" % (local_dir, "\n".join(unpack_handler.outputLines)))
+        return received
+
+    def _cmdline(self, cmd):
+        """
+        :param cmd: command line as an Array of shell tokens
+        :return: CmdLine the remote shell parses, or that runs the tokens with sh -c on the local host
+        """
         cmdline = CmdLine()
+        if self._local_shell:
+            for s in ["sh", "-c", " ".join(cmd)]:
+                cmdline.addArgument(s)
+            return cmdline
         for s in cmd:
             cmdline.addRaw(s)
+        return cmdline
 
-        rc = self.get_conn().execute(so_handler, se_handler, cmdline)
-        #wait for output to drain
-        time.sleep(1)
-
-        response = CommandResponse(rc=rc, stdout=capture_so_handler.outputLines, stderr=capture_se_handler.outputLines)
-
-        if response.rc != 0 and check_success:
-            if not suppress_streaming_output:
-                mdl.print_error(StringUtils.strip_ansi(StringUtils.concat(response.stdout)))
-                mdl.print_error(StringUtils.strip_ansi(StringUtils.concat(response.stderr)))
-            raise Exception(response.rc)
+    def _new_output_handler(self, stream_name, forward):
+        spill_file = None
+        if self._spill_output:
+            self._spill_count += 1
+            spill_file = self.work_dir_file("%s-%d.log.gz" % (stream_name, self._spill_count))
+        return StreamingOutputHandler(max_lines=self._capture_max_lines, max_bytes=self._capture_max_bytes,
+                                      forward=forward, spill_file=spill_file)
 
-        return response
+    def report_failure(self, response, print_output=True):
+        """
+        Prints the output of a failed command and raises an exception with its return code
+        :param response: CommandResponse of the failed command
+        :param print_output: False to only raise the exception
+        """
+        if print_output:
+            for digest, lines in [(response.stdout_digest, response.stdout), (response.stderr_digest, response.stderr)]:
+                if digest is None:
+                    digest = FailureDigest()
+                    for line in lines:
+                        digest.handleLine(line)
+                text = digest.render()
+                if StringUtils.notEmpty(text):
+                    mdl.print_error(text)
+        raise Exception(response.rc)
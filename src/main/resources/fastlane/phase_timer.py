@@ -0,0 +1,115 @@
+#
+#
+# Copyright 2019 XEBIALABS
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+#
+# THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND, EITHER EXPRESSED OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS
+# FOR A PARTICULAR PURPOSE. THIS CODE AND INFORMATION ARE NOT SUPPORTED BY XEBIALABS.
+#
+
+"""
+    Durations of the phases of a task, measured with the JVM's monotonic clock.  A task starts a timer for
+    its thread; code anywhere below it records phases with 'timed', which does nothing when no timer runs.
+"""
+import threading
+from contextlib import contextmanager
+
+from java.lang import System
+
+from fastlane.markdown_logger import MarkdownLogger as mdl
+
+CONNECT_PHASE = "connect"
+COMMAND_PHASE = "remote command"
+# phases that run within the other phases.  They are listed last in the summary
+OVERLAPPING_PHASES = [CONNECT_PHASE, COMMAND_PHASE]
+
+
+class PhaseTimer(object):
+    """Accumulated duration and number of calls of each phase"""
+
+    _local = threading.local()
+
+    def __init__(self):
+        self._names = []
+        self._calls = {}
+        self._nanos = {}
+        self._start = System.nanoTime()
+
+    @staticmethod
+    def start():
+        """
+        Starts a timer for the current thread.
+        :return: PhaseTimer
+        """
+        timer = PhaseTimer()
+        PhaseTimer._local.timer = timer
+        return timer
+
+    @staticmethod
+    def current():
+        """
+        :return: the timer of the current thread, None when no timer was started
+        """
+        return getattr(PhaseTimer._local, "timer", None)
+
+    @staticmethod
+    def stop():
+        PhaseTimer._local.timer = None
+
+    def record(self, name, nanos):
+        if name not in self._calls:
+            self._names.append(name)
+            self._calls[name] = 0
+            self._nanos[name] = 0
+        self._calls[name] += 1
+        self._nanos[name] += nanos
+
+    def calls(self, name):
+        return self._calls.get(name, 0)
+
+    def duration_ms(self, name):
+        return self._nanos.get(name, 0) / 1000000
+
+    def total_ms(self):
+        """
+        :return: milliseconds since the timer was started
+        """
+        return (System.nanoTime() - self._start) / 1000000
+
+    def durations_ms(self):
+        """
+        :return: dict of phase name to milliseconds
+        """
+        return dict((name, self.duration_ms(name)) for name in self._names)
+
+    def print_summary(self):
+        total = max(1, self.total_ms())
+        rows = []
+        for name in sorted(self._names, key=lambda n: n in OVERLAPPING_PHASES):
+            ms = self.duration_ms(name)
+            rows.append([name, str(self._calls[name]), "%.1f s" % (ms / 1000.0), "%d%%" % (ms * 100 / total)])
+        rows.append(["total", "", "%.1f s" % (total / 1000.0), "100%"])
+        mdl.print_table(["Phase", "Calls", "Duration", "Share"], rows)
+        mdl.println("_%s run within the other phases._" % " and ".join(OVERLAPPING_PHASES))
+
+
+@contextmanager
+def timed(name):
+    """
+    Records the duration of the enclosed block as phase name of the current thread's timer.
+    """
+    timer = PhaseTimer.current()
+    start = System.nanoTime()
+    try:
+        yield
+    finally:
+        if timer is not None:
+            timer.record(name, System.nanoTime() - start)
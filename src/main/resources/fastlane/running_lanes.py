@@ -0,0 +1,78 @@
+#
+#
+# Copyright 2019 XEBIALABS
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+#
+# THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND, EITHER EXPRESSED OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS
+# FOR A PARTICULAR PURPOSE. THIS CODE AND INFORMATION ARE NOT SUPPORTED BY XEBIALABS.
+#
+
+"""
+    Registry of the lanes running on a fastlane host.  While a lane runs, a file in
+    <Working Dir>/.xlr-fastlane/running holds the pid of the shell running it, whether the lane runs directly,
+    in the preloaded worker, in a job script or detached.  Host probes count the files whose pid is alive.
+"""
+import pipes
+import uuid
+
+RUNNING_DIR = ".xlr-fastlane/running"
+
+# a marker is written right after its file is created, so only markers older than a minute are stale
+COUNT_TEMPLATE = """running=0
+for lane_marker in %(running_dir)s/*; do
+  [ -f "$lane_marker" ] || continue
+  if kill -0 "$(cat "$lane_marker")" 2>/dev/null; then
+    running=$((running + 1))
+  elif [ -n "$(find "$lane_marker" -mmin +1 2>/dev/null)" ]; then
+    rm -f "$lane_marker"
+  fi
+done"""
+
+
+def count_script(base_dir):
+    """
+    :param base_dir: Working Dir on the host
+    :return: shell script that sets $running to the number of lanes running in base_dir and removes stale markers
+    """
+    return COUNT_TEMPLATE % {"running_dir": "%s/%s" % (pipes.quote(base_dir), RUNNING_DIR)}
+
+
+class LaneMarker(object):
+    """Marks one lane as running while its shell is alive"""
+
+    def __init__(self, base_dir):
+        """
+        :param base_dir: Working Dir on the host
+        """
+        self.dir = "%s/%s" % (base_dir, RUNNING_DIR)
+        self.path = "%s/%s" % (self.dir, uuid.uuid4().hex)
+
+    def wrap_cmd(self, cmd):
+        """
+        :param cmd: lane command line as an Array of Strings
+        :return: command line that runs cmd while the lane is marked as running and exits with its exit code
+        """
+        path = pipes.quote(self.path)
+        return ["mkdir", "-p", pipes.quote(self.dir), "&&", "echo", "$$", ">", path, ";", "{"] + cmd + \
+               [";", "};", "lane_rc=$?;", "rm", "-f", path, ";", "exit", "$lane_rc"]
+
+    def wrap_script(self, script):
+        """
+        :param script: lane shell script
+        :return: shell script that runs script in a subshell while the lane is marked as running and exits with its exit code
+        """
+        path = pipes.quote(self.path)
+        return "\n".join([
+            "mkdir -p %s && echo $$ > %s" % (pipes.quote(self.dir), path),
+            "( %s )" % script,
+            "lane_rc=$?",
+            "rm -f %s" % path,
+            "exit $lane_rc"])
@@ -0,0 +1,116 @@
+#
+#
+# Copyright 2019 XEBIALABS
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+#
+# THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND, EITHER EXPRESSED OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS
+# FOR A PARTICULAR PURPOSE. THIS CODE AND INFORMATION ARE NOT SUPPORTED BY XEBIALABS.
+#
+
+"""
+    Progress of a running lane, followed from the '--- Step: <action> ---' banners fastlane prints
+    before each action.  Only step changes are written to the task log, not the lane output.
+"""
+import re
+import time
+
+from com.xebialabs.overthere import OverthereExecutionOutputHandler
+
+from fastlane.overthere import StringUtils
+from fastlane.markdown_logger import MarkdownLogger as mdl
+
+# fastlane prefixes its log lines with the time, e.g. '[14:02:11]: --- Step: gym ---'
+TIMESTAMP_RE = re.compile(r'^\[(\d{2}):(\d{2}):(\d{2})\]: ')
+STEP_RE = re.compile(r'^-+ Step: (.+?) -+$')
+DAY_SECS = 24 * 3600
+
+
+def format_secs(secs):
+    secs = int(secs)
+    if secs < 60:
+        return "%d s" % secs
+    if secs < 3600:
+        return "%d min %02d s" % (secs / 60, secs % 60)
+    return "%d h %02d min" % (secs / 3600, (secs % 3600) / 60)
+
+
+class StepTracker(OverthereExecutionOutputHandler):
+    """Output handler that reports the start and duration of each fastlane step"""
+
+    def __init__(self, heartbeat_secs=120):
+        """
+        :param heartbeat_secs: a step running longer than this is reported again every heartbeat_secs
+        """
+        self.heartbeat_secs = heartbeat_secs
+        self.steps = []
+        """list of [name, start secs, end secs].  The end is None for the running step"""
+        self._log_secs = None
+        self._log_wall = None
+        self._last_report = None
+
+    def handleChar(self, c):
+        pass
+
+    def handleLine(self, line):
+        line = StringUtils.strip_ansi(line).strip()
+        now = self._now(line)
+        match = STEP_RE.match(TIMESTAMP_RE.sub("", line))
+        if match:
+            self._start_step(match.group(1).strip(), now)
+        elif self.steps and now - self._last_report >= self.heartbeat_secs:
+            name, start, _ = self.steps[-1]
+            mdl.println("Step %d `%s` running for %s" % (len(self.steps), name, format_secs(now - start)))
+            self._last_report = now
+
+    def _now(self, line):
+        """
+        :return: seconds according to the fastlane timestamps.  Wall clock seconds until the first timestamp.
+        """
+        wall = time.time()
+        match = TIMESTAMP_RE.match(line)
+        if match:
+            secs = int(match.group(1)) * 3600 + int(match.group(2)) * 60 + int(match.group(3))
+            if self._log_secs is not None:
+                # the timestamps have no date.  Keep counting past midnight
+                secs += (self._log_secs // DAY_SECS) * DAY_SECS
+                if secs < self._log_secs - DAY_SECS / 2:
+                    secs += DAY_SECS
+            self._log_secs = secs
+            self._log_wall = wall
+            return secs
+        if self._log_secs is not None:
+            return self._log_secs + (wall - self._log_wall)
+        return wall
+
+    def _start_step(self, name, now):
+        msg = "Step %d `%s` started" % (len(self.steps) + 1, name)
+        if self.steps:
+            self.steps[-1][2] = now
+            previous, start, _ = self.steps[-1]
+            msg = "%s, `%s` took %s" % (msg, previous, format_secs(now - start))
+        self.steps.append([name, now, None])
+        self._last_report = now
+        mdl.println(msg)
+
+    def finish(self, rc=0):
+        """
+        Ends the running step and prints a table of all steps.
+        :param rc: exit code of the lane.  A non-zero code marks the running step as failed
+        """
+        if not self.steps:
+            return
+        now = self._now("")
+        rows = []
+        for i, (name, start, end) in enumerate(self.steps):
+            last = i == len(self.steps) - 1
+            status = "failed" if last and rc != 0 else "done"
+            rows.append([str(i + 1), name, format_secs((end if end is not None else now) - start), status])
+        mdl.print_table(["#", "Step", "Duration", "Status"], rows)
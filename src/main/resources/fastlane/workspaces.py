@@ -0,0 +1,123 @@
+#
+#
+# Copyright 2019 XEBIALABS
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+#
+# THIS CODE AND INFORMATION ARE PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND, EITHER EXPRESSED OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED WARRANTIES OF MERCHANTABILITY AND/OR FITNESS
+# FOR A PARTICULAR PURPOSE. THIS CODE AND INFORMATION ARE NOT SUPPORTED BY XEBIALABS.
+#
+
+"""
+    Keeps the working copies under the Working Dir of a fastlane host within a disk budget.  Each working
+    copy has an entry in <Working Dir>/.xlr-fastlane/workspaces recording its size, and the entry's
+    modification time is its last use.  Before a working copy is cloned, the least recently used ones are
+    evicted until the budget and the minimum free disk are met.  Working copies held by a running task are kept.
+"""
+import pipes
+import re
+import uuid
+
+from fastlane.host_lock import HostLock
+
+# a hold older than this belongs to a task that died without releasing it
+HOLD_STALE_SECS = 12 * 3600
+
+HOLD_TEMPLATE = """%(lock_acquire)s
+ws_registry=%(registry)s
+ws_evicted=""
+if [ ! -e %(git_dir)s ]; then
+  ws_total_kb=$(cat $ws_registry/*.ws 2>/dev/null | awk '{ s += $1 } END { print s + 0 }')
+  ws_free_kb=$(df -Pk %(base_dir)s | awk 'NR==2 {print $4}')
+  for ws_entry in $(ls -tr $ws_registry/*.ws 2>/dev/null); do
+    { [ %(budget_kb)d -gt 0 ] && [ $ws_total_kb -gt %(budget_kb)d ]; } || \\
+      { [ %(min_free_kb)d -gt 0 ] && [ ${ws_free_kb:-0} -lt %(min_free_kb)d ]; } || break
+    read ws_kb ws_path < $ws_entry
+    case "$ws_path" in %(base_dir)s/?*) ;; *) continue ;; esac
+    [ -n "$(find $ws_registry -maxdepth 1 -name "$(basename $ws_entry .ws).held-*" -mmin -%(stale_min)d)" ] && continue
+    [ -d "$ws_path.lock" ] && continue
+    echo "Evicting least recently used workspace $ws_path ($((ws_kb / 1024)) MB)"
+    if [ -e "$ws_path" ]; then
+      mv "$ws_path" "$ws_path.evicting-$$" && ws_evicted="$ws_evicted $ws_path.evicting-$$"
+    fi
+    rm -f $ws_entry
+    ws_total_kb=$((ws_total_kb - ws_kb))
+    ws_free_kb=$((ws_free_kb + ws_kb))
+  done
+fi
+mkdir -p %(hold)s
+[ -f %(entry)s ] && touch %(entry)s
+%(lock_release)s
+if [ -n "$ws_evicted" ]; then
+  rm -rf $ws_evicted
+fi"""
+
+RELEASE_TEMPLATE = """if [ -d %(git_dir)s ]; then
+  echo "$(du -sk %(git_dir)s | cut -f1) %(git_dir)s" > %(entry)s.tmp && mv %(entry)s.tmp %(entry)s
+else
+  rm -f %(entry)s
+fi
+rm -rf %(hold)s"""
+
+
+class WorkspaceManager(object):
+    """Disk budget of the working copies in the Working Dir of a host"""
+
+    def __init__(self, repo_base_dir, budget_mb=0, min_free_mb=0):
+        """
+        :param repo_base_dir: Working Dir on the host
+        :param budget_mb: maximum total size of the working copies.  0 for no limit
+        :param min_free_mb: free disk in the Working Dir to keep.  0 for no limit
+        """
+        self.repo_base_dir = repo_base_dir.rstrip("/")
+        self.budget_mb = budget_mb
+        self.min_free_mb = min_free_mb
+        self.registry_dir = "%s/.xlr-fastlane/workspaces" % self.repo_base_dir
+        self.hold_id = uuid.uuid4().hex[:12]
+        """identifies the hold of this task on its working copy"""
+
+    @staticmethod
+    def new_instance(repo_base_dir, params):
+        """
+        :return: WorkspaceManager, None when neither a budget nor a minimum free disk is set
+        """
+        budget_mb = params["gitWorkspaceBudgetMb"] or 0
+        min_free_mb = params["gitWorkspaceMinFreeMb"] or 0
+        if not budget_mb and not min_free_mb:
+            return None
+        return WorkspaceManager(repo_base_dir, budget_mb, min_free_mb)
+
+    def _script_vars(self, git_dir):
+        name = re.sub(r'[^A-Za-z0-9._-]', '_', git_dir[len(self.repo_base_dir):].strip("/"))
+        lock = HostLock("%s.lock" % self.registry_dir, wait_secs=600, stale_secs=1800)
+        return {"registry": pipes.quote(self.registry_dir),
+                "base_dir": pipes.quote(self.repo_base_dir),
+                "git_dir": pipes.quote(git_dir),
+                "entry": pipes.quote("%s/%s.ws" % (self.registry_dir, name)),
+                "hold": pipes.quote("%s/%s.held-%s" % (self.registry_dir, name, self.hold_id)),
+                "budget_kb": self.budget_mb * 1024,
+                "min_free_kb": self.min_free_mb * 1024,
+                "stale_min": HOLD_STALE_SECS / 60,
+                "lock_acquire": lock.acquire_script(),
+                "lock_release": lock.release_script()}
+
+    def hold_script(self, git_dir):
+        """
+        :param git_dir: working copy the task builds in
+        :return: shell script that evicts least recently used working copies when git_dir does not exist yet,
+                 then holds git_dir so other tasks do not evict it
+        """
+        return HOLD_TEMPLATE % self._script_vars(git_dir)
+
+    def release_script(self, git_dir):
+        """
+        :return: shell script that records the size and last use of git_dir and drops the hold
+        """
+        return RELEASE_TEMPLATE % self._script_vars(git_dir)